@@ -2,36 +2,95 @@ import os
 import numpy as np
 import sqlite3
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, flash, redirect, render_template, request, session
-from flask_session import Session
-from werkzeug.security import check_password_hash, generate_password_hash
-from helpers import apology, draw_chart, is_valid_month, is_valid_username, login_required, swap
-from helpers_data import get_data, get_data_locations
-from helpers_maps import draw_multi_maps
+from flask import Flask, abort, flash, jsonify, redirect, render_template, request, session
+from werkzeug.security import check_password_hash, generate_password_hash, safe_join
+from helpers import admin_required, apology, draw_chart, is_valid_month, is_valid_username, login_required, swap
+from helpers_data import run_job
+from helpers_db import connect, get_db, init_app as init_db
+from helpers_jobs import cancel_job, job_errors, job_progress, job_status, plan_job, resumable_jobs
+from helpers_api import GRID_FORMATS, grid_path, series_path, write_grid, write_series
+from helpers_assets import asset_url
+from helpers_cache import RenderCache, render_lock
+from helpers_climatology import baselines_mtime, load_baselines
+from helpers_cube import validate_cube
+from helpers_http import cache_policy, is_immutable, is_private, send_cached
+from helpers_ingest import ApiBudget
+from helpers_locations import METHODS as LOCATION_METHODS, cell_location, location_data, nearest_cell
+from helpers_maps import draw_frame, draw_multi_maps, draw_raster, frame_palette, frame_path, generate_dates, raster_path
+from helpers_maps import DATA_TYPES as MAPS_DATA_TYPES, ANOMALY_TYPES, MAP_TYPES, SHAPE as MAPS_SHAPE, TREND_TYPES
+from helpers_periods import SEASONS, draw_period_map, draw_period_raster, load_prefix, parse_period, period_key, prefix_mtime
+from helpers_prerender import source_mtime
+from helpers_session import init_app as init_sessions
+from helpers_trends import MIN_YEARS as MIN_TREND_YEARS, draw_trend_map, draw_trend_raster, parse_trend, trend_key, trend_mtime, trend_path, write_trend
 
 SHAPE = (91, 91)
 DATA_TYPES = ["temp_mean", "temp_max", "temp_min", "precip"]
 START = "1950-01"
 END = "2023-12"
+UPDATE_DB = "static/weather_update.db"
+USERS_DB = "static/users.db"
+
+# The memory-mapped weather cube must agree with the constants used here and in helpers_maps
+if validate_cube(SHAPE, DATA_TYPES, START, END):
+    validate_cube(MAPS_SHAPE, MAPS_DATA_TYPES)
 
 # Configure application
 app = Flask(__name__)
 
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+# One connection per database and request, closed after it; WAL lets the pages read during an update
+app.config["DATABASES"] = {"users": USERS_DB, "weather": "static/weather.db", "update": UPDATE_DB}
+init_db(app)
+
+# Configure session to use SQLite (instead of signed cookies): only logged in users have a record,
+# which expires after SESSION_LIFETIME seconds without use
+app.config["PERMANENT_SESSION_LIFETIME"] = int(os.environ.get("SESSION_LIFETIME", 7 * 86400))
+init_sessions(app)
+
+# Rendered maps and charts are kept within a disk budget, evicting the least recently used first
+app.config["RENDER_CACHE_BYTES"] = int(os.environ.get("RENDER_CACHE_BYTES", 1024**3))
+app.config["RENDER_CACHE_POLICY"] = os.environ.get("RENDER_CACHE_POLICY", "lru")
+render_cache = RenderCache(budget=app.config["RENDER_CACHE_BYTES"], policy=app.config["RENDER_CACHE_POLICY"])
+# "webgl": light WebGL charts with annual and decadal levels, "classic": one trace per calendar month
+app.config["CHART_MODE"] = os.environ.get("CHART_MODE", "webgl")
+# "nearest": the chart of the nearest cell of the grid, "bilinear": interpolated from the four cells around
+app.config["LOCATION_METHOD"] = os.environ.get("LOCATION_METHOD", "nearest")
+# Charts only show the local data unless LOCATION_TOP_UP=1: then the months after END come from Open-Meteo,
+# within the API budget shared with the backfill jobs
+app.config["LOCATION_TOP_UP"] = os.environ.get("LOCATION_TOP_UP") == "1"
+location_budget = ApiBudget() if app.config["LOCATION_TOP_UP"] else None
+# Templates link the local copies of the JS/CSS libraries when they have been vendored (python helpers_assets.py)
+app.jinja_env.globals["asset_url"] = asset_url
+# Renders of past months (maps, raster images, frames, grids) are cached by browsers for this many seconds
+app.config["RENDER_MAX_AGE"] = int(os.environ.get("RENDER_MAX_AGE", 30 * 86400))
+
+# Grid updates run in the background, one job at a time.
+# Their state is stored in the journal of UPDATE_DB, so jobs interrupted by a restart are resumed here.
+update_jobs = ThreadPoolExecutor(max_workers=1)
+if os.path.isfile(UPDATE_DB):
+    con = connect(UPDATE_DB)
+    for job_id in resumable_jobs(con):
+        print(f"Resuming update job {job_id}")
+        update_jobs.submit(run_job, job_id, dbpath=UPDATE_DB)
+    con.close()
 
 
 @app.after_request
 def after_request(response):
-    """Ensure responses aren't cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
-    return response
+    """Ensure pages aren't cached, files choose their own policy (see helpers_http.py)"""
+    return cache_policy(response)
+
 
+def static_file(filename):
+    """Serve the files under static/ with a content-hash ETag, the renders of past months as immutable"""
+    path = safe_join(app.static_folder, filename)
+    if path is None or is_private(filename) or not os.path.isfile(path):
+        abort(404)
+    return send_cached(path, immutable=is_immutable(filename), max_age=app.config["RENDER_MAX_AGE"])
+
+
+app.view_functions["static"] = static_file
 
 
 @app.route("/")
@@ -63,13 +122,30 @@ def locations():
         print(f"Latitude: {lat} \nLongitude: {lon}")
         return apology(f"Latitude/logitude out of range", 400)
     
-    strlat = "{:.2f}".format(lat)
-    strlon = "{:.2f}".format(lon)
-    filename = "location_data/"+strlat+"_"+strlon+".html"
-    if not os.path.isfile("static/"+filename):
-        data = get_data(location=(lat, lon), date_end=datetime.today().strftime("%Y-%m-%d"), 
-                meteo_types=["temperature_2m_mean", "precipitation_sum"], return_DataFrame=True)
-        draw_chart(lat, lon, data, filename=filename.split("/")[1])
+    method = request.args.get("method", app.config["LOCATION_METHOD"])
+    if method not in LOCATION_METHODS:
+        return apology(f"This method ({method}) is not supported", 400)
+
+    # The nearest cell of the grid: all the locations of a cell share its chart
+    cell = nearest_cell(lat, lon) if method == "nearest" else None
+    if cell:
+        filename = f"location_data/cell_{cell[0]}_{cell[1]}.html"
+    else:
+        filename = "location_data/"+"{:.2f}".format(lat)+"_"+"{:.2f}".format(lon)+".html"
+    def render():
+        # Local data until END, the API only for the months after it (if enabled)
+        data = location_data(lat, lon, method=method, start=START, end=END,
+                             top_up=app.config["LOCATION_TOP_UP"], budget=location_budget)
+        if data is None:
+            raise ValueError(f"No data for {lat}°N, {lon}°E")
+        # The full data written next to a WebGL chart belongs to the chart's entry (see helpers_cache.COMPANIONS)
+        draw_chart(lat, lon, data, filename=filename.split("/")[1], mode=app.config["CHART_MODE"])
+    try:
+        render_cache.get_or_render(filename, render)
+    except ValueError:
+        return apology("No data for this location", 404)
+    if cell:
+        lat, lon = cell_location(*cell)
     return render_template("locations.html", imgname=imgname, lat=lat, lon=lon, filename=filename)
 
 
@@ -89,7 +165,7 @@ def login():
             return apology("must provide password", 400)
 
         # Query database for username
-        con = sqlite3.connect("static/users.db")
+        con = get_db("users", readonly=True)
         rows = con.execute(
             "SELECT * FROM users WHERE username = ?", (request.form.get("username"),)
         ).fetchall()
@@ -113,7 +189,6 @@ def login():
 
         # Redirect user to home page
         path = "/?message=Hi!+"+request.form.get("username")
-        con.close()
         return redirect(path)
 
     # User reached route via GET (as by clicking a link or via redirect)
@@ -134,26 +209,202 @@ def logout():
 def maps():
     month = request.args.get("month-picker")
     data_type = request.args.get("data-type")
+    start_month = request.args.get("start-month")
+    end_month = request.args.get("end-month")
+    start_year = request.args.get("start-year")
+    end_year = request.args.get("end-year")
+    season = request.args.get("season", "annual")
+    trend_start = request.args.get("trend-start")
+    trend_end = request.args.get("trend-end")
+    significant = request.args.get("significant") == "on"
     try:
         imgname = session["imgname"]
     except:
         imgname = None
+    if trend_start and trend_end and data_type:
+        # Linear trend of the annual means over a range of years (see helpers_trends.py)
+        key = trend_key(trend_start, trend_end, significant)
+        if not is_valid_trend(key):
+            return apology(f"Invalid period (at least {MIN_TREND_YEARS} years)", 400)
+        elif data_type not in DATA_TYPES:
+            return apology(f"This data type ({data_type}) is not supported", 400)
+        elif load_prefix()[0] is None:
+            # The trends are computed from the index of the periods
+            return apology("The maps of the trends are not available", 404)
+        filename = "weather_data/"+key+"_"+data_type+"_trend.html"
+        if render_cache.get_or_render(filename, lambda: draw_trend_map(key, data_type+"_trend")) is None:
+            return apology("No map for this period", 404)
+        label = f"{trend_start}-{trend_end}" + (" (significant at 5%)" if significant else "")
+        return render_template("maps.html", imgname=imgname, data_types=MAP_TYPES,
+                               data_type=data_type+"_trend", period=label,
+                               filename=filename, start=START, end=END)
+    if start_year and end_year and data_type:
+        # Mean of a season over a range of years, from the prefix sums (see helpers_periods.py)
+        key = period_key(start_year, end_year, season)
+        if not is_valid_period(key):
+            return apology("Invalid period", 400)
+        elif data_type not in DATA_TYPES:
+            return apology(f"This data type ({data_type}) is not supported", 400)
+        elif load_prefix()[0] is None:
+            # Without the index, the raster of the map could never be drawn
+            return apology("The maps of the periods are not available", 404)
+        filename = "weather_data/"+key+"_"+data_type+".html"
+        if render_cache.get_or_render(filename, lambda: draw_period_map(key, data_type)) is None:
+            return apology("No map for this period", 404)
+        return render_template("maps.html", imgname=imgname, data_types=MAP_TYPES,
+                               data_type=data_type, period=f"{season} {start_year}-{end_year}",
+                               filename=filename, start=START, end=END)
+    if start_month and end_month and data_type:
+        # Time range: an animated map whose frames are loaded as the slider moves
+        if not (is_valid_month(start_month, start=START, end=END) and is_valid_month(end_month, start=START, end=END)):
+            return apology("Invalid month", 400)
+        elif start_month > end_month:
+            return apology("The start month must be before the end month", 400)
+        elif data_type not in MAP_TYPES:
+            return apology(f"This data type ({data_type}) is not supported", 400)
+        months = [date.strftime("%Y-%m") for date in generate_dates(start_month + "-01", end_month + "-01")]
+        return render_template("maps.html", imgname=imgname, data_types=MAP_TYPES,
+                               data_type=data_type, months=months, start=START, end=END)
     if not (month and data_type):
-        return render_template("maps.html", imgname=imgname, data_types=DATA_TYPES,
-                               start=START, end=END)
+        return render_template("maps.html", imgname=imgname, data_types=MAP_TYPES, period_types=DATA_TYPES,
+                               seasons=SEASONS, start=START, end=END)
     elif not is_valid_month(month, start=START, end=END):
         return apology("Invalid month", 400)
-    elif data_type not in DATA_TYPES:
+    elif data_type not in MAP_TYPES:
         return apology(f"This data type ({data_type}) is not supported", 400)
     else:
         filename = "weather_data/"+month+"_"+data_type+".html"
-        if not os.path.isfile("static/"+filename):
-            draw_multi_maps(month+"-01", month+"-01", data_type) 
-        return render_template("maps.html", imgname=imgname, data_types=DATA_TYPES, 
+        if render_cache.get_or_render(filename, lambda: draw_multi_maps(month+"-01", month+"-01", data_type),
+                                      stale_before=anomaly_mtime(data_type)) is None:
+            return apology("No map for this month", 404)
+        return render_template("maps.html", imgname=imgname, data_types=MAP_TYPES, 
                                data_type=data_type, month=month,
                                filename=filename, start=START, end=END)
 
 
+@app.route("/raster/<month>/<data_type>.png")
+def raster(month, data_type):
+    """Serve the raster image of a month (or of a period, eg: "1991-2020_JJA") as a palette PNG, referenced by the map pages"""
+    if is_valid_trend(month) and data_type in TREND_TYPES:
+        # Drawn again when new months are merged. The trends are computed from the index of the periods,
+        # which is opened (and built if needed) before the render takes the lock of its key
+        if load_prefix()[0] is None:
+            return apology("Raster not found", 404)
+        return send_rendered(raster_path(month, data_type), lambda: draw_trend_raster(month, data_type), "image/png",
+                             stale_before=trend_mtime())
+    if is_valid_period(month) and data_type in DATA_TYPES:
+        # Drawn again when the index of the periods is rebuilt.
+        # The index is opened (and built if needed) before the render takes the lock of its key
+        if load_prefix()[0] is None:
+            return apology("Raster not found", 404)
+        return send_rendered(raster_path(month, data_type), lambda: draw_period_raster(month, data_type), "image/png",
+                             stale_before=prefix_mtime())
+    if not is_valid_month(month, start=START, end=END) or data_type not in MAP_TYPES:
+        return apology("Raster not found", 404)
+    return send_rendered(raster_path(month, data_type), lambda: draw_raster(month, data_type), "image/png",
+                         stale_before=anomaly_mtime(data_type))
+
+
+@app.route("/frames/<data_type>/<month>.bin")
+def frame(month, data_type):
+    """Serve one frame of the animated maps: the palette indices of a month, one byte per pixel"""
+    if not is_valid_month(month, start=START, end=END) or data_type not in MAP_TYPES:
+        return apology("Frame not found", 404)
+    return send_rendered(frame_path(month, data_type), lambda: draw_frame(month, data_type), "application/octet-stream",
+                         stale_before=anomaly_mtime(data_type))
+
+
+@app.route("/frames/<data_type>/palette.json")
+def frame_palette_json(data_type):
+    """Serve the palette shared by all the frames of a type of data"""
+    if data_type not in MAP_TYPES:
+        return apology("Palette not found", 404)
+    response = jsonify(frame_palette(data_type))
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["RENDER_MAX_AGE"]
+    return response
+
+
+@app.route("/api/grid/<month>/<data_type>.<format>")
+def api_grid(month, data_type, format):
+    """Serve the grid of a month as stored, as a NumPy .npy file or an Arrow IPC file"""
+    if not is_valid_month(month, start=START, end=END) or data_type not in DATA_TYPES or format not in GRID_FORMATS:
+        return jsonify(error="Grid not found"), 404
+    mimetype = "application/octet-stream" if format == "npy" else "application/vnd.apache.arrow.file"
+    return send_rendered(grid_path(month, data_type, format), lambda: write_grid(month, data_type, format),
+                         mimetype, stale_before=source_mtime())
+
+
+@app.route("/api/series/<int:row>/<int:col>.json")
+def api_series(row, col):
+    """Serve the time series of a cell of the grid as columnar JSON, one value per month from START to END"""
+    if not (0 <= row < SHAPE[0] and 0 <= col < SHAPE[1]):
+        return jsonify(error="Cell not found"), 404
+    return send_rendered(series_path(row, col), lambda: write_series(row, col, START, END),
+                         "application/json", stale_before=source_mtime())
+
+
+@app.route("/api/trend/<period>/<data_type>.npy")
+def api_trend(period, data_type):
+    """Serve the trend of a period ("YYYY-YYYY") as a NumPy .npy file: slope per decade, t, p-value and years of each cell"""
+    trend = parse_trend(period)
+    if not is_valid_trend(period) or trend[2] or data_type not in DATA_TYPES:
+        return jsonify(error="Trend not found"), 404
+    # Like the rasters of the trends, the index is opened before the lock of the file is taken
+    if load_prefix()[0] is None:
+        return jsonify(error="Trend not available"), 404
+    return send_rendered(trend_path(trend[0], trend[1], data_type), lambda: write_trend(trend[0], trend[1], data_type),
+                         "application/octet-stream", stale_before=trend_mtime())
+
+
+def anomaly_mtime(data_type):
+    """
+    The renders of an anomaly are drawn again once its baselines have been rebuilt, the others are kept (None).
+    The baselines are loaded (built if needed) here, before the render takes the lock of its key.
+    """
+    if data_type not in ANOMALY_TYPES:
+        return None
+    load_baselines()
+    return baselines_mtime()
+
+
+def is_valid_trend(key):
+    """Whether a trend key ("YYYY-YYYY", or "YYYY-YYYY_significant") is within the dataset"""
+    trend = parse_trend(key)
+    return trend is not None and int(START[:4]) <= trend[0] and trend[1] <= int(END[:4])
+
+
+def is_valid_period(key):
+    """Whether a period key ("YYYY-YYYY_season") is within the dataset"""
+    period = parse_period(key)
+    return period is not None and int(START[:4]) <= period[0] and period[1] <= int(END[:4])
+
+
+def send_rendered(path, render, mimetype, stale_before=None):
+    """
+    Render a file into the render cache if needed, then send it with a content-hash ETag.
+    Conditional and Range requests are answered by send_file().
+    The file is opened under the lock of its key, so an eviction cannot delete it in between;
+    if it was evicted right after being rendered, it is rendered once more.
+    """
+    key = os.path.relpath(path, render_cache.root)
+    for attempt in range(2):
+        if render_cache.get_or_render(key, render, stale_before=stale_before) is None:
+            break
+        with render_lock(key):
+            if os.path.isfile(render_cache.path(key)):
+                return send_cached(render_cache.path(key), mimetype=mimetype, immutable=is_immutable(key),
+                                   max_age=app.config["RENDER_MAX_AGE"])
+    return apology("The file cannot be rendered", 404)
+
+
+@app.route("/cache/stats")
+@admin_required
+def cache_stats():
+    """Report the hit/miss statistics and the disk usage of the render cache"""
+    return jsonify(render_cache.stats())
+
+
 @app.route("/profile", methods=["GET", "POST"])
 @login_required
 def profile():
@@ -165,7 +416,7 @@ def profile():
         img = request.files.get("img")
         bio = request.form.get("bio")
         
-        con = sqlite3.connect("static/users.db")
+        con = get_db("users")
         if img:
             # Save image only
             try:
@@ -190,7 +441,6 @@ def profile():
                     con.commit()
                     session["imgname"] = imgname
                 except:
-                    con.close()
                     return apology("Oh no! Something went wrong",400)
         elif bio:
             # Change bio only
@@ -203,18 +453,15 @@ def profile():
                                (session["user_id"], bio))
                     con.commit()
                 except:
-                    con.close()
                     return apology("Oh no! Something went wrong",400)
         else:
             # Change nothing
-            con.close()
             return redirect("/profile?message=Nothing changed")
-        con.close()
         return redirect("/profile?message=Succeeded!")
 
     # If request.method = "GET"
     else:
-        con = sqlite3.connect("static/users.db")
+        con = get_db("users")
         try:
             profile = con.execute("SELECT * FROM profiles WHERE user_id = ?", (session["user_id"],)).fetchone()
         except:
@@ -223,7 +470,6 @@ def profile():
             profile = con.execute("SELECT * FROM profiles WHERE user_id = ?", (session["user_id"],)).fetchone()
         username = con.execute("SELECT username FROM users WHERE id = ?", (session["user_id"],)).fetchone()
         message = request.args.get("message")
-        con.close()
         return render_template("profile.html", message=message, username=username[0], bio=profile[1], 
                                imgname=imgname)
 
@@ -256,7 +502,7 @@ def register():
             return apology("Username must be 3-12 characters long and contain only alphanumeric, underscores, or hyphens", 400)
         hash_pwd = generate_password_hash(pwd)
         
-        con = sqlite3.connect("static/users.db")
+        con = get_db("users")
         try:
             con.execute("INSERT INTO users (username, hash_pwd) VALUES (?, ?)", (username, hash_pwd))
             con.commit()
@@ -265,9 +511,7 @@ def register():
             con.execute("INSERT INTO profiles (user_id) VALUES (?)", (user_id[0],))
             con.commit()
         except:
-            con.close()
             return apology("Username already exists!", 400)
-        con.close()
         return render_template("/login.html", username=username)
     else:
         return render_template("/register.html")
@@ -307,16 +551,13 @@ def update():
         # Check if the user is allowed to update database
         if not "user_id" in session:
             return apology("You are not logged in", 400)
-        con = sqlite3.connect("static/users.db")
+        con = get_db("users", readonly=True)
         try:
             is_admin = con.execute("SELECT is_admin FROM users WHERE id = ?", (session["user_id"],)).fetchone()[0]
-            if not is_admin:
-                con.close()
-                return apology("Sorry, you are not administrator", 400)
         except:
-            con.close()
             return apology("Failed to connect to database", 400)
-        con.close()
+        if not is_admin:
+            return apology("Sorry, you are not administrator", 400)
         
         if force_update:
             print("Force update")
@@ -332,14 +573,51 @@ def update():
             date_start, date_end = swap(date_start, date_end)
         lats = np.linspace(lat_start, lat_end, n_lat)
         lons = np.linspace(lon_start, lon_end, n_lon)
-        is_successful = get_data_locations(lats=lats, lons=lons, date_start=date_start, date_end=date_end, 
-                           dbpath="static/weather_update.db", force_update_database=force_update)
-        if not is_successful:
+        # Plan the job and run it in the background, so the request returns immediately
+        try:
+            job_id = plan_job(get_db("update"), lats, lons, date_start, date_end, force_update=force_update)
+        except sqlite3.Error:
             return apology("Failed to update data", 400)
-        return redirect("/update?message=Succeeded!")
+        update_jobs.submit(run_job, job_id, dbpath=UPDATE_DB)
+        return redirect(f"/update?message=Update+started!&job={job_id}")
     else:
         message = request.args.get("message")
+        job_id = request.args.get("job", type=int)
         start = START + "-01"  # "1950-01-01"
         end = datetime.today().strftime("%Y-%m-%d")  # eg: "2024-12-25"
         return render_template("update.html", message=message, imgname=imgname, 
-                               start=start, end=end)
\ No newline at end of file
+                               start=start, end=end, job_id=job_id)
+
+
+@app.route("/update/jobs/<int:job_id>")
+@admin_required
+def update_job_status(job_id):
+    """Report the progress of an update job"""
+    if not os.path.isfile(UPDATE_DB):
+        return jsonify(error="Job not found"), 404
+    con = get_db("update", readonly=True)
+    try:
+        status = job_status(con, job_id)
+        if not status:
+            return jsonify(error="Job not found"), 404
+        progress = job_progress(con, job_id)
+        errors = [{"lat": lat, "lon": lon, "attempts": attempts, "error": error}
+                  for lat, lon, attempts, error in job_errors(con, job_id)]
+    except sqlite3.Error:
+        return jsonify(error="Failed to connect to database"), 500
+    return jsonify(job_id=job_id, status=status, completed=progress["done"] + progress["skipped"],
+                   failed=progress["failed"], remaining=progress["remaining"], total=progress["total"],
+                   eta=progress["eta"], errors=errors)
+
+
+@app.route("/update/jobs/<int:job_id>/cancel", methods=["POST"])
+@admin_required
+def update_job_cancel(job_id):
+    """Cancel an update job, the running job stops before its next request"""
+    if not os.path.isfile(UPDATE_DB):
+        return jsonify(error="Job not found"), 404
+    try:
+        cancelled = cancel_job(get_db("update"), job_id)
+    except sqlite3.Error:
+        return jsonify(error="Failed to connect to database"), 500
+    return jsonify(job_id=job_id, cancelled=cancelled)
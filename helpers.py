@@ -1,14 +1,24 @@
 # Some assistence functions are written by CS50 staff
 # https://cs50.harvard.edu/x/2024/psets/9/finance/
 import datetime
+import json
+import os
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import re
+import sqlite3
 
 from calendar import month_name
 from flask import redirect, render_template, request, session
 from functools import wraps
+from helpers_assets import plotly_url
+from helpers_cache import atomic_write
+from helpers_db import get_db
+from helpers_series import LEVELS, aggregate, downsample, to_columns
+
+# Points of the downsampled monthly series of the WebGL charts
+CHART_POINTS = 400
 
 def apology(message, code=400):
     """Render message as an apology to user."""
@@ -38,7 +48,24 @@ def apology(message, code=400):
 
 
 # ChatGPT helped me complete this part. https://chatgpt.com/
-def draw_chart(lat: float, lon: float, df: pd.DataFrame, filename=None):
+def draw_chart(lat: float, lon: float, df: pd.DataFrame, filename=None, shared_js=True, mode="classic"):
+    """
+    Draw the climate history of a location and save it as HTML in static/location_data.
+    mode "classic" draws one trace per calendar month; mode "webgl" draws light WebGL traces
+    with annual and decadal levels, see draw_chart_webgl().
+
+    Returns:
+        list: paths of the files written
+    """
+    # Link the shared plotly.js bundle instead of inlining it (several MB) in every chart,
+    # unless the chart has to work on its own
+    include_plotlyjs = plotly_url() if shared_js else True
+    path = f"static/location_data/{filename}" if filename else f"static/location_data/{lat}_{lon}.html"
+    if mode == "webgl":
+        return draw_chart_webgl(df, path, include_plotlyjs)
+    elif mode != "classic":
+        raise ValueError("Only 'classic' or 'webgl' are acceptable")
+
     fig = go.Figure()
     grouped = df.groupby(df.index.month)
     
@@ -94,11 +121,103 @@ def draw_chart(lat: float, lon: float, df: pd.DataFrame, filename=None):
         x=0
     ))
         
-    # Save as HTML
-    if filename:
-        fig.write_html(f"static/location_data/{filename}")
-    else:
-        fig.write_html(f"static/location_data/{lat}_{lon}.html")
+    def save(tmppath):
+        fig.write_html(tmppath, include_plotlyjs=include_plotlyjs)
+
+    # Save as HTML (atomically, so a half-written chart is never served)
+    atomic_write(path, save)
+    return [path]
+
+
+def draw_chart_webgl(df, path, include_plotlyjs, points=CHART_POINTS):
+    """
+    Draw the climate history of a location with one WebGL trace per type of data.
+    The levels "monthly", "annual" and "decadal" are computed here and switched with buttons.
+    The monthly series are downsampled to `points` points with LTTB; the full monthly data is written
+    next to the chart as JSON, and only loaded by the browser when the user zooms in.
+
+    Args:
+        df (DataFrame): monthly data indexed by dates
+        path (string): where to save the chart (.html), the full data goes to the same path in .json
+        include_plotlyjs: passed to plotly's write_html
+        points (int): number of points of the downsampled monthly series
+
+    Returns:
+        list: paths of the files written (chart and full data)
+    """
+    columns = ["temp_mean", "temp_max", "temp_min", "precip"]
+    names = {"temp_mean": "Mean Temperature (°C)", "temp_max": "Max Temperature (°C)",
+             "temp_min": "Min Temperature (°C)", "precip": "Precipitation per day (mm)"}
+    colors = {"temp_mean": "red", "temp_max": "orange", "temp_min": "purple", "precip": "blue"}
+    columns = [column for column in columns if column in df]
+
+    # {level: [(x, y) of each trace]}
+    levels = {}
+    for level in LEVELS:
+        if level == "monthly":
+            series = [downsample(df[column], points) for column in columns]
+        else:
+            aggregated = aggregate(df, level)
+            series = [aggregated[column].dropna() for column in columns]
+        levels[level] = [([date.strftime("%Y-%m-%d") for date in s.index], s.round(3).tolist()) for s in series]
+
+    fig = go.Figure()
+    for column, (x, y) in zip(columns, levels["monthly"]):
+        if column == "precip":
+            fig.add_trace(go.Scattergl(x=x, y=y, name=names[column], mode="lines", line=dict(color=colors[column], width=1, shape="hv"),
+                                       fill="tozeroy", opacity=0.5, yaxis="y2"))
+        else:
+            fig.add_trace(go.Scattergl(x=x, y=y, name=names[column], mode="lines", line=dict(color=colors[column], width=1)))
+    buttons = [dict(label=level.title(), method="restyle",
+                    args=[{"x": [x for x, y in levels[level]], "y": [y for x, y in levels[level]]}])
+               for level in LEVELS]
+    fig.update_layout(
+        xaxis_title="Date",
+        yaxis=dict(title=dict(text="Temperature (°C)", font=dict(color="red")), tickfont=dict(color="red")),
+        yaxis2=dict(title=dict(text="Precipitation per day (mm)", font=dict(color="blue")), tickfont=dict(color="blue"),
+                    overlaying="y", side="right"),
+        updatemenus=[dict(type="buttons", direction="right", buttons=buttons, active=0,
+                          x=1, xanchor="right", y=1.12, yanchor="bottom")],
+        legend=dict(orientation="h", yanchor="bottom", y=1.03, xanchor="left", x=0),
+        template="plotly_white",
+    )
+
+    data_path = os.path.splitext(path)[0] + ".json"
+    full = json.dumps({"columns": columns, **to_columns(df, columns)})
+    # When the user zooms in at the monthly level, show every month in the visible range
+    post_script = """
+        const chart = document.getElementById("{plot_id}");
+        const columns = %s;
+        let sampled = null, full = null;
+        chart.on("plotly_relayout", async event => {
+            if (chart.layout.updatemenus[0].active !== 0) return;
+            sampled = sampled || {x: chart.data.map(trace => trace.x), y: chart.data.map(trace => trace.y)};
+            if (event["xaxis.autorange"]) {
+                Plotly.restyle(chart, sampled);
+                return;
+            }
+            const start = event["xaxis.range[0]"], end = event["xaxis.range[1]"];
+            if (start === undefined) return;
+            full = full || await (await fetch(%s)).json();
+            // Dates compare as strings; keep one month on each side so the lines reach the edges
+            const first = Math.max(0, full.dates.findIndex(date => date >= start) - 1);
+            let last = full.dates.findIndex(date => date > end);
+            last = last === -1 ? full.dates.length : last + 1;
+            const x = full.dates.slice(first, last);
+            Plotly.restyle(chart, {x: columns.map(() => x), y: columns.map(column => full[column].slice(first, last))});
+        });
+    """ % (json.dumps(columns), json.dumps(os.path.basename(data_path)))
+
+    def save_chart(tmppath):
+        fig.write_html(tmppath, include_plotlyjs=include_plotlyjs, post_script=post_script)
+
+    def save_data(tmppath):
+        with open(tmppath, "w") as file:
+            file.write(full)
+
+    atomic_write(data_path, save_data)
+    atomic_write(path, save_chart)
+    return [path, data_path]
 
 
 def is_valid_month(month, start="1950-01", end="2023-12"):
@@ -137,5 +256,26 @@ def login_required(f):
     return decorated_function
 
 
+def admin_required(f):
+    """
+    Decorate routes to require an administrator.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get("user_id") is None:
+            return redirect("/login")
+        try:
+            is_admin = get_db("users", readonly=True).execute("SELECT is_admin FROM users WHERE id = ?",
+                                                              (session["user_id"],)).fetchone()
+        except sqlite3.Error:
+            return apology("Failed to connect to database", 400)
+        if not (is_admin and is_admin[0]):
+            return apology("Sorry, you are not administrator", 400)
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
 def swap(a, b):
     return b, a
\ No newline at end of file
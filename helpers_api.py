@@ -0,0 +1,147 @@
+import json
+import numpy as np
+import os
+
+from helpers_cache import atomic_write
+from helpers_cube import cube_month, is_source, load_cube
+from helpers_db import connect
+from helpers_maps import DATA_TYPES, SHAPE, fetch_grid
+from helpers_migrate import has_grid_keys
+
+# Arrow is optional: without pyarrow, grids are only served as .npy
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+API_DIR = "static/api"
+GRID_FORMATS = ["npy", "arrow"] if pyarrow else ["npy"]
+
+
+def grid_path(month, climate_type, format="npy"):
+    """Path of the grid of a month ("YYYY-MM") and a climate type, in a format of GRID_FORMATS"""
+    return f"{API_DIR}/grid/{month}_{climate_type}.{format}"
+
+
+def series_path(row, col):
+    """Path of the time series of a cell of the grid"""
+    return f"{API_DIR}/series/{row}_{col}.json"
+
+
+def read_grid(month, climate_type, dbpath="static/weather.db"):
+    """
+    Read one month of the grid as stored: from the cube if it has been built from dbpath, otherwise from the database.
+    Missing cells stay NaN (unlike fetch_data(), nothing is filled in).
+
+    Returns:
+        NDarray: float32 array of shape SHAPE, row 0 at latitude -90 and column 0 at longitude -180
+    """
+    grid = cube_month(month, climate_type, dbpath=dbpath)
+    if grid is not None and grid.shape == tuple(SHAPE):
+        return np.array(grid, dtype=np.float32)
+    lats, lons, grids, found = fetch_grid(SHAPE, month + "-01", [climate_type], dbpath=dbpath)
+    return grids[climate_type].astype(np.float32)
+
+
+def write_grid(month, climate_type, format="npy", path=None, dbpath="static/weather.db"):
+    """
+    Save the grid of a month as a NumPy .npy file, or as an Arrow IPC file with one row per cell
+    (columns "row", "col", "lat", "lon" and the climate type).
+
+    Returns:
+        string: path of the file
+    """
+    if format not in GRID_FORMATS:
+        raise ValueError(f"Invalid format: {format}")
+    grid = read_grid(month, climate_type, dbpath=dbpath)
+    path = path or grid_path(month, climate_type, format)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if format == "npy":
+        def save(tmppath):
+            with open(tmppath, "wb") as file:
+                np.save(file, grid)
+    else:
+        rows, cols = np.indices(grid.shape)
+        table = pyarrow.table({
+            "row": rows.ravel().astype(np.int16),
+            "col": cols.ravel().astype(np.int16),
+            "lat": np.linspace(-90, 90, SHAPE[0])[rows.ravel()].astype(np.float32),
+            "lon": np.linspace(-180, 180, SHAPE[1])[cols.ravel()].astype(np.float32),
+            climate_type: pyarrow.array(grid.ravel(), from_pandas=True),
+        })
+
+        def save(tmppath):
+            with pyarrow.OSFile(tmppath, "wb") as sink, pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    atomic_write(path, save)
+    return path
+
+
+def read_series(row, col, start="1950-01", end="2023-12", dbpath="static/weather.db"):
+    """
+    Read the time series of one cell of the grid, one value per month from start to end:
+    from the cube if it has been built from dbpath, otherwise with one query on the database.
+
+    Returns:
+        dict: {climate_type: list of values, None where there is no data}
+    """
+    nmonths = (int(end[:4]) - int(start[:4])) * 12 + int(end[5:7]) - int(start[5:7]) + 1
+    values = np.full((nmonths, len(DATA_TYPES)), np.nan)
+    cube, meta = load_cube()
+    if cube is not None and set(DATA_TYPES) <= set(meta["data_types"]) and cube.shape[1:3] == tuple(SHAPE) \
+            and is_source(meta, dbpath):
+        # Months of the cube which overlap the requested ones
+        first = (int(start[:4]) - int(meta["start"][:4])) * 12 + int(start[5:7]) - int(meta["start"][5:7])
+        begin, stop = max(0, first), min(cube.shape[0], first + nmonths)
+        if begin < stop:
+            types = [meta["data_types"].index(climate_type) for climate_type in DATA_TYPES]
+            values[begin - first:stop - first] = cube[begin:stop, row, col][:, types]
+    else:
+        con = connect(dbpath, readonly=True)
+        try:
+            if has_grid_keys(con):
+                where, params = "l.row = ? AND l.col = ?", (row, col)
+            else:
+                where, params = "l.lat = ? AND l.lon = ?", (-90 + row * 180 / (SHAPE[0] - 1), -180 + col * 360 / (SHAPE[1] - 1))
+            rows = con.execute(f"""SELECT d.dates, {', '.join('d.' + climate_type for climate_type in DATA_TYPES)}
+                                   FROM data AS d JOIN locations AS l ON l.loc_id = d.loc_id
+                                   WHERE {where}""", params).fetchall()
+        finally:
+            con.close()
+        for dates, *cells in rows:
+            i = (int(dates[:4]) - int(start[:4])) * 12 + int(dates[5:7]) - int(start[5:7])
+            if 0 <= i < nmonths:
+                values[i] = [np.nan if cell is None else cell for cell in cells]
+    values = np.round(values, 3)
+    return {climate_type: [None if value != value else value for value in values[:, k].tolist()]
+            for k, climate_type in enumerate(DATA_TYPES)}
+
+
+def write_series(row, col, start="1950-01", end="2023-12", path=None, dbpath="static/weather.db"):
+    """
+    Save the time series of a cell as compact columnar JSON:
+    {"row", "col", "lat", "lon", "start", "end", "step": "month", climate_type: [one value per month]}
+
+    Returns:
+        string: path of the file
+    """
+    data = {
+        "row": row,
+        "col": col,
+        "lat": -90 + row * 180 / (SHAPE[0] - 1),
+        "lon": -180 + col * 360 / (SHAPE[1] - 1),
+        "start": start,
+        "end": end,
+        "step": "month",
+        **read_series(row, col, start, end, dbpath=dbpath),
+    }
+    path = path or series_path(row, col)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def save(tmppath):
+        with open(tmppath, "w") as file:
+            json.dump(data, file, separators=(",", ":"))
+    atomic_write(path, save)
+    return path
@@ -0,0 +1,110 @@
+import folium
+import os
+import re
+import sys
+import urllib.request
+
+from helpers_cache import atomic_write, write_sidecars
+from plotly import __version__ as PLOTLY_VERSION
+from urllib.parse import urlparse
+
+
+# Local copies of the JS/CSS libraries, shared by every chart and map, so the browser caches them once.
+# The file names keep the versions, so a new version never reuses the cache of an old one.
+VENDOR_DIR = "static/vendor"
+VENDOR_URL = "/static/vendor"
+
+
+def vendored_name(url):
+    """File name of the local copy of a library, eg: "npm_leaflet@1.9.3_dist_leaflet.js" """
+    return re.sub(r"[^A-Za-z0-9@._-]", "_", urlparse(url).path.strip("/"))
+
+
+def asset_url(url, vendor_dir=VENDOR_DIR):
+    """URL of the local copy of a library if it has been vendored, otherwise the original URL"""
+    name = vendored_name(url)
+    if os.path.isfile(os.path.join(vendor_dir, name)):
+        return f"{VENDOR_URL}/{name}"
+    return url
+
+
+def plotly_url(vendor_dir=VENDOR_DIR):
+    """
+    URL of the plotly.js bundle of the installed plotly package, written under static/ the first time.
+
+    Returns:
+        string: eg: "/static/vendor/plotly-5.24.1.min.js"
+    """
+    name = f"plotly-{PLOTLY_VERSION}.min.js"
+    path = os.path.join(vendor_dir, name)
+    if not os.path.isfile(path):
+        from plotly.offline import get_plotlyjs
+        os.makedirs(vendor_dir, exist_ok=True)
+
+        def save(tmppath):
+            with open(tmppath, "w", encoding="utf-8") as file:
+                file.write(get_plotlyjs())
+        atomic_write(path, save)
+        write_sidecars(path)
+    return f"{VENDOR_URL}/{name}"
+
+
+def folium_assets():
+    """URLs of the JS/CSS libraries folium links in the maps"""
+    return [url for name, url in folium.Map.default_js + folium.Map.default_css]
+
+
+def vendor_assets(urls=None, vendor_dir=VENDOR_DIR, timeout=30):
+    """
+    Download local copies of libraries. Style sheets which load other files by relative URL
+    (fonts, images) are left on their CDN, since their copies would miss those files.
+
+    Args:
+        urls (list): URLs of the libraries (None: the ones of folium_assets())
+        vendor_dir (string): where to save the copies
+        timeout (float): timeout of each download in seconds
+
+    Returns:
+        dict: {url: local URL, or None if it has been left on its CDN}
+    """
+    urls = urls or folium_assets()
+    os.makedirs(vendor_dir, exist_ok=True)
+    vendored = {}
+    for url in urls:
+        path = os.path.join(vendor_dir, vendored_name(url))
+        if os.path.isfile(path):
+            vendored[url] = asset_url(url, vendor_dir)
+            continue
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                content = response.read()
+        except OSError as e:
+            print(f"Cannot download {url}: {e}")
+            vendored[url] = None
+            continue
+        if url.endswith(".css") and re.search(rb"url\((?![\"']?(data:|https?:))", content):
+            print(f"Left on its CDN (loads files by relative URL): {url}")
+            vendored[url] = None
+            continue
+
+        def save(tmppath):
+            with open(tmppath, "wb") as file:
+                file.write(content)
+        atomic_write(path, save)
+        write_sidecars(path)
+        vendored[url] = asset_url(url, vendor_dir)
+        print(f"Vendored {url} ({len(content)} bytes)")
+    return vendored
+
+
+def use_local_assets(map):
+    """Make a folium map link the local copies of its libraries (the ones which have been vendored)"""
+    map.default_js = [(name, asset_url(url)) for name, url in map.default_js]
+    map.default_css = [(name, asset_url(url)) for name, url in map.default_css]
+    return map
+
+
+if __name__ == "__main__":
+    # Usage: python helpers_assets.py [url ...]
+    plotly_url()
+    vendor_assets(sys.argv[1:] or None)
@@ -0,0 +1,356 @@
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+# File locks work across processes (gunicorn workers) but only exist on Unix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Brotli is optional: without it, only the gzip copies are written
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# The state of the app is kept in its instance folder, out of static/ which is served to anyone
+CACHE_DB = "instance/render_cache.db"
+LOCK_DIR = "instance/locks"
+# The builds of the shared data (baselines, index of the periods) run inside renders, under the lock of the
+# rendered key: their locks are separate files, so they can never be the stripe the process already holds
+BUILD_LOCK_DIR = "instance/locks/build"
+# Keys are spread over a fixed number of lock files, so the lock files don't pile up
+LOCK_STRIPES = 256
+# Precompressed copies written next to the rendered files, {Content-Encoding: suffix}, preferred first
+SIDECARS = {"br": ".br", "gzip": ".gz"}
+COMPRESSIBLE = (".html", ".json", ".js", ".css", ".bin", ".npy")
+# Smaller files are not worth the extra files
+MIN_COMPRESS_SIZE = 1024
+# Files written next to a rendered file under the same name (eg: the full data of a WebGL chart),
+# which belong to its entry: they are counted, compressed and evicted with it
+COMPANIONS = (".json",)
+
+
+@contextmanager
+def render_lock(key, lock_dir=LOCK_DIR, blocking=True):
+    """
+    Exclusive lock on a key, shared by all threads and processes.
+    Without fcntl (Windows), only the threads of this process are coordinated.
+
+    Args:
+        key (string): what is locked, eg: the key of a cached file
+        lock_dir (string): where the lock files are
+        blocking (bool): False: don't wait if the lock is taken
+
+    Yields:
+        bool: True if the lock is held, False if it was taken and blocking is False
+    """
+    stripe = int(hashlib.sha1(key.encode()).hexdigest(), 16) % LOCK_STRIPES
+    if fcntl is None:
+        with _thread_locks_guard:
+            lock = THREAD_LOCKS.setdefault(lock_dir, [threading.Lock() for i in range(LOCK_STRIPES)])[stripe]
+        if not lock.acquire(blocking=blocking):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            lock.release()
+        return
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"{stripe}.lock"), "w") as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+# Stripes of the thread locks, by lock_dir
+THREAD_LOCKS = {}
+_thread_locks_guard = threading.Lock()
+
+
+def build_lock(name):
+    """Exclusive lock on the build of shared data, eg: "climatology/1951-1980", which may be taken under a render_lock()"""
+    return render_lock(name, lock_dir=BUILD_LOCK_DIR)
+
+
+def atomic_write(path, save):
+    """
+    Write a file atomically: save(tmppath) writes a temporary file next to path, which is then renamed
+    into place, so readers see either the old file or the whole new one, never a half-written file.
+
+    Args:
+        path (string): where the file is published
+        save (function): save(tmppath), for example folium.Map.save or plotly's Figure.write_html
+    """
+    tmppath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        save(tmppath)
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def sidecar_path(path, encoding):
+    """Path of the precompressed copy of a file, eg: "static/weather_data/1950-01_temp_mean.html.br" """
+    return path + SIDECARS[encoding]
+
+
+def is_fresh(sidecar, path):
+    """Whether a precompressed copy exists and is at least as recent as its file"""
+    try:
+        return os.path.getmtime(sidecar) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def write_sidecars(path):
+    """
+    Write the gzip and brotli copies of a rendered text file next to it (".gz", ".br"), so the server sends them
+    without compressing anything per request. Copies which are already up to date are kept.
+    The output is deterministic (no timestamp in the gzip header), so the ETag of a copy only changes with its file.
+
+    Returns:
+        list: paths of the copies written
+    """
+    if not path.endswith(COMPRESSIBLE) or not os.path.isfile(path) or os.path.getsize(path) < MIN_COMPRESS_SIZE:
+        return []
+    compressors = {"gzip": lambda data: gzip.compress(data, 9, mtime=0)}
+    if brotli:
+        compressors["br"] = lambda data: brotli.compress(data, quality=11)
+    written = []
+    data = None
+    for encoding, compress in compressors.items():
+        sidecar = sidecar_path(path, encoding)
+        if is_fresh(sidecar, path):
+            continue
+        if data is None:
+            with open(path, "rb") as file:
+                data = file.read()
+        compressed = compress(data)
+
+        def save(tmppath):
+            with open(tmppath, "wb") as file:
+                file.write(compressed)
+        atomic_write(sidecar, save)
+        written.append(sidecar)
+    return written
+
+
+class RenderCache:
+    """
+    Index of the rendered files under static/ (maps in weather_data, charts in location_data).
+    Each entry records its size, last access and hit count. When the files use more than
+    the disk budget, the least recently used ("lru") or least frequently used ("lfu") ones are deleted.
+    The index is stored in SQLite, so it is shared by all the workers.
+    """
+
+    def __init__(self, root="static", dbpath=CACHE_DB, budget=1024**3, policy="lru"):
+        if policy not in ("lru", "lfu"):
+            raise ValueError("Only 'lru' or 'lfu' are acceptable")
+        self.root = root
+        self.dbpath = dbpath
+        self.budget = budget
+        self.policy = policy
+        os.makedirs(os.path.dirname(dbpath) or ".", exist_ok=True)
+        con = self.connect()
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access);
+            CREATE INDEX IF NOT EXISTS entries_lfu ON entries (hits, last_access);
+            CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY NOT NULL,
+                value INTEGER NOT NULL DEFAULT 0
+            );
+            INSERT OR IGNORE INTO stats (name, value) VALUES ('hits', 0), ('misses', 0), ('evictions', 0);
+        """)
+        # The full data of the charts used to be indexed as entries of their own
+        con.execute("""DELETE FROM entries WHERE key LIKE 'location_data/%.json'
+                       AND substr(key, 1, length(key) - 5) || '.html' IN (SELECT key FROM entries)""")
+        con.commit()
+        con.close()
+
+    def connect(self):
+        return sqlite3.connect(self.dbpath, timeout=30)
+
+    def path(self, key):
+        """Path of the file of an entry, key is relative to root, eg: "weather_data/1950-01_temp_mean.html" """
+        return os.path.join(self.root, key)
+
+    def lookup(self, key, stale_before=None):
+        """
+        Check whether a rendered file is cached, and record the hit or the miss.
+        Files rendered before the index existed are added to it on their first hit.
+        A stale file (see is_stale()) is a miss, since it has to be rendered again.
+
+        Returns:
+            bool: True if the file exists and is not stale
+        """
+        now = time.time()
+        con = self.connect()
+        try:
+            exists = os.path.isfile(self.path(key))
+            if exists and not self.is_stale(key, stale_before):
+                cur = con.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+                if cur.rowcount == 0:
+                    con.execute("INSERT OR IGNORE INTO entries (key, size, created, last_access, hits) VALUES (?, ?, ?, ?, 1)",
+                                (key, self.size(key), now, now))
+                con.execute("UPDATE stats SET value = value + 1 WHERE name = 'hits'")
+                con.commit()
+                return True
+            if not exists:
+                # The file has been deleted behind our back: forget it
+                con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            con.execute("UPDATE stats SET value = value + 1 WHERE name = 'misses'")
+            con.commit()
+            return False
+        finally:
+            con.close()
+
+    def get_or_render(self, key, render, stale_before=None):
+        """
+        Make sure a file is cached, rendering it if needed. Concurrent requests for the same key
+        are coalesced across processes: one caller renders while the others wait for it.
+
+        Args:
+            key (string): path of the file relative to root
+            render (function): render() writes the file (atomically, see atomic_write())
+            stale_before (float): a file older than this timestamp is rendered again (None: never)
+
+        Returns:
+            bool: True if this call rendered the file, False if it was already cached,
+                  None if render() wrote no file (nothing is stored then)
+        """
+        if self.lookup(key, stale_before):
+            return False
+        with render_lock(key):
+            # Another request may have rendered it while we were waiting for the lock
+            if os.path.isfile(self.path(key)) and not self.is_stale(key, stale_before):
+                return False
+            render()
+            if not os.path.isfile(self.path(key)):
+                return None
+            self.store(key)
+        return True
+
+    def is_stale(self, key, stale_before):
+        """Whether the file of an entry is older than stale_before (a timestamp, or None)"""
+        if stale_before is None:
+            return False
+        try:
+            return os.path.getmtime(self.path(key)) < stale_before
+        except OSError:
+            return True
+
+    def files(self, key):
+        """Paths of the file of an entry and of its companions (see COMPANIONS), without their precompressed copies"""
+        path = self.path(key)
+        base, ext = os.path.splitext(path)
+        return [path] + [base + suffix for suffix in COMPANIONS if suffix != ext]
+
+    def size(self, key):
+        """Size on disk of an entry, with its companions and their precompressed copies"""
+        size = 0
+        for path in self.files(key) + [sidecar_path(path, encoding) for path in self.files(key) for encoding in SIDECARS]:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def store(self, key):
+        """
+        Add a newly rendered file to the index with its companions and their precompressed copies
+        (see write_sidecars()), then evict other entries to fit in the budget
+        """
+        for path in self.files(key):
+            write_sidecars(path)
+        now = time.time()
+        con = self.connect()
+        try:
+            con.execute("""INSERT INTO entries (key, size, created, last_access, hits) VALUES (?, ?, ?, ?, 0)
+                           ON CONFLICT (key) DO UPDATE SET size = excluded.size, created = excluded.created,
+                           last_access = excluded.last_access""",
+                        (key, self.size(key), now, now))
+            con.commit()
+            self.evict(con, keep=key)
+        finally:
+            con.close()
+
+    def evict(self, con, keep=None):
+        """
+        Delete entries (least recently or least frequently used first) until they fit in the budget.
+        Entries being rendered or sent are locked, so they are skipped rather than waited for:
+        this also runs under the lock of the key just stored, whose stripe other keys may share.
+        """
+        total = con.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.budget:
+            return
+        order = "last_access" if self.policy == "lru" else "hits, last_access"
+        evicted = 0
+        for key, size in con.execute(f"SELECT key, size FROM entries ORDER BY {order}").fetchall():
+            if total <= self.budget:
+                break
+            if key == keep or not self.remove(key, blocking=False):
+                continue
+            con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        con.execute("UPDATE stats SET value = value + ? WHERE name = 'evictions'", (evicted,))
+        con.commit()
+
+    def remove(self, key, blocking=True):
+        """
+        Delete the file of an entry, its companions and their precompressed copies, under the lock of the key
+        so that a file is never deleted while it is rendered or opened to be sent.
+
+        Returns:
+            bool: True if the files have been deleted, False if the key was locked and blocking is False
+        """
+        with render_lock(key, blocking=blocking) as locked:
+            if not locked:
+                return False
+            for path in self.files(key) + [sidecar_path(path, encoding) for path in self.files(key) for encoding in SIDECARS]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return True
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, evictions, hit_rate, entries, bytes and budget
+        """
+        con = self.connect()
+        try:
+            stats = dict(con.execute("SELECT name, value FROM stats").fetchall())
+            stats["entries"], stats["bytes"] = con.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        finally:
+            con.close()
+        requests = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / requests, 4) if requests else None
+        stats["budget"] = self.budget
+        stats["policy"] = self.policy
+        return stats
@@ -0,0 +1,213 @@
+import argparse
+import numpy as np
+import os
+import sqlite3
+import time
+
+from helpers_cache import build_lock
+from helpers_cube import is_source, load_cube
+from helpers_db import WEATHER_DB, connect
+
+
+# The reference period of the anomalies, as in the WMO normals before 1991
+BASELINE_START = 1951
+BASELINE_END = 1980
+SHAPE = (91, 91)
+# Where the baselines are stored, in the instance folder of the app
+CLIMATOLOGY_DIR = "instance"
+DATA_TYPES = ["temp_mean", "temp_max", "temp_min", "precip"]
+
+# Baselines loaded from the database, by (dbpath, name): (built, NDarray of shape (12, nlats, nlons, types))
+_baselines = {}
+
+
+def climatology_path(dbpath=WEATHER_DB):
+    """
+    Path of the database holding the baselines computed from a weather database, eg: "instance/weather_climatology.db".
+    They are kept out of the weather database, whose modification time tells when the data changed (see source_mtime()).
+    """
+    return os.path.join(CLIMATOLOGY_DIR, os.path.splitext(os.path.basename(dbpath))[0] + "_climatology.db")
+
+
+def baseline_name(start_year=BASELINE_START, end_year=BASELINE_END):
+    """Name of a baseline, eg: "1951-1980" """
+    return f"{start_year}-{end_year}"
+
+
+def compute_baselines(start_year=BASELINE_START, end_year=BASELINE_END, dbpath=WEATHER_DB):
+    """
+    Mean of each cell for each calendar month over a period of years, ignoring the missing months.
+    With the cube, it is one vectorized reduction: the months are reshaped to (years, 12, ...) and averaged
+    over the years. Without it (or if it was built from another database), the database averages them
+    (AVG ignores NULL, like nanmean); the locations off the grid are left out, as in helpers_maps.fetch_grid().
+
+    Returns:
+        NDarray: float32 array of shape (12, nlats, nlons, len(DATA_TYPES)), NaN where a cell has no data
+    """
+    cube, meta = load_cube()
+    if cube is not None and is_source(meta, dbpath) and set(DATA_TYPES) <= set(meta["data_types"]) \
+            and list(SHAPE) == meta["shape"][1:3]:
+        first = (start_year - int(meta["start"][:4])) * 12 - int(meta["start"][5:7]) + 1
+        last = (end_year - int(meta["start"][:4])) * 12 - int(meta["start"][5:7]) + 13
+        if first >= 0 and last <= cube.shape[0]:
+            types = [meta["data_types"].index(climate_type) for climate_type in DATA_TYPES]
+            months = cube[first:last][..., types].reshape((end_year - start_year + 1, 12) + tuple(SHAPE) + (len(types),))
+            # Cells without data in any year stay NaN, without the "mean of empty slice" warnings
+            counts = np.sum(~np.isnan(months), axis=0)
+            sums = np.nansum(months, axis=0, dtype=np.float64)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return np.where(counts > 0, sums / counts, np.nan).astype(np.float32)
+        print(f"The cube doesn't cover {start_year}-{end_year}, averaging in the database")
+
+    baselines = np.full((12,) + tuple(SHAPE) + (len(DATA_TYPES),), np.nan, dtype=np.float32)
+    con = connect(dbpath, readonly=True)
+    try:
+        rows = con.execute(f"""
+            SELECT l.lat, l.lon, CAST(SUBSTR(d.dates, 6, 2) AS INTEGER),
+                   {', '.join(f'AVG(d.{climate_type})' for climate_type in DATA_TYPES)}
+            FROM data AS d JOIN locations AS l ON l.loc_id = d.loc_id
+            WHERE d.dates >= ? AND d.dates < ?
+            GROUP BY d.loc_id, SUBSTR(d.dates, 6, 2)""", (f"{start_year}-01-01", f"{end_year + 1}-01-01")).fetchall()
+    finally:
+        con.close()
+    if not rows:
+        return baselines
+    values = np.array(rows, dtype=float)
+    i = np.rint((values[:, 0] + 90) / 180 * (SHAPE[0] - 1)).astype(int)
+    j = np.rint((values[:, 1] + 180) / 360 * (SHAPE[1] - 1)).astype(int)
+    on_grid = (i >= 0) & (i < SHAPE[0]) & (j >= 0) & (j < SHAPE[1])
+    i, j, values = i[on_grid], j[on_grid], values[on_grid]
+    # Locations between the cells (eg: from "/locations") would overwrite the cell they round to
+    lats = np.linspace(-90, 90, SHAPE[0])
+    lons = np.linspace(-180, 180, SHAPE[1])
+    on_grid = np.isclose(lats[i], values[:, 0]) & np.isclose(lons[j], values[:, 1])
+    baselines[values[on_grid, 2].astype(int) - 1, i[on_grid], j[on_grid]] = values[on_grid, 3:]
+    return baselines
+
+
+def build_baselines(start_year=BASELINE_START, end_year=BASELINE_END, dbpath=WEATHER_DB):
+    """
+    Compute the baselines of a period from the weather database at dbpath and materialize them in the table
+    "climatology" of its own database (see climatology_path()), one row per (baseline, calendar month, cell).
+    The table "baselines" records when each one was built.
+
+    Returns:
+        string: name of the baseline, eg: "1951-1980"
+    """
+    start = time.time()
+    baselines = compute_baselines(start_year, end_year, dbpath)
+    name = baseline_name(start_year, end_year)
+    months, rows, cols = np.indices(baselines.shape[:3]).reshape(3, -1)
+    values = baselines.reshape(-1, len(DATA_TYPES)).astype(float)
+    # NaN is stored as NULL
+    records = [(name, int(month) + 1, int(row), int(col), *[None if value != value else value for value in cells])
+               for month, row, col, cells in zip(months, rows, cols, values.tolist())]
+    os.makedirs(CLIMATOLOGY_DIR, exist_ok=True)
+    con = connect(climatology_path(dbpath))
+    try:
+        con.executescript(f"""
+            CREATE TABLE IF NOT EXISTS baselines (
+                name TEXT PRIMARY KEY NOT NULL,
+                start_year INTEGER NOT NULL,
+                end_year INTEGER NOT NULL,
+                built REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS climatology (
+                baseline TEXT NOT NULL,
+                month INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                col INTEGER NOT NULL,
+                {', '.join(f'{climate_type} REAL' for climate_type in DATA_TYPES)},
+                PRIMARY KEY (baseline, month, row, col)
+            ) WITHOUT ROWID;
+        """)
+        with con:
+            con.execute("DELETE FROM climatology WHERE baseline = ?", (name,))
+            con.executemany(f"INSERT INTO climatology VALUES (?, ?, ?, ?, {', '.join('?' for climate_type in DATA_TYPES)})",
+                            records)
+            con.execute("INSERT OR REPLACE INTO baselines (name, start_year, end_year, built) VALUES (?, ?, ?, ?)",
+                        (name, start_year, end_year, time.time()))
+    finally:
+        con.close()
+    _baselines.pop((dbpath, name), None)
+    print(f"Built baseline {name}: {np.isfinite(baselines[..., 0]).sum()} cell-months in {time.time() - start:.1f} s")
+    return name
+
+
+def baselines_mtime(name=None, dbpath=WEATHER_DB):
+    """When the baselines of a period were last built (the anomalies drawn before are stale), None if they have not been"""
+    name = name or baseline_name()
+    try:
+        con = connect(climatology_path(dbpath), readonly=True)
+        try:
+            built = con.execute("SELECT built FROM baselines WHERE name = ?", (name,)).fetchone()
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return None
+    return built[0] if built else None
+
+
+def load_baselines(name=None, dbpath=WEATHER_DB):
+    """
+    The baselines of a period computed from the weather database at dbpath, read from the table "climatology"
+    once per process and again only if they are rebuilt. They are built first if they don't exist yet.
+
+    Returns:
+        NDarray: read-only float32 array of shape (12, nlats, nlons, len(DATA_TYPES))
+    """
+    name = name or baseline_name()
+    built = baselines_mtime(name, dbpath)
+    if built is None:
+        # Built once, even if several workers need it at the same time
+        with build_lock(f"climatology/{name}"):
+            start_year, end_year = (int(year) for year in name.split("-"))
+            os.makedirs(CLIMATOLOGY_DIR, exist_ok=True)
+            con = connect(climatology_path(dbpath))
+            try:
+                exists = con.execute("SELECT 1 FROM sqlite_master WHERE name = 'baselines'").fetchone() and \
+                    con.execute("SELECT 1 FROM baselines WHERE name = ?", (name,)).fetchone()
+            finally:
+                con.close()
+            if not exists:
+                build_baselines(start_year, end_year, dbpath)
+        return load_baselines(name, dbpath)
+    cached = _baselines.get((dbpath, name))
+    if cached is None or cached[0] != built:
+        con = connect(climatology_path(dbpath), readonly=True)
+        try:
+            rows = con.execute(f"""SELECT month, row, col, {', '.join(DATA_TYPES)} FROM climatology
+                                   WHERE baseline = ?""", (name,)).fetchall()
+        finally:
+            con.close()
+        baselines = np.full((12,) + tuple(SHAPE) + (len(DATA_TYPES),), np.nan, dtype=np.float32)
+        values = np.array(rows, dtype=float)
+        baselines[values[:, 0].astype(int) - 1, values[:, 1].astype(int), values[:, 2].astype(int)] = values[:, 3:]
+        baselines.flags.writeable = False
+        cached = _baselines[(dbpath, name)] = (built, baselines)
+    return cached[1]
+
+
+def baseline_grid(month, climate_type, name=None, dbpath=WEATHER_DB):
+    """
+    The baseline of a calendar month for a climate type.
+
+    Args:
+        month (string): "YYYY-MM", or "MM"
+        climate_type (string): "temp_mean", "temp_max", "temp_min" or "precip"
+        name (string): name of the baseline (None: 1951-1980)
+
+    Returns:
+        NDarray: read-only view of shape (nlats, nlons), row 0 at latitude -90
+    """
+    return load_baselines(name, dbpath)[int(month[-2:]) - 1, :, :, DATA_TYPES.index(climate_type)]
+
+
+if __name__ == "__main__":
+    # Usage: python helpers_climatology.py [--start 1951] [--end 1980] [--db static/weather.db]
+    parser = argparse.ArgumentParser(description="Build the climatology baselines of the anomaly maps")
+    parser.add_argument("--start", type=int, default=BASELINE_START, help="first year of the baseline")
+    parser.add_argument("--end", type=int, default=BASELINE_END, help="last year of the baseline")
+    parser.add_argument("--db", default=WEATHER_DB, help="path of the weather database")
+    args = parser.parse_args()
+    build_baselines(args.start, args.end, args.db)
@@ -0,0 +1,133 @@
+import numpy as np
+import sys
+import time
+
+from helpers_raster import NCOLORS, TRANSPARENT, quantize
+
+
+# Anchors of the colour maps, evenly spaced from the bottom to the top of the scale.
+# "coolwarm" is Kenneth Moreland's diverging map (https://www.kennethmoreland.com/color-maps/) at 33 points,
+# "Blues" is the 9-class sequential scheme of ColorBrewer (https://colorbrewer2.org), "BrBG" its 11-class diverging one.
+# They are the same anchors as matplotlib's colour maps of the same names.
+COLOR_MAPS = {
+    "coolwarm": [
+        "3b4cc0", "445acc", "4d68d7", "5775e1", "6282ea", "6c8ef1", "779af7", "82a5fb", "8db0fe", "98b9ff", "a3c2ff",
+        "aec9fd", "b8d0f9", "c2d5f4", "ccd9ee", "d5dbe6", "dddddd", "e5d8d1", "ecd3c5", "f1ccb9", "f5c4ad", "f7bba0",
+        "f7b194", "f7a687", "f49a7b", "f18d6f", "ec7f63", "e57058", "de604d", "d55042", "cb3e38", "c0282f", "b40426",
+    ],
+    "Blues": ["f7fbff", "deebf7", "c6dbef", "9ecae1", "6baed6", "4292c6", "2171b5", "08519c", "08306b"],
+    "BrBG": ["543005", "8c510a", "bf812d", "dfc27d", "f6e8c3", "f5f5f5", "c7eae5", "80cdc1", "35978f", "01665e", "003c30"],
+}
+
+# Lookup tables are computed once per process
+_luts = {}
+
+
+def lut(name, ncolors=NCOLORS):
+    """
+    Lookup table of a colour map: the anchors interpolated linearly to ncolors colours.
+
+    Args:
+        name (string): "coolwarm", "Blues" or "BrBG"
+        ncolors (int): number of colours
+
+    Returns:
+        NDarray: read-only uint8 array of shape (ncolors, 3)
+    """
+    if (name, ncolors) not in _luts:
+        if name not in COLOR_MAPS:
+            raise ValueError(f"Unknown colour map: {name}")
+        anchors = np.array([[int(color[k:k + 2], 16) for k in (0, 2, 4)] for color in COLOR_MAPS[name]], dtype=float)
+        x = np.linspace(0, 1, len(anchors))
+        positions = np.linspace(0, 1, ncolors)
+        table = np.stack([np.interp(positions, x, anchors[:, k]) for k in range(3)], axis=1)
+        table = np.rint(table).astype(np.uint8)
+        table.flags.writeable = False
+        _luts[(name, ncolors)] = table
+    return _luts[(name, ncolors)]
+
+
+def rgba_lut(name):
+    """
+    Lookup table from palette indices to RGBA: the colour map, then fully transparent
+    black at the TRANSPARENT index (missing values).
+
+    Returns:
+        NDarray: read-only uint8 array of shape (TRANSPARENT + 1, 4)
+    """
+    if (name, "rgba") not in _luts:
+        table = np.zeros((TRANSPARENT + 1, 4), dtype=np.uint8)
+        table[:NCOLORS, :3] = lut(name)
+        table[:NCOLORS, 3] = 255
+        table.flags.writeable = False
+        _luts[(name, "rgba")] = table
+    return _luts[(name, "rgba")]
+
+
+def colorize(data, name, vmin, vmax, out=None):
+    """
+    Colour a grid with a colour map, without matplotlib: the values are quantized to palette indices
+    (clipped to the scale, NaN transparent) and looked up in a uint8 table.
+
+    Args:
+        data (NDarray): values, of shape (height, width)
+        name (string): "coolwarm", "Blues" or "BrBG"
+        vmin (float): bottom of the scale
+        vmax (float): top of the scale
+        out (NDarray): uint8 array of shape (height, width, 4) to write into (None: a new one)
+
+    Returns:
+        NDarray: uint8 RGBA array of shape (height, width, 4)
+    """
+    indices = quantize(data, vmin, vmax)
+    if out is None:
+        out = np.empty(indices.shape + (4,), dtype=np.uint8)
+    return np.take(rgba_lut(name), indices, axis=0, out=out)
+
+
+def css_color(name, position, opacity=1):
+    """CSS rgba() colour at a position (0 to 1) of a colour map"""
+    r, g, b = lut(name)[int(round(position * (NCOLORS - 1)))]
+    return f"rgba({r}, {g}, {b}, {opacity})"
+
+
+def benchmark(shape=(91, 455), repeat=200):
+    """
+    Compare the matplotlib path (Normalize, then the colour map to float64 RGBA)
+    with the lookup table path, on a grid of the size of the tiled maps.
+
+    Returns:
+        dict: {path: milliseconds per grid}
+    """
+    from matplotlib import colormaps
+    from matplotlib.colors import Normalize
+
+    rng = np.random.default_rng(0)
+    data = rng.uniform(-30, 50, shape)
+    data[rng.random(shape) < 0.01] = np.nan
+    out = np.empty(shape + (4,), dtype=np.uint8)
+    paths = {
+        "matplotlib": lambda: colormaps["coolwarm"](Normalize(vmin=-20, vmax=40)(data)),
+        "lut": lambda: colorize(data, "coolwarm", -20, 40),
+        "lut (out buffer)": lambda: colorize(data, "coolwarm", -20, 40, out=out),
+        "indices only": lambda: quantize(data, -20, 40),
+    }
+    results = {}
+    for name, function in paths.items():
+        function()
+        start = time.perf_counter()
+        for i in range(repeat):
+            function()
+        results[name] = (time.perf_counter() - start) / repeat * 1000
+        print(f"{name:>18}: {results[name]:.3f} ms per {shape[0]}x{shape[1]} grid")
+
+    # The two paths should give the same colours, up to rounding
+    reference = np.rint(colormaps["coolwarm"](Normalize(vmin=-20, vmax=40)(data))[..., :3] * 255)
+    difference = np.abs(reference - colorize(data, "coolwarm", -20, 40)[..., :3])[~np.isnan(data)]
+    print(f"Largest difference with matplotlib: {difference.max():.0f} / 255")
+    return results
+
+
+if __name__ == "__main__":
+    # Usage: python helpers_colors.py [repeat]
+    benchmark(repeat=int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,229 @@
+import json
+import numpy as np
+import os
+import sqlite3
+import sys
+
+from datetime import datetime
+from helpers_cache import atomic_write
+
+
+CUBE_PATH = "static/weather_cube.npy"
+META_PATH = "static/weather_cube.json"
+
+# Cache of the opened cube, so each process maps the file only once
+# and all gunicorn workers share the same pages of the OS page cache
+_cube = {"mtime": None, "cube": None, "meta": None, "enabled": True}
+
+
+def build_cube(dbpath="static/weather.db", cubepath=CUBE_PATH, metapath=META_PATH, start="1950-01", end="2023-12",
+               shape=(91, 91), climate_types=["temp_mean", "temp_max", "temp_min", "precip"]):
+    """
+    Compact the weather database into a dense array of shape (months, nlats, nlons, climate types)
+    stored as a .npy file, plus a JSON sidecar with its metadata.
+    Cells without data are NaN.
+
+    Args:
+        dbpath (string): path of the weather database
+        cubepath (string): where to save the cube
+        metapath (string): where to save the metadata
+        start (string): first month, "YYYY-MM"
+        end (string): last month, "YYYY-MM"
+        shape (turple): how many lats and lons in the grid
+        climate_types (list of strings): "temp_mean", "temp_max", "temp_min" and/or "precip"
+
+    Returns:
+        dict: metadata of the cube
+    """
+    nlats, nlons = shape
+    year_start, month_start = int(start[:4]), int(start[5:7])
+    nmonths = (int(end[:4]) - year_start) * 12 + int(end[5:7]) - month_start + 1
+    lats = np.linspace(-90, 90, nlats)
+    lons = np.linspace(-180, 180, nlons)
+
+    # Write into a temporary file, so readers never see a half-built cube
+    tmppath = cubepath + ".tmp"
+    cube = np.lib.format.open_memmap(tmppath, mode="w+", dtype=np.float32,
+                                     shape=(nmonths, nlats, nlons, len(climate_types)))
+    cube[:] = np.nan
+
+    # Stream the whole table once instead of running one query per month
+    con = sqlite3.connect(dbpath)
+    columns = ", ".join("d." + climate_type for climate_type in climate_types)
+    cur = con.execute(f"""SELECT l.lat, l.lon, d.dates, {columns} FROM data AS d
+                          JOIN locations AS l ON l.loc_id = d.loc_id""")
+    nrows = 0
+    while True:
+        rows = cur.fetchmany(100000)
+        if not rows:
+            break
+        coords = np.array([row[:2] for row in rows], dtype=float)
+        months = np.array([(int(row[2][:4]) - year_start) * 12 + int(row[2][5:7]) - month_start for row in rows])
+        values = np.array([row[3:] for row in rows], dtype=float)
+        i = np.rint((coords[:, 0] + 90) / 180 * (nlats - 1)).astype(int)
+        j = np.rint((coords[:, 1] + 180) / 360 * (nlons - 1)).astype(int)
+        # Only keep the months in range and the locations on the grid
+        keep = (months >= 0) & (months < nmonths) & (i >= 0) & (i < nlats) & (j >= 0) & (j < nlons)
+        keep[keep] = (np.isclose(lats[i[keep]], coords[keep, 0]) & np.isclose(lons[j[keep]], coords[keep, 1]))
+        cube[months[keep], i[keep], j[keep], :] = values[keep]
+        nrows += keep.sum()
+    con.close()
+    cube.flush()
+    del cube
+    os.replace(tmppath, cubepath)
+
+    meta = {
+        "shape": [nmonths, nlats, nlons, len(climate_types)],
+        "dtype": "float32",
+        "start": start,
+        "end": end,
+        "data_types": list(climate_types),
+        "rows": int(nrows),
+        "source": dbpath,
+        "built": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    # Published after the cube, atomically: load_cube() and source_mtime() never read half-written metadata,
+    # and the new metadata (whose mtime they watch) only appears once the new cube is in place
+    def save(tmppath):
+        with open(tmppath, "w") as file:
+            json.dump(meta, file, indent=4)
+    atomic_write(metapath, save)
+    print(f"Built cube {cubepath} {tuple(meta['shape'])} from {nrows} rows")
+    return meta
+
+
+def load_cube(cubepath=CUBE_PATH, metapath=META_PATH):
+    """
+    Open the cube as a read-only memory map. It is opened again only if it has been rebuilt.
+
+    Returns:
+        (numpy.memmap) cube, or None if the cube doesn't exist or is disabled
+        (dict) meta, or None
+    """
+    if not _cube["enabled"]:
+        return None, None
+    try:
+        mtime = os.path.getmtime(metapath)
+    except OSError:
+        return None, None
+    if _cube["mtime"] != mtime:
+        try:
+            with open(metapath) as file:
+                meta = json.load(file)
+            cube = np.load(cubepath, mmap_mode="r")
+        except (OSError, ValueError):
+            print("Warning: cannot open the weather cube")
+            return None, None
+        if list(cube.shape) != meta["shape"]:
+            print("Warning: the weather cube doesn't match its metadata")
+            return None, None
+        _cube.update(mtime=mtime, cube=cube, meta=meta)
+    return _cube["cube"], _cube["meta"]
+
+
+def validate_cube(shape, data_types, start=None, end=None, metapath=META_PATH):
+    """
+    Check the constants used to draw maps against the metadata of the cube.
+    The cube is disabled (and the database used instead) if they disagree.
+
+    Args:
+        shape (turple): (nlats, nlons)
+        data_types (list of strings): types of climate data
+        start (string): first month, "YYYY-MM"
+        end (string): last month, "YYYY-MM"
+
+    Returns:
+        bool: True if the cube exists and agrees with the constants, False otherwise
+    """
+    try:
+        with open(metapath) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return False
+    problems = []
+    if list(shape) != meta["shape"][1:3]:
+        problems.append(f"shape {tuple(shape)} != {tuple(meta['shape'][1:3])}")
+    if not set(data_types) <= set(meta["data_types"]):
+        problems.append(f"data types {data_types} not in {meta['data_types']}")
+    if start and start < meta["start"]:
+        problems.append(f"start {start} < {meta['start']}")
+    if end and end > meta["end"]:
+        problems.append(f"end {end} > {meta['end']}")
+    if problems:
+        print("Warning: the weather cube is disabled because of " + ", ".join(problems))
+        _cube["enabled"] = False
+        return False
+    return True
+
+
+def is_source(meta, dbpath):
+    """Whether the cube was built from a database (None: any database), compared by absolute path"""
+    return dbpath is None or os.path.abspath(meta.get("source", "")) == os.path.abspath(dbpath)
+
+
+def month_index(month, meta):
+    """Index of a month ("YYYY-MM") in the cube, or None if it's out of range"""
+    index = (int(month[:4]) - int(meta["start"][:4])) * 12 + int(month[5:7]) - int(meta["start"][5:7])
+    if 0 <= index < meta["shape"][0]:
+        return index
+    return None
+
+
+def cube_month(month, climate_type="temp_mean", dbpath=None):
+    """
+    Read one month of the grid from the cube without copying it.
+
+    Args:
+        month (string): "YYYY-MM"
+        climate_type (string): "temp_mean", "temp_max", "temp_min" or "precip"
+        dbpath (string): the database the data is asked from: the cube only answers for its source (None: any)
+
+    Returns:
+        NDarray: read-only view of shape (nlats, nlons), or None if the cube can't answer
+    """
+    cube, meta = load_cube()
+    if cube is None or climate_type not in meta["data_types"] or not is_source(meta, dbpath):
+        return None
+    index = month_index(month, meta)
+    if index is None:
+        return None
+    return cube[index, :, :, meta["data_types"].index(climate_type)]
+
+
+def cube_series(row, col, climate_type="temp_mean", dbpath=None):
+    """
+    Read the time series of one cell of the grid from the cube without copying it.
+
+    Args:
+        row (int): index of the latitude in the grid
+        col (int): index of the longitude in the grid
+        climate_type (string): "temp_mean", "temp_max", "temp_min" or "precip"
+        dbpath (string): the database the data is asked from: the cube only answers for its source (None: any)
+
+    Returns:
+        NDarray: read-only view with one value per month, or None if the cube can't answer
+    """
+    cube, meta = load_cube()
+    if cube is None or climate_type not in meta["data_types"] or not is_source(meta, dbpath):
+        return None
+    if not (0 <= row < meta["shape"][1] and 0 <= col < meta["shape"][2]):
+        return None
+    return cube[:, row, col, meta["data_types"].index(climate_type)]
+
+
+def cube_months():
+    """List of the months ("YYYY-MM") along the first axis of the cube"""
+    cube, meta = load_cube()
+    if cube is None:
+        return []
+    year, month = int(meta["start"][:4]), int(meta["start"][5:7]) - 1
+    return [f"{year + (month + i) // 12}-{(month + i) % 12 + 1:02d}" for i in range(meta["shape"][0])]
+
+
+if __name__ == "__main__":
+    # Usage: python helpers_cube.py [dbpath]
+    if len(sys.argv) > 1:
+        build_cube(dbpath=sys.argv[1])
+    else:
+        build_cube()
@@ -4,6 +4,39 @@ import pandas as pd
 import requests_cache
 from retry_requests import retry
 import sqlite3
+import threading
+import time
+
+from helpers_db import WEATHER_DB, connect
+from helpers_ingest import ApiBudget, BulkWriter, ingest
+from helpers_jobs import (CANCELLED, DONE, FAILED, PENDING, SKIPPED, claim_job, job_errors, job_progress, job_status,
+                          mark_done, mark_failed, next_items, next_retry, plan_job, set_status, touch_job)
+from helpers_migrate import grid_index, has_grid_keys
+
+CLIMATE_API_URL = "https://climate-api.open-meteo.com/v1/climate"
+
+
+def location_query(lat, lon, con):
+    """
+    Input: lat, lon, con
+    Output: condition, params
+    Build the WHERE condition which finds a location in the table "locations".
+    Use the integer grid keys if the database has been migrated and the location is on the grid,
+    otherwise compare the floats.
+
+    Args:
+        lat (float): latitude
+        lon (float): longitude
+        con (sqlite3.Connection): connection to the database
+
+    Returns:
+        string: condition
+        turple: params
+    """
+    index = grid_index(lat, lon)
+    if index and has_grid_keys(con):
+        return "row = ? AND col = ?", index
+    return "lat = ? AND lon = ?", (lat, lon)
 
 
 def fetch_loc_id(lat, lon, con=None):
@@ -23,13 +56,14 @@ def fetch_loc_id(lat, lon, con=None):
     
     # I learned sqlite3 tutorial at https://docs.python.org/3/library/sqlite3.html
     if not con:
-        con = sqlite3.connect("./static/weather.db")
+        con = connect(WEATHER_DB)
         if_assigned = False
     else:
         if_assigned = True
     try:
         cur = con.cursor()
-        cur.execute("SELECT loc_id FROM locations WHERE lat = ? AND lon = ?", (lat, lon))
+        condition, params = location_query(lat, lon, con)
+        cur.execute(f"SELECT loc_id FROM locations WHERE {condition}", params)
         loc_id = cur.fetchone()
         # If this location exists in the db, output its location
         if loc_id:
@@ -51,7 +85,8 @@ def fetch_loc_id(lat, lon, con=None):
 def get_data(con=None, location=(0, 0), date_start="1950-01-01", date_end="1951-12-31", 
              models=["MRI_AGCM3_2_S", "EC_Earth3P_HR"],
              meteo_types=["temperature_2m_mean", "temperature_2m_max", "temperature_2m_min", "precipitation_sum"],
-             save_as_csv=False, insert_into_database=False, force_update_database=False, return_DataFrame=False):
+             save_as_csv=False, insert_into_database=False, force_update_database=False, return_DataFrame=False,
+             url=CLIMATE_API_URL):
     """
     Get weather data with open-meteo API (https://open-meteo.com/) for a given location and a range of dates.
     Can decide whether or not to save those weather data as CSV files and insert into the database.
@@ -69,6 +104,7 @@ def get_data(con=None, location=(0, 0), date_start="1950-01-01", date_end="1951-
         insert_into_database (bool): whether to insert the data into the database
         force_update_database (bool): whether to force update the database when the database already holds the data at the cooresponding position
         return_DataFrame (bool): whether to return the data as a DataFrame
+        url (string): URL of the climate API (can point to a local stub server for testing)
         
     Returns:
         bool: False. If something went wrong
@@ -81,14 +117,10 @@ def get_data(con=None, location=(0, 0), date_start="1950-01-01", date_end="1951-
     else:
         loc_id = None
     
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
-    retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
-    openmeteo = openmeteo_requests.Client(session = retry_session)
+    openmeteo = open_meteo_client()
 
     # Make sure all required weather variables are listed here
     # The order of variables in hourly or daily is important to assign them correctly below
-    url = "https://climate-api.open-meteo.com/v1/climate"
     params = {
         "latitude": lat,
         "longitude": lon,
@@ -101,11 +133,65 @@ def get_data(con=None, location=(0, 0), date_start="1950-01-01", date_end="1951-
     try:
         responses = openmeteo.weather_api(url, params=params)
     except Exception as e:
-        reason = e.args[0]['reason']
+        # The client raises its errors with a dict of details, connection errors with a message
+        reason = e.args[0]['reason'] if e.args and isinstance(e.args[0], dict) else e
         STAR = "*"
         print(f"{STAR*30}WARNING{STAR*30}\n\tError occurred, reaason: {reason}")
         return False
 
+    mean_monthly_dataframe = process_responses(responses, location, models, meteo_types, loc_id)
+    
+    # If I add the line below, the index will cause problems (Error binding parameter 1: type 'Period' is not supported) 
+    # when saving it as sql, beacuse period is not supported when saving as sql
+    #mean_monthly_dataframe.index = mean_monthly_dataframe.index.to_period("M")
+    
+    # Save as csv for debugging purposes if needed
+    if save_as_csv:
+        mean_monthly_dataframe.to_csv("static/weather_data/" + str(lat) + "-" + str(lon) + ".csv")
+    
+    # Data can be saved in a database if needed
+    if insert_into_database:
+        data_tmp = get_data_in_database(lat, lon, con=con)
+        
+        # If the data exists: decide whether to update it or not.
+        if data_tmp:
+            if force_update_database:
+                print(f"For location {lat}°N, {lon}°E, data already exists. \n\tUpdating data in the database.")
+                modify_database(mean_monthly_dataframe, type="update", con=con)
+            else:
+                print(f"For location {lat}°N, {lon}°E, data already exists. \n\tSkipping these locations.")
+        # If the data doesn't exist: just insert.
+        else:
+            modify_database(mean_monthly_dataframe, type="insert", con=con)
+        
+    if return_DataFrame:
+        return mean_monthly_dataframe
+    else:
+        return True
+
+
+def open_meteo_client():
+    """Setup the Open-Meteo API client with cache and retry on error"""
+    cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
+    retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
+    return openmeteo_requests.Client(session = retry_session)
+
+
+def process_responses(responses, location, models, meteo_types, loc_id=None):
+    """
+    Turn the responses of one location (one response per model) into monthly data:
+    the mean of all models, aggregated by month.
+    
+    Args:
+        responses (list): responses of the Open-Meteo API client for this location, in the order of models
+        location (tuple): (latitude, longitude) in decimal degrees.
+        models (list of strings): models requested
+        meteo_types (list of strings): meteo_types requested, in the order of the request
+        loc_id (int): loc_id of the location in the database (None if it's not needed)
+        
+    Returns:
+        DataFrame: mean_monthly_dataframe
+    """
     daily_dataframes = []
     
     # Use shorter names for elements in the list meteo_types
@@ -119,6 +205,7 @@ def get_data(con=None, location=(0, 0), date_start="1950-01-01", date_end="1951-
             meteo_types_shortened[j] = reaplace_dict[meteo_types[j]]
     
     # Deal with each model respectively
+    lat, lon = location
     for i in range(len(models)):
         response = responses[i]
         if i == 0:
@@ -166,34 +253,61 @@ def get_data(con=None, location=(0, 0), date_start="1950-01-01", date_end="1951-
     valid_aggregation_dict = {col: agg for col, agg in aggregation_dict.items() 
                               if col in mean_daily_dataframe.columns}
     mean_monthly_dataframe = mean_daily_dataframe.resample("MS").agg(valid_aggregation_dict)
+    return mean_monthly_dataframe
+
+
+def get_data_batch(locations, date_start="1950-01-01", date_end="1951-12-31", 
+                   models=["MRI_AGCM3_2_S", "EC_Earth3P_HR"],
+                   meteo_types=["temperature_2m_mean", "temperature_2m_max", "temperature_2m_min", "precipitation_sum"],
+                   url=CLIMATE_API_URL):
+    """
+    Get weather data for N locations with a single request to the open-meteo API.
+    The API answers with one response per location and model, location by location.
     
-    # If I add the line below, the index will cause problems (Error binding parameter 1: type 'Period' is not supported) 
-    # when saving it as sql, beacuse period is not supported when saving as sql
-    #mean_monthly_dataframe.index = mean_monthly_dataframe.index.to_period("M")
-    
-    # Save as csv for debugging purposes if needed
-    if save_as_csv:
-        mean_monthly_dataframe.to_csv("static/weather_data/" + str(lat) + "-" + str(lon) + ".csv")
-    
-    # Data can be saved in a database if needed
-    if insert_into_database:
-        data_tmp = get_data_in_database(lat, lon, con=con)
-        
-        # If the data exists: decide whether to update it or not.
-        if data_tmp:
-            if force_update_database:
-                print(f"For location {lat}°N, {lon}°E, data already exists. \n\tUpdating data in the database.")
-                modify_database(mean_monthly_dataframe, type="update", con=con)
-            else:
-                print(f"For location {lat}°N, {lon}°E, data already exists. \n\tSkipping these locations.")
-        # If the data doesn't exist: just insert.
-        else:
-            modify_database(mean_monthly_dataframe, type="insert", con=con)
+    Args:
+        locations (list of tuples): [(latitude, longitude), ...] in decimal degrees.
+        date_start (string): "YYYY-MM-DD"
+        date_end (string): "YYYY-MM-DD"
+        models (list of strings): see get_data()
+        meteo_types (list of strings): see get_data()
+        url (string): URL of the climate API (can point to a local stub server for testing)
         
-    if return_DataFrame:
-        return mean_monthly_dataframe
-    else:
-        return True
+    Returns:
+        bool: False. If something went wrong
+        list of DataFrames: the monthly data of each location, in the order of locations
+    """
+    openmeteo = open_meteo_client()
+    params = {
+        "latitude": [lat for lat, lon in locations],
+        "longitude": [lon for lat, lon in locations],
+        "start_date": date_start,
+        "end_date": date_end,
+        "models": models,
+        "daily": meteo_types
+    }
+    try:
+        responses = openmeteo.weather_api(url, params=params)
+    except Exception as e:
+        STAR = "*"
+        print(f"{STAR*30}WARNING{STAR*30}\n\tError occurred, reaason: {e}")
+        return False
+    if len(responses) != len(locations) * len(models):
+        print(f"Expected {len(locations) * len(models)} responses, got {len(responses)}")
+        return False
+
+    dataframes = []
+    for k, (lat, lon) in enumerate(locations):
+        location_responses = responses[k*len(models):(k+1)*len(models)]
+        # Make sure the responses are demultiplexed correctly: models snap to grids of a few dozen km,
+        # while neighbouring locations of a batch are degrees apart
+        for response in location_responses:
+            lon_difference = (response.Longitude() - lon + 180) % 360 - 180
+            if abs(response.Latitude() - lat) > 1 or abs(lon_difference) > 1:
+                print(f"Response for {response.Latitude()}°N, {response.Longitude()}°E "
+                      f"doesn't match location {lat}°N, {lon}°E")
+                return False
+        dataframes.append(process_responses(location_responses, (lat, lon), models, meteo_types))
+    return dataframes
 
 
 def get_data_in_database(lat, lon, con=None):
@@ -209,17 +323,18 @@ def get_data_in_database(lat, lon, con=None):
         list: data. A list of weather data for one location.
     """
     if not con:
-        con = sqlite3.connect("./static/weather.db")
+        con = connect(WEATHER_DB)
         if_assigned = False
     else:
         if_assigned = True
     try:
         cur = con.cursor()
-        cur.execute("""
+        condition, params = location_query(lat, lon, con)
+        cur.execute(f"""
                     SELECT * FROM data WHERE loc_id = 
-                    (SELECT loc_id FROM locations WHERE lat = ? AND lon = ?)
+                    (SELECT loc_id FROM locations WHERE {condition})
                     LIMIT 1
-                    """, (lat, lon))
+                    """, params)
         data = cur.fetchall()
     except:
         if not if_assigned: con.close()
@@ -229,8 +344,12 @@ def get_data_in_database(lat, lon, con=None):
 
 
 def get_data_locations(lats, lons, date_start="1950-01-01", date_end="1951-12-31", 
-                       dbpath="static/weather.db", force_update_database=False):
+                       dbpath="static/weather.db", force_update_database=False,
+                       workers=8, url=CLIMATE_API_URL, budget_path="instance/api_budget.db", batch_size=91,
+                       max_attempts=5):
     """Get weather data for multiple locations.
+    The work is planned in a job journal stored in the database, so calling this function again
+    with the same parameters resumes the backfill where it stopped (see run_job()).
         
     Args:
         lats (list): List of latitudes
@@ -238,62 +357,163 @@ def get_data_locations(lats, lons, date_start="1950-01-01", date_end="1951-12-31
         date_start (string): "YYYY-MM-DD"
         date_end (string): "YYYY-MM-DD"
         force_update_database (bool): Whether to force update when the data already exists
+        workers (int): How many requests to send at the same time
+        url (string): URL of the climate API (can point to a local stub server for testing)
+        budget_path (string): Where the API budget is stored (None: don't limit the API calls)
+        batch_size (int): How many locations to download with one request
+        max_attempts (int): How many times to try each location
 
     Returns:
         Bool: Ture if successful, False otherwise
     """
+    con = connect(dbpath)
+    try:
+        job_id = plan_job(con, lats, lons, date_start, date_end, force_update=force_update_database)
+    except sqlite3.Error as e:
+        print(f"Cannot plan the job: {e}")
+        con.close()
+        return False
+    con.close()
+    return run_job(job_id, dbpath=dbpath, workers=workers, url=url, budget_path=budget_path,
+                   batch_size=batch_size, max_attempts=max_attempts)
+
+
+def run_job(job_id, dbpath="static/weather.db", workers=8, url=CLIMATE_API_URL, budget_path="instance/api_budget.db",
+            batch_size=91, max_attempts=5, backoff=30):
+    """Run (or resume) a backfill job planned by helpers_jobs.plan_job().
+    Each request downloads (up to batch_size) locations of the same latitude row.
+    Requests are sent in parallel and written to the database by a single writer, which marks
+    the work items as done in the same transaction as their data (new locations are committed before it,
+    when they are looked up). Failed items are retried with an exponential backoff.
+    The job stops before its next request once it has been cancelled (helpers_jobs.cancel_job()).
+        
+    Args:
+        job_id (int): the job to run
+        dbpath (string): path of the weather database holding the job
+        workers (int): How many requests to send at the same time
+        url (string): URL of the climate API (can point to a local stub server for testing)
+        budget_path (string): Where the API budget is stored (None: don't limit the API calls)
+        batch_size (int): How many locations to download with one request
+        max_attempts (int): How many times to try each location
+        backoff (float): Seconds to wait before the first retry, doubled after each attempt
+
+    Returns:
+        Bool: Ture if every location is done, False otherwise (including if the job is cancelled or already running)
+    """
     # The daily API calls is limited to 10,000 for non-commercial use (https://open-meteo.com/en/terms)
     # Less than 10'000 API calls per day, 5'000 per hour and 600 per minute.
-    if len(lats) * len(lons) > 5000:
-        print("""Warning: too many locations at one time.
-              \nAPI Hourly limit: 5'000 (around 370 locations)
-              \nAPI Daily limit: 10'000
-              \nCheck terms at https://open-meteo.com/en/terms""")
+    # These limits are enforced by the token buckets of ApiBudget, which wait until calls are available.
+    budget = ApiBudget(budget_path) if budget_path else None
+
+    con = connect(dbpath)
+    job = con.execute("SELECT date_start, date_end, force_update FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if not job:
+        print(f"Job {job_id} doesn't exist")
+        con.close()
         return False
-    
-    con = sqlite3.connect(dbpath)
-    # If we want to force update
-    if force_update_database:
-        for lat in lats:
-            for lon in lons:
-                ifsucceeded = get_data(con=con, location=(lat, lon), date_start=date_start, date_end=date_end,
-                                insert_into_database=True, force_update_database=True)
-                # If get_data returns False, then return False
-                if not ifsucceeded:
-                    print(f"Something went wrong while getting data.")
-                    print(f"\tCurrent latitude: {lat}\n\tCurrent longitude: {lon}")
-                    return False
-    # If we don't want to force update: 
-    # 1. Find out locations without data
-    # 2. Update
-    else:
-        for lat in lats:
-            for lon in lons:
-                try:
-                    cur = con.cursor()
-                    cur.execute("""
-                                SELECT * FROM data WHERE loc_id = 
-                                (SELECT loc_id FROM locations WHERE lat = ? AND lon = ?)
-                                LIMIT 1
-                                """, (lat, lon))
-                    ifexists = cur.fetchone()
-                    cur.close()
-                    if ifexists:
-                        print(f"For location {lat}°N, {lon}°E, data already exists. \n\tSkipping these locations.")
-                    else:
-                        ifget = get_data(con=con, location=(lat, lon), date_start=date_start, date_end=date_end,
-                                         insert_into_database=True)
-                        # If get_data returns False, then return False
-                        if not ifget:
-                            print(f"Something went wrong while getting data.")
-                            print(f"\tCurrent latitude: {lat}\n\tCurrent longitude: {lon}")
-                            con.close()
-                            return False
-                except:
-                    con.close()
-                    return False           
+    date_start, date_end, force_update_database = job
+    if not claim_job(con, job_id):
+        print(f"Job {job_id} is done or already running")
+        con.close()
+        return False
+
+    # Checking the status costs one indexed lookup per request
+    def cancelled():
+        check = connect(dbpath, readonly=True)
+        status = job_status(check, job_id)
+        check.close()
+        return status == CANCELLED
+
+    def fetch(batch):
+        return get_data_batch(batch, date_start=date_start, date_end=date_end, url=url)
+
+    # One bulk writer for the connection of the writer thread
+    writers = {}
+
+    def write(con, batch, dataframes):
+        if con not in writers:
+            writers[con] = BulkWriter(con, type="update" if force_update_database else "insert")
+        # Look up every location first, so the data of a batch is written either whole or not at all.
+        # New locations are committed by fetch_loc_id() right away, not in the transaction of the data:
+        # a batch failing afterwards leaves locations without data, which are reused when it is retried
+        # (a location only counts as done, or as skipped by plan_job(), once it has data)
+        loc_ids = [fetch_loc_id(lat, lon, con) for lat, lon in batch]
+        if any(loc_id is False or loc_id is None for loc_id in loc_ids):
+            return False
+        for loc_id, data in zip(loc_ids, dataframes):
+            data["loc_id"] = loc_id
+            writers[con].add(data)
+        # The items are marked as done in the same transaction as their data
+        writers[con].defer(lambda con: mark_done(con, job_id, batch, commit=False))
+        return True
+
+    def finish(con):
+        if con in writers:
+            writers.pop(con).flush()
+
+    # Keep the heartbeat of the job fresh, even while waiting for the API budget,
+    # so that other processes don't take it for abandoned
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(60):
+            try:
+                beat = connect(dbpath)
+                touch_job(beat, job_id)
+                beat.close()
+            except sqlite3.Error as e:
+                print(f"Cannot update the heartbeat of job {job_id}: {e}")
+
+    threading.Thread(target=heartbeat, name=f"job-{job_id}-heartbeat", daemon=True).start()
+    try:
+        ifsucceeded = run_rounds(con, job_id, fetch, write, finish, cancelled, dbpath, workers, budget,
+                                 batch_size, max_attempts, backoff)
+    finally:
+        stopped.set()
+        con.close()
+    return ifsucceeded
+
+
+def run_rounds(con, job_id, fetch, write, finish, cancelled, dbpath, workers, budget, batch_size, max_attempts, backoff):
+    """Run the rounds of run_job() until every item is done, has failed too many times, or the job is cancelled"""
+    while not cancelled():
+        locations = next_items(con, job_id, max_attempts)
+        if not locations:
+            # Wait for the backoff of failed items, if they have attempts left
+            retry_at = next_retry(con, job_id, max_attempts)
+            if retry_at is None:
+                break
+            time.sleep(min(max(0, retry_at - time.time()), 60))
+            continue
+
+        # Send whole latitude rows at once
+        batches = []
+        for lat in dict.fromkeys(lat for lat, lon in locations):
+            row = [location for location in locations if location[0] == lat]
+            for i in range(0, len(row), batch_size):
+                batches.append(tuple(row[i:i+batch_size]))
+
+        # Each location of a batch counts as one API call
+        succeeded, failed = ingest(batches, fetch, write, dbpath=dbpath, workers=workers, budget=budget, cost=len,
+                                   finish=finish, stop=cancelled)
+        for batch, error in failed:
+            mark_failed(con, job_id, batch, error, backoff=backoff)
+        progress = job_progress(con, job_id)
+        print(f"Job {job_id}: {progress[DONE] + progress[SKIPPED]}/{progress['total']} done, "
+              f"{progress[FAILED]} failed, {progress[PENDING]} pending")
+
+    progress = job_progress(con, job_id)
+    if job_status(con, job_id) == CANCELLED:
+        print(f"Job {job_id} has been cancelled: {progress['remaining']} location(s) remaining")
+        return False
+    if progress[FAILED]:
+        print(f"Something went wrong while getting data.")
+        for lat, lon, attempts, error in job_errors(con, job_id):
+            print(f"\tLatitude: {lat}, Longitude: {lon} ({attempts} attempts): {error}")
+        set_status(con, job_id, FAILED)
+        return False
+    set_status(con, job_id, DONE)
     print(f"\nSuccess!\n")
-    con.close()
     return True
 
 
@@ -311,30 +531,15 @@ def modify_database(data, type="donothing", con=None):
         return False
     
     if not con:
-        con = sqlite3.connect("./static/weather.db")
+        con = connect(WEATHER_DB)
         if_assigned = False
     else:
         if_assigned = True
     try:
-        # I learned how to insert dataframes into sqlite3 at https://stackoverflow.com/questions/53189071 
-        # and https://theleftjoin.com/how-to-write-a-pandas-dataframe-to-an-sqlite-table/
-        cur = con.cursor()
-        data.to_sql('temporary_table', con, if_exists='replace')
-        if type == "insert":
-            cur.execute("""
-                        INSERT OR IGNORE INTO data (loc_id, dates, temp_mean, temp_max, temp_min, precip)
-                        SELECT loc_id, dates, temp_mean, temp_max, temp_min, precip
-                        FROM temporary_table
-                        """)
-        # Else: update weather data. (REPLACE INTO: if exists → replace, if not exists → insert)
-        else:
-            cur.execute("""
-                        REPLACE INTO data (loc_id, dates, temp_mean, temp_max, temp_min, precip)
-                        SELECT loc_id, dates, temp_mean, temp_max, temp_min, precip
-                        FROM temporary_table
-                        """)
-        #cur.execute('DROP TABLE temporary_table')
-        con.commit()
+        # Prepared INSERT OR IGNORE / REPLACE INTO statements, no temporary table
+        writer = BulkWriter(con, type=type)
+        writer.add(data)
+        writer.flush()
     except:
         if not if_assigned: con.close()
         return False
@@ -360,6 +565,7 @@ if __name__ == "__main__":
     #        print(f"{fetch_loc_id(lat=lat, lon=lon)}: {lat}°N {lon}°E")
     
     #---------------------------------- Get data ----------------------------------
-    lats = [90] # Next: [80, 82, 84, 86, 88]
+    # The job journal resumes the backfill where it stopped, so the whole grid can be requested at once
+    lats = np.linspace(-90, 90, 91)
     lons = np.linspace(-180, 180, 91)
     get_data_locations(lats=lats, lons=lons, date_start="1950-01-01", date_end="2023-12-31", force_update_database=False)
\ No newline at end of file
@@ -0,0 +1,101 @@
+import os
+import sqlite3
+
+from flask import current_app, g
+from urllib.request import pathname2url
+
+
+USERS_DB = "static/users.db"
+WEATHER_DB = "static/weather.db"
+UPDATE_DB = "static/weather_update.db"
+# Databases of the app by name, the paths can be changed in app.config["DATABASES"]
+DATABASES = {"users": USERS_DB, "weather": WEATHER_DB, "update": UPDATE_DB}
+# Databases switched to WAL: those written while the pages read them. "users" is left in its own journal mode,
+# since static/users.db is committed to the repository and switching it would rewrite the file
+WAL_DATABASES = ["weather", "update"]
+# Memory-map up to 256 MiB of each database: reads are served from the page cache without copies
+MMAP_SIZE = 256 * 1024**2
+
+
+def connect(path, readonly=False, timeout=30, wal=True):
+    """
+    Open a configured connection: memory-mapped reads, and waiting up to `timeout` seconds for a lock
+    instead of failing with "database is locked". Read-only connections use a "mode=ro" URI, so they
+    can never take a write lock; in WAL mode they read a snapshot while a writer is ingesting.
+
+    Args:
+        path (string): path of the database
+        readonly (bool): open it read-only (the file must exist)
+        timeout (float): how long to wait for a lock, in seconds
+        wal (bool): switch the database to WAL when writing (False: keep its journal mode)
+
+    Returns:
+        sqlite3.Connection: the connection
+    """
+    if readonly:
+        con = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro", uri=True, timeout=timeout)
+    else:
+        con = sqlite3.connect(path, timeout=timeout)
+        if wal:
+            # Databases created since init_app() are switched to WAL by their first writer (a no-op afterwards).
+            # Safe with WAL: a crash can only lose the last transactions, never corrupt the database
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute("PRAGMA synchronous = NORMAL")
+    con.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    return con
+
+
+def enable_wal(path):
+    """
+    Switch a database to write-ahead logging, which lets readers and one writer work at the same time.
+    The mode is stored in the file, so this is only needed once per database.
+
+    Returns:
+        string: the journal mode ("wal"), None if the database doesn't exist
+    """
+    if not os.path.isfile(path):
+        return None
+    con = sqlite3.connect(path, timeout=30)
+    try:
+        return con.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    finally:
+        con.close()
+
+
+def get_db(name="users", readonly=False):
+    """
+    Connection to a database of the app, shared by everything running in the current app context
+    (one request) and closed by close_db() when the context ends, even if the request failed.
+
+    Args:
+        name (string): "users", "weather" or "update" (see DATABASES)
+        readonly (bool): a read-only connection, for the routes which only read
+
+    Returns:
+        sqlite3.Connection: the connection
+    """
+    if "databases" not in g:
+        g.databases = {}
+    if (name, readonly) not in g.databases:
+        path = current_app.config["DATABASES"][name]
+        g.databases[(name, readonly)] = connect(path, readonly=readonly, wal=name in current_app.config["WAL_DATABASES"])
+    return g.databases[(name, readonly)]
+
+
+def close_db(exception=None):
+    """Close the connections of the current app context (registered as a teardown hook by init_app())"""
+    for con in g.pop("databases", {}).values():
+        con.close()
+
+
+def init_app(app):
+    """
+    Configure the databases of an app: paths, WAL mode (only for app.config["WAL_DATABASES"]),
+    and closing the connections after each request
+    """
+    app.config.setdefault("DATABASES", dict(DATABASES))
+    app.config.setdefault("WAL_DATABASES", list(WAL_DATABASES))
+    for name in app.config["WAL_DATABASES"]:
+        if name in app.config["DATABASES"]:
+            enable_wal(app.config["DATABASES"][name])
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,126 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from flask import request, send_file
+from helpers_cache import COMPRESSIBLE, SIDECARS, is_fresh, sidecar_path
+
+
+# Renders of one past month under static/: they never change once written, except when new data is merged
+# (then python helpers_prerender.py --force writes them again, with new ETags).
+# Only the 4 types of data: the anomalies are drawn again when their baselines are rebuilt, the grids of the API
+# and the means of a period (eg: "weather_data/1991-2020_JJA_temp_mean.html") when the data is newer,
+# so these are revalidated like any other file.
+RENDERED_TYPES = r"(temp_mean|temp_max|temp_min|precip)"
+IMMUTABLE_FILES = [
+    re.compile(r"weather_data/\d{4}-\d{2}_" + RENDERED_TYPES + r"\.html"),
+    re.compile(r"weather_raster/\d{4}-\d{2}_" + RENDERED_TYPES + r"\.png"),
+    re.compile(r"weather_frames/\d{4}-\d{2}_" + RENDERED_TYPES + r"\.bin"),
+    # Local copies of the libraries, their names keep the versions
+    re.compile(r"vendor/.+"),
+]
+# SQLite databases (and their journals) are never sent, even if they are under static/
+PRIVATE_FILES = (".db", ".db-wal", ".db-shm", ".db-journal")
+NO_STORE = "no-cache, no-store, must-revalidate"
+
+# Content hashes of the files, recomputed only when a file changes
+_etags = {}
+_etags_lock = threading.Lock()
+
+
+def content_etag(path):
+    """
+    Strong ETag of a file: the SHA-1 of its content, cached by (path, mtime, size)
+    so each file is only read again when it has been rewritten.
+
+    Returns:
+        string: the hash, eg: "437547a139e276a6b2943f7a0b927997d8066969"
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _etags_lock:
+        etag = _etags.get(key)
+    if etag is None:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                sha1.update(block)
+        etag = sha1.hexdigest()
+        with _etags_lock:
+            # Forget the hashes of the older versions of the file
+            for old in [old for old in _etags if old[0] == key[0]]:
+                del _etags[old]
+            _etags[key] = etag
+    return etag
+
+
+def is_immutable(filename):
+    """Whether a file under static/ is a render of one past month (or a versioned library), eg: "weather_data/1950-01_temp_mean.html" """
+    filename = filename.replace(os.sep, "/")
+    return any(pattern.fullmatch(filename) for pattern in IMMUTABLE_FILES)
+
+
+def is_private(filename):
+    """Whether a file under static/ must not be served, eg: "users.db" """
+    return filename.lower().endswith(PRIVATE_FILES)
+
+
+def pick_encoding(path, accept_encodings):
+    """
+    The precompressed copy of a file to send for the Accept-Encoding of a request:
+    brotli, then gzip, among the copies which are up to date (see write_sidecars()).
+
+    Returns:
+        turple: (path of the file to send, its Content-Encoding or None)
+    """
+    for encoding in SIDECARS:
+        sidecar = sidecar_path(path, encoding)
+        if accept_encodings[encoding] > 0 and is_fresh(sidecar, path):
+            return sidecar, encoding
+    return path, None
+
+
+def send_cached(path, mimetype=None, immutable=False, max_age=86400):
+    """
+    Send a file with a content-hash ETag and its Last-Modified date, answering conditional
+    requests with "304 Not Modified" (and Range requests with "206 Partial Content").
+    Text files are sent precompressed when the browser accepts it and a copy has been written.
+
+    Args:
+        path (string): path of the file
+        mimetype (string): its type (None: guessed from its name)
+        immutable (bool): True: cached by browsers and proxies for max_age seconds without revalidation,
+                          False: revalidated with its ETag on every use
+        max_age (int): lifetime of an immutable file in seconds
+
+    Returns:
+        Response: the file, or an empty "304 Not Modified"
+    """
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    # Each encoding has its own ETag, as required for strong ETags
+    variant, encoding = pick_encoding(path, request.accept_encodings)
+    response = send_file(variant, mimetype=mimetype, etag=content_etag(variant), conditional=True,
+                         max_age=max_age if immutable else None)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if path.endswith(COMPRESSIBLE):
+        response.vary.add("Accept-Encoding")
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def cache_policy(response):
+    """
+    Caching of the responses which have not chosen a policy (no Cache-Control header):
+    pages depend on the session (login, profile, flashed messages), so they are never stored.
+    """
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = NO_STORE
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
+    return response
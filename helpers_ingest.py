@@ -0,0 +1,281 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from helpers_migrate import has_grid_keys
+
+
+BUDGET_PATH = "instance/api_budget.db"
+# The API calls are limited for non-commercial use (https://open-meteo.com/en/terms):
+# less than 10'000 API calls per day, 5'000 per hour and 600 per minute.
+# {name: (capacity, period in seconds)}
+API_LIMITS = {
+    "minute": (600, 60),
+    "hour": (5000, 3600),
+    "day": (10000, 86400),
+}
+
+
+class ApiBudget:
+    """
+    Token buckets enforcing the API limits. Each bucket holds up to `capacity` calls
+    and refills continuously at `capacity / period` calls per second.
+    The buckets are stored in SQLite, so they hold across restarts and are shared between processes.
+    """
+
+    def __init__(self, path=BUDGET_PATH, limits=API_LIMITS):
+        self.path = path
+        self.limits = limits
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        con = sqlite3.connect(self.path)
+        con.execute("""CREATE TABLE IF NOT EXISTS api_budget (
+                           name TEXT PRIMARY KEY NOT NULL,
+                           tokens REAL NOT NULL,
+                           updated REAL NOT NULL)""")
+        for name, (capacity, period) in self.limits.items():
+            con.execute("INSERT OR IGNORE INTO api_budget (name, tokens, updated) VALUES (?, ?, ?)",
+                        (name, capacity, time.time()))
+        con.commit()
+        con.close()
+
+    def refill(self, con, now):
+        """Return {name: tokens} of every bucket, refilled up to now"""
+        tokens = {}
+        for name, level, updated in con.execute("SELECT name, tokens, updated FROM api_budget"):
+            if name in self.limits:
+                capacity, period = self.limits[name]
+                tokens[name] = min(capacity, level + max(0, now - updated) * capacity / period)
+        return tokens
+
+    def try_acquire(self, cost=1):
+        """
+        Take `cost` calls from every bucket if they all hold enough.
+
+        Returns:
+            float: 0 if the calls were taken, otherwise how many seconds to wait before trying again
+        """
+        for name, (capacity, period) in self.limits.items():
+            if cost > capacity:
+                raise ValueError(f"A cost of {cost} calls can never fit in the {name} limit ({capacity})")
+        con = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # BEGIN IMMEDIATE: nobody else can take calls between reading and writing the buckets
+            con.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            tokens = self.refill(con, now)
+            wait = 0
+            for name, level in tokens.items():
+                capacity, period = self.limits[name]
+                if level < cost:
+                    wait = max(wait, (cost - level) * period / capacity)
+            if wait:
+                con.execute("ROLLBACK")
+                return wait
+            for name, level in tokens.items():
+                con.execute("UPDATE api_budget SET tokens = ?, updated = ? WHERE name = ?",
+                            (level - cost, now, name))
+            con.execute("COMMIT")
+            return 0
+        finally:
+            con.close()
+
+    def acquire(self, cost=1, timeout=None):
+        """
+        Wait until `cost` calls can be taken from every bucket, then take them.
+
+        Args:
+            cost (float): how many API calls to take
+            timeout (float): give up after this many seconds (None: wait as long as it takes)
+
+        Returns:
+            bool: True if the calls were taken, False if timed out
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = self.try_acquire(cost)
+            if not wait:
+                return True
+            if deadline is not None and time.time() + wait > deadline:
+                return False
+            time.sleep(min(wait, 60))
+
+    def remaining(self):
+        """Return {name: calls left} of every bucket"""
+        con = sqlite3.connect(self.path, timeout=30)
+        tokens = self.refill(con, time.time())
+        con.close()
+        return tokens
+
+
+def configure_for_ingestion(con, wal=True, synchronous="NORMAL"):
+    """
+    Tune a connection for long ingestion runs.
+
+    Args:
+        con (sqlite3.Connection): connection to the database
+        wal (bool): use write-ahead logging, so readers don't block the writer (and the other way round)
+        synchronous (string): "OFF", "NORMAL" or "FULL". "NORMAL" is safe in WAL mode and fsyncs much less
+    """
+    if wal:
+        con.execute("PRAGMA journal_mode = WAL")
+    if synchronous.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"Invalid synchronous setting: {synchronous}")
+    con.execute(f"PRAGMA synchronous = {synchronous.upper()}")
+    con.execute("PRAGMA temp_store = MEMORY")
+
+
+class BulkWriter:
+    """
+    Buffer the monthly rows of many locations and write them with executemany
+    in large transactions, with prepared statements and no temporary table.
+    type "insert" keeps the rows which already exist (INSERT OR IGNORE),
+    type "update" replaces them (REPLACE INTO).
+    """
+
+    COLUMNS = ["loc_id", "dates", "temp_mean", "temp_max", "temp_min", "precip"]
+
+    def __init__(self, con, type="insert", batch_rows=50000):
+        if type not in ("insert", "update"):
+            raise ValueError("Only 'insert' or 'update' are acceptable")
+        self.con = con
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.deferred = []
+        columns = list(self.COLUMNS)
+        # Fill in the month key directly instead of leaving it to the trigger
+        self.with_month = has_grid_keys(con)
+        if self.with_month:
+            columns.append("month")
+        verb = "INSERT OR IGNORE" if type == "insert" else "REPLACE"
+        self.sql = f"{verb} INTO data ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+    def add(self, data):
+        """
+        Buffer the rows of a DataFrame indexed by dates (as returned by get_data()), flushing if the buffer is full.
+        """
+        dates = [str(date) for date in data.index]
+        columns = []
+        for column in self.COLUMNS:
+            if column == "dates":
+                columns.append(dates)
+            elif column in data:
+                # NaN is stored as NULL
+                columns.append([None if value != value else value for value in data[column].tolist()])
+            else:
+                columns.append([None] * len(dates))
+        if self.with_month:
+            columns.append([int(date[:4] + date[5:7]) for date in dates])
+        self.rows.extend(zip(*columns))
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def defer(self, function):
+        """Run function(con) in the transaction of the next flush, after the rows are written"""
+        self.deferred.append(function)
+
+    def flush(self):
+        """Write the buffered rows (and run the deferred functions) in one transaction"""
+        try:
+            if self.rows:
+                self.con.executemany(self.sql, self.rows)
+            for function in self.deferred:
+                function(self.con)
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        finally:
+            self.rows = []
+            self.deferred = []
+
+
+def ingest(tasks, fetch, write, dbpath="static/weather.db", workers=8, budget=None, cost=1,
+           finish=None, stop=None, wal=True, synchronous="NORMAL"):
+    """
+    Fetch data for many tasks in parallel, and write the results through a single writer thread,
+    so that only one connection ever writes to the database.
+
+    Args:
+        tasks (list): tasks to be passed to fetch, for example (lat, lon) pairs
+        fetch (function): fetch(task) → result. Called in a bounded thread pool.
+                          A result of False (or an exception) means that the task failed.
+        write (function): write(con, task, result) → bool. Called in the writer thread only.
+                          False (or an exception) means that the task failed.
+        dbpath (string): path of the database the writer connects to
+        workers (int): number of threads fetching at the same time
+        budget (ApiBudget): API budget to take `cost` calls from before each fetch (None: no limit)
+        cost (float or function): API calls of a task, or cost(task) → API calls
+        finish (function): finish(con) → None. Called in the writer thread after the last write,
+                           for example to flush a BulkWriter. If it fails, every task is reported as failed.
+        stop (function): stop() → bool. Checked before each task; once it returns True,
+                         the remaining tasks are neither fetched nor reported
+        wal (bool), synchronous (string): settings of the writer's connection, see configure_for_ingestion()
+
+    Returns:
+        list: tasks which succeeded
+        list: (task, error message) of the tasks which failed
+    """
+    results = queue.Queue(maxsize=4 * workers)
+    succeeded = []
+    failed = []
+
+    def writer():
+        con = sqlite3.connect(dbpath)
+        try:
+            configure_for_ingestion(con, wal=wal, synchronous=synchronous)
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                task, result = item
+                try:
+                    if write(con, task, result) is False:
+                        failed.append((task, "cannot write data into the database"))
+                    else:
+                        succeeded.append(task)
+                except Exception as e:
+                    print(f"Something went wrong while writing data for {task}: {e}")
+                    con.rollback()
+                    failed.append((task, f"cannot write data into the database: {e}"))
+            if finish:
+                try:
+                    finish(con)
+                except Exception as e:
+                    print(f"Something went wrong while writing data: {e}")
+                    # Writes are idempotent, so retrying tasks which were in fact written is harmless
+                    failed.extend((task, f"cannot write data into the database: {e}") for task in succeeded)
+                    succeeded.clear()
+        finally:
+            con.close()
+
+    def worker(task):
+        if stop and stop():
+            return
+        try:
+            if budget:
+                budget.acquire(cost(task) if callable(cost) else cost)
+            result = fetch(task)
+        except Exception as e:
+            print(f"Something went wrong while getting data for {task}: {e}")
+            failed.append((task, f"cannot get data: {e}"))
+            return
+        if result is False or result is None:
+            failed.append((task, "cannot get data"))
+        else:
+            results.put((task, result))
+
+    writer_thread = threading.Thread(target=writer, name="ingest-writer")
+    writer_thread.start()
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Consume the iterator so that exceptions in the pool surface here
+            list(executor.map(worker, tasks))
+    finally:
+        results.put(None)
+        writer_thread.join()
+    print(f"Ingested {len(succeeded)} task(s), {len(failed)} failed, in {time.time() - start:.1f} s")
+    return succeeded, failed
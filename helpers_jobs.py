@@ -0,0 +1,245 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+
+# States of a job and of its work items
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+CANCELLED = "cancelled"
+
+# A running job whose heartbeat is older than this (in seconds) was abandoned, for example by a restart
+STALE_AFTER = 1800
+
+
+def create_tables(con):
+    """Create the tables of the job journal if they don't exist"""
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            job_key TEXT NOT NULL,
+            date_start TEXT NOT NULL,
+            date_end TEXT NOT NULL,
+            force_update BOOLEAN NOT NULL DEFAULT FALSE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            started REAL DEFAULT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_key ON jobs (job_key, status);
+        CREATE TABLE IF NOT EXISTS job_items (
+            job_id INTEGER NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            date_start TEXT NOT NULL,
+            date_end TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT DEFAULT NULL,
+            next_try REAL NOT NULL DEFAULT 0,
+            updated REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (job_id) REFERENCES jobs(job_id),
+            UNIQUE (job_id, lat, lon)
+        );
+        CREATE INDEX IF NOT EXISTS job_items_state ON job_items (job_id, state, next_try);
+    """)
+
+
+def plan_job(con, lats, lons, date_start, date_end, force_update=False):
+    """
+    Plan a backfill: one work item per (lat, lon) in the grid generated by lats and lons.
+    If an unfinished job with the same parameters exists, return it instead, so a backfill
+    started again resumes exactly where it stopped. A failed job gets its failed items back
+    with their attempts reset, since they would otherwise never be retried.
+
+    Args:
+        con (sqlite3.Connection): connection to the weather database
+        lats (list): List of latitudes
+        lons (list): List of longitudes
+        date_start (string): "YYYY-MM-DD"
+        date_end (string): "YYYY-MM-DD"
+        force_update (bool): Whether to replace data which already exists
+
+    Returns:
+        int: job_id
+    """
+    create_tables(con)
+    lats = [float(lat) for lat in lats]
+    lons = [float(lon) for lon in lons]
+    job_key = hashlib.sha1(json.dumps([lats, lons, date_start, date_end, bool(force_update)]).encode()).hexdigest()
+    row = con.execute("SELECT job_id, status FROM jobs WHERE job_key = ? AND status != ? ORDER BY job_id DESC LIMIT 1",
+                      (job_key, DONE)).fetchone()
+    if row:
+        job_id, status = row
+        if status == FAILED:
+            retry_failed(con, job_id)
+        print(f"Resuming job {job_id}")
+        return job_id
+
+    now = time.time()
+    cur = con.execute("""INSERT INTO jobs (job_key, date_start, date_end, force_update, status, created, updated)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                      (job_key, date_start, date_end, bool(force_update), PENDING, now, now))
+    job_id = cur.lastrowid
+    con.executemany("""INSERT OR IGNORE INTO job_items (job_id, lat, lon, date_start, date_end, updated)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    [(job_id, lat, lon, date_start, date_end, now) for lat in lats for lon in lons])
+    # Without force update, locations which already hold data are skipped.
+    # One set-based query instead of one SELECT per location.
+    if not force_update:
+        con.execute("""UPDATE job_items SET state = ? WHERE job_id = ? AND EXISTS (
+                           SELECT 1 FROM locations AS l WHERE l.lat = job_items.lat AND l.lon = job_items.lon
+                           AND EXISTS (SELECT 1 FROM data AS d WHERE d.loc_id = l.loc_id))""",
+                    (SKIPPED, job_id))
+    con.commit()
+    print(f"Planned job {job_id}: {job_progress(con, job_id)}")
+    return job_id
+
+
+def retry_failed(con, job_id):
+    """
+    Give the failed items of a job all their attempts again, and set the job as pending.
+    Without this, the items which ran out of attempts would stay failed whenever the job is resumed.
+
+    Returns:
+        int: how many items will be retried
+    """
+    now = time.time()
+    cur = con.execute("""UPDATE job_items SET state = ?, attempts = 0, next_try = 0, updated = ?
+                         WHERE job_id = ? AND state = ?""", (PENDING, now, job_id, FAILED))
+    con.execute("UPDATE jobs SET status = ?, updated = ? WHERE job_id = ? AND status = ?",
+                (PENDING, now, job_id, FAILED))
+    con.commit()
+    return cur.rowcount
+
+
+def next_items(con, job_id, max_attempts=5):
+    """
+    Return the (lat, lon) of the items ready to be (re)tried: pending items,
+    and failed items with attempts left whose backoff has expired.
+    """
+    return con.execute("""SELECT lat, lon FROM job_items WHERE job_id = ?
+                          AND (state = ? OR (state = ? AND attempts < ? AND next_try <= ?))
+                          ORDER BY lat, lon""",
+                       (job_id, PENDING, FAILED, max_attempts, time.time())).fetchall()
+
+
+def next_retry(con, job_id, max_attempts=5):
+    """Return when the next failed item can be retried, or None if no item has attempts left"""
+    return con.execute("SELECT MIN(next_try) FROM job_items WHERE job_id = ? AND state = ? AND attempts < ?",
+                       (job_id, FAILED, max_attempts)).fetchone()[0]
+
+
+def mark_done(con, job_id, locations, commit=True):
+    """Mark the items of these (lat, lon) as done"""
+    con.executemany("UPDATE job_items SET state = ?, last_error = NULL, updated = ? WHERE job_id = ? AND lat = ? AND lon = ?",
+                    [(DONE, time.time(), job_id, float(lat), float(lon)) for lat, lon in locations])
+    if commit:
+        con.commit()
+
+
+def mark_failed(con, job_id, locations, error, backoff=30, commit=True):
+    """Mark the items of these (lat, lon) as failed, and retry them after an exponential backoff"""
+    now = time.time()
+    con.executemany("""UPDATE job_items SET state = ?, attempts = attempts + 1, last_error = ?,
+                           next_try = ? + ? * (1 << attempts), updated = ?
+                       WHERE job_id = ? AND lat = ? AND lon = ?""",
+                    [(FAILED, error, now, backoff, now, job_id, float(lat), float(lon)) for lat, lon in locations])
+    if commit:
+        con.commit()
+
+
+def set_status(con, job_id, status):
+    """Set the status of a job, unless it has been cancelled"""
+    con.execute("UPDATE jobs SET status = ?, updated = ? WHERE job_id = ? AND status != ?",
+                (status, time.time(), job_id, CANCELLED))
+    con.commit()
+
+
+def job_status(con, job_id):
+    """Return the status of a job, or None if it doesn't exist"""
+    row = con.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return row[0] if row else None
+
+
+def claim_job(con, job_id, stale_after=STALE_AFTER):
+    """
+    Mark a job as running, unless it is done or another worker is running it.
+    Only one process can claim a job, so a job is never run twice at the same time.
+
+    Returns:
+        bool: True if the job has been claimed
+    """
+    now = time.time()
+    cur = con.execute("""UPDATE jobs SET status = ?, started = ?, updated = ? WHERE job_id = ?
+                         AND (status NOT IN (?, ?) OR (status = ? AND updated < ?))""",
+                      (RUNNING, now, now, job_id, DONE, RUNNING, RUNNING, now - stale_after))
+    con.commit()
+    return cur.rowcount == 1
+
+
+def touch_job(con, job_id, commit=True):
+    """Update the heartbeat of a running job"""
+    con.execute("UPDATE jobs SET updated = ? WHERE job_id = ? AND status = ?", (time.time(), job_id, RUNNING))
+    if commit:
+        con.commit()
+
+
+def cancel_job(con, job_id):
+    """
+    Cancel a job which isn't done. A running job stops before its next request.
+
+    Returns:
+        bool: True if the job has been cancelled
+    """
+    cur = con.execute("UPDATE jobs SET status = ?, updated = ? WHERE job_id = ? AND status NOT IN (?, ?)",
+                      (CANCELLED, time.time(), job_id, DONE, CANCELLED))
+    con.commit()
+    return cur.rowcount == 1
+
+
+def resumable_jobs(con, stale_after=STALE_AFTER):
+    """Return the ids of the jobs waiting to run, and of the running jobs abandoned by a restart"""
+    try:
+        rows = con.execute("SELECT job_id FROM jobs WHERE status = ? OR (status = ? AND updated < ?) ORDER BY job_id",
+                           (PENDING, RUNNING, time.time() - stale_after)).fetchall()
+    except sqlite3.OperationalError:
+        # The journal doesn't exist yet
+        return []
+    return [row[0] for row in rows]
+
+
+def job_progress(con, job_id):
+    """
+    Input: con, job_id
+    Output: {"done": ..., "skipped": ..., "failed": ..., "pending": ..., "total": ..., "remaining": ..., "eta": ...}
+    "eta" is the estimated number of seconds left (None if it can't be estimated yet).
+    """
+    progress = {DONE: 0, SKIPPED: 0, FAILED: 0, PENDING: 0}
+    for state, count in con.execute("SELECT state, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY state",
+                                    (job_id,)):
+        progress[state] = count
+    progress["total"] = sum(progress.values())
+    progress["remaining"] = progress[PENDING] + progress[FAILED]
+
+    # Estimate the time left from the rate of the items done since the job (re)started
+    progress["eta"] = None
+    row = con.execute("SELECT started, status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if row and row[0] and row[1] == RUNNING:
+        started = row[0]
+        done_since_start = con.execute("SELECT COUNT(*) FROM job_items WHERE job_id = ? AND state = ? AND updated >= ?",
+                                       (job_id, DONE, started)).fetchone()[0]
+        if done_since_start:
+            progress["eta"] = round(progress["remaining"] * (time.time() - started) / done_since_start)
+    return progress
+
+
+def job_errors(con, job_id, limit=10):
+    """Return the (lat, lon, attempts, last_error) of failed items"""
+    return con.execute("""SELECT lat, lon, attempts, last_error FROM job_items
+                          WHERE job_id = ? AND state = ? ORDER BY updated DESC LIMIT ?""",
+                       (job_id, FAILED, limit)).fetchall()
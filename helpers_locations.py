@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+from helpers_api import read_series
+from helpers_data import get_data
+from helpers_maps import DATA_TYPES, SHAPE
+
+
+# How a location between the cells of the grid is answered
+METHODS = ["nearest", "bilinear"]
+
+
+def grid_position(lat, lon, shape=SHAPE):
+    """
+    Fractional position of a location on the regular grid, by index arithmetic (no search):
+    row 0 is latitude -90 and the last row 90, column 0 is longitude -180 and the last column 180.
+
+    Returns:
+        turple: (row, col) as floats
+    """
+    row = (lat + 90) / 180 * (shape[0] - 1)
+    col = (lon + 180) / 360 * (shape[1] - 1)
+    return row, col
+
+
+def cell_location(row, col, shape=SHAPE):
+    """Latitude and longitude of a cell of the grid"""
+    return -90 + row * 180 / (shape[0] - 1), -180 + col * 360 / (shape[1] - 1)
+
+
+def nearest_cell(lat, lon, shape=SHAPE):
+    """
+    The cell of the grid nearest to a location.
+
+    Returns:
+        turple: (row, col)
+    """
+    row, col = grid_position(lat, lon, shape)
+    return int(round(row)), int(round(col))
+
+
+def bilinear_cells(lat, lon, shape=SHAPE):
+    """
+    The four cells around a location and their weights for bilinear interpolation
+    (fewer on the edges of the grid, where some of them are the same cell).
+
+    Returns:
+        list: [((row, col), weight), ...], the weights add up to 1
+    """
+    row, col = grid_position(lat, lon, shape)
+    row0 = min(int(np.floor(row)), shape[0] - 2)
+    col0 = min(int(np.floor(col)), shape[1] - 2)
+    dr, dc = row - row0, col - col0
+    cells = [((row0, col0), (1 - dr) * (1 - dc)), ((row0, col0 + 1), (1 - dr) * dc),
+             ((row0 + 1, col0), dr * (1 - dc)), ((row0 + 1, col0 + 1), dr * dc)]
+    return [(cell, weight) for cell, weight in cells if weight > 0]
+
+
+def local_series(lat, lon, method="nearest", start="1950-01", end="2023-12", dbpath="static/weather.db"):
+    """
+    Monthly data of a location from the local dataset (the cube, or the database if it has not been built):
+    the nearest cell, or the bilinear interpolation of the four cells around it. Cells without data
+    are left out of the interpolation and the weights of the others are scaled up.
+
+    Args:
+        lat (float): Latitude
+        lon (float): Longitude
+        method (string): "nearest" or "bilinear"
+        start (string): first month, "YYYY-MM"
+        end (string): last month, "YYYY-MM"
+
+    Returns:
+        DataFrame: monthly data indexed by dates (UTC), like get_data(), None if there is no local data
+    """
+    if method == "nearest":
+        cells = [(nearest_cell(lat, lon), 1.0)]
+    elif method == "bilinear":
+        cells = bilinear_cells(lat, lon)
+    else:
+        raise ValueError("Only 'nearest' or 'bilinear' are acceptable")
+
+    total = 0
+    weights = 0
+    for (row, col), weight in cells:
+        series = read_series(row, col, start, end, dbpath=dbpath)
+        values = np.array([series[climate_type] for climate_type in DATA_TYPES], dtype=float).T
+        available = ~np.isnan(values)
+        total = total + np.where(available, values, 0) * weight
+        weights = weights + available * weight
+    with np.errstate(invalid="ignore", divide="ignore"):
+        values = np.where(weights > 0, total / weights, np.nan)
+    if np.isnan(values).all():
+        return None
+    dates = pd.date_range(start + "-01", periods=len(values), freq="MS", tz="UTC", name="dates")
+    return pd.DataFrame(values, index=dates, columns=DATA_TYPES).dropna(how="all")
+
+
+def location_data(lat, lon, method="nearest", start="1950-01", end="2023-12", date_end=None,
+                  dbpath="static/weather.db", top_up=False, budget=None):
+    """
+    Monthly data of a location for its chart: local data from start to end and, if top_up is True,
+    the Open-Meteo API for the months the local dataset doesn't cover (after end, up to date_end).
+    The API is always asked for the nearest cell, whatever the method, so its answer is shared by all the
+    locations of the cell (the client caches identical requests, see helpers_data.open_meteo_client()).
+
+    Args:
+        date_end (string): "YYYY-MM-DD", last day of data (None: today)
+        top_up (bool): Whether to ask the API for the months after end (a call per chart which is not cached)
+        budget (ApiBudget): the API limits the call is taken from (None: not limited);
+                            when they are spent, the local data is returned alone instead of waiting
+
+    Returns:
+        DataFrame: monthly data indexed by dates (UTC), None if there is no data at all
+    """
+    df = local_series(lat, lon, method, start, end, dbpath=dbpath)
+    if not top_up:
+        return df
+    date_end = date_end or datetime.today().strftime("%Y-%m-%d")
+    api_start = (pd.Timestamp(end + "-01") + pd.offsets.MonthBegin(1)).strftime("%Y-%m-%d")
+    if df is None:
+        # Nothing stored for this location: the whole range comes from the API
+        api_start = start + "-01"
+    if api_start > date_end:
+        return df
+    if budget is not None and budget.try_acquire() > 0:
+        print(f"Only local data for {lat}°N, {lon}°E (until {end}): the API budget is spent")
+        return df
+    recent = get_data(location=cell_location(*nearest_cell(lat, lon)), date_start=api_start, date_end=date_end,
+                      meteo_types=["temperature_2m_mean", "precipitation_sum"], return_DataFrame=True)
+    if recent is not False:
+        recent = recent.drop(columns="loc_id", errors="ignore")
+        df = recent if df is None else pd.concat([df, recent])
+    else:
+        print(f"Only local data for {lat}°N, {lon}°E (until {end})")
+    return df
@@ -1,17 +1,36 @@
 import folium
-from matplotlib import colormaps
-from matplotlib.colors import Normalize
+from folium.utilities import mercator_transform
 import numpy as np
+import os
 import pandas as pd
 import sqlite3
 
+from helpers_assets import use_local_assets
+from helpers_cache import atomic_write
+from helpers_climatology import baseline_grid
+from helpers_colors import css_color, lut
+from helpers_cube import cube_month
+from helpers_db import connect
+from helpers_migrate import GRID_SHAPE, has_grid_keys
+from helpers_raster import TRANSPARENT, encode_png, quantize
 
 REPEAT = 2
 SHAPE = (91, 91)
+DATA_TYPES = ["temp_mean", "temp_max", "temp_min", "precip"]
+# Differences from the climatology baseline of the calendar month (see helpers_climatology.py)
+ANOMALY_TYPES = [climate_type + "_anomaly" for climate_type in DATA_TYPES]
+MAP_TYPES = DATA_TYPES + ANOMALY_TYPES
+# Linear trends per decade over a period (see helpers_trends.py)
+TREND_TYPES = [climate_type + "_trend" for climate_type in DATA_TYPES]
 MAX_TEMP = 40
 MIN_TEMP = -20
 MAX_PRECIP = 10
 MIN_PRECIP = 0
+# Anomalies have symmetric scales, centred on the baseline
+MAX_TEMP_ANOMALY = 5
+MAX_PRECIP_ANOMALY = 3
+MAX_TEMP_TREND = 1
+MAX_PRECIP_TREND = 0.5
 OPACITY = 0.5
 
 def add_bounds(map):
@@ -34,21 +53,34 @@ def add_legend(map, climate_type):
         max_data = str(MAX_PRECIP) + "mm"
         min_data = str(MIN_PRECIP) + "mm"
         title = "Precipitation per day (mm)"
-        colormap = "Blues"
     elif climate_type in ["temp_mean", "temp_max", "temp_min"]:
         max_data = str(MAX_TEMP) + "°C"
         min_data = str(MIN_TEMP) + "°C"
         title = f"{climate_type[5:].title()} Temperature (°C)"
-        colormap = "coolwarm"
+    elif climate_type == "precip_anomaly":
+        max_data = f"+{MAX_PRECIP_ANOMALY}mm"
+        min_data = f"-{MAX_PRECIP_ANOMALY}mm"
+        title = "Precipitation anomaly (mm)"
+    elif climate_type in ["temp_mean_anomaly", "temp_max_anomaly", "temp_min_anomaly"]:
+        max_data = f"+{MAX_TEMP_ANOMALY}°C"
+        min_data = f"-{MAX_TEMP_ANOMALY}°C"
+        title = f"{climate_type[5:-8].title()} Temperature anomaly (°C)"
+    elif climate_type == "precip_trend":
+        max_data = f"+{MAX_PRECIP_TREND}mm"
+        min_data = f"-{MAX_PRECIP_TREND}mm"
+        title = "Precipitation trend (mm per decade)"
+    elif climate_type in ["temp_mean_trend", "temp_max_trend", "temp_min_trend"]:
+        max_data = f"+{MAX_TEMP_TREND}°C"
+        min_data = f"-{MAX_TEMP_TREND}°C"
+        title = f"{climate_type[5:-6].title()} Temperature trend (°C per decade)"
     else: 
         return False
     # Create an HTML legend (scale bar)
-    cm = colormaps[colormap]
-    # Comvert rgba values from [0, 1] to [0, 255]
-    r, g, b, a = cm(0.0) # cm(0.0) rather than cm(0) 
-    start = f"rgba({int(r * 255)}, {int(g * 255)}, {int(b * 255)}, {OPACITY})"
-    r, g, b, a = cm(1.0)
-    end = f"rgba({int(r * 255)}, {int(g * 255)}, {int(b * 255)}, {OPACITY})"
+    colormap = scale_for(climate_type)[0]
+    start = css_color(colormap, 0.0, OPACITY)
+    # The centre of the diverging scales (no anomaly) is lighter than both ends
+    middle = css_color(colormap, 0.5, OPACITY)
+    end = css_color(colormap, 1.0, OPACITY)
     legend_html = f"""
     <div style="
         position: fixed; 
@@ -59,7 +91,7 @@ def add_legend(map, climate_type):
                     writing-mode: vertical-rl; transform: rotate(180deg)">
             {title}
         </div>
-        <div style="float: left; background: linear-gradient(to top, {start}, {end}); 
+        <div style="float: left; background: linear-gradient(to top, {start}, {middle}, {end}); 
                     height: 200px; width: 20px; margin: 0 5px;">
         </div>
         <div style="float: left; line-height: 18px; height: 200px;">
@@ -75,11 +107,7 @@ def add_legend(map, climate_type):
 
 
 def draw_multi_layers(start_date, end_date, climate_type):
-    if climate_type == "precip":
-        colormap = "Blues"
-    elif climate_type in ["temp_mean", "temp_max", "temp_min"]:
-        colormap = "coolwarm"
-    else: 
+    if climate_type not in MAP_TYPES:
         print("Invalid climate_type")
         return False
     # Draw multi layers in one map
@@ -90,79 +118,219 @@ def draw_multi_layers(start_date, end_date, climate_type):
         min_zoom=2,
         tiles="cartodb positron",
     )
+    use_local_assets(m)
     add_bounds(m)
     add_legend(m, climate_type)
     
     for date in dates:
-        strdate = date.strftime('%Y-%m-%d')
         strmonth = date.strftime('%Y-%m')
-        lats, lons, data = fetch_data(SHAPE, strdate, climate_type)
-        political_countries_url = (
-            "http://geojson.xyz/naturalearth-3.3.0/ne_50m_admin_0_countries.geojson"
-        )
-
-        # Repeat the map
-        data_r = np.tile(data, (1, (2*REPEAT+1)))
-        cm = colormaps[colormap]
-        colored_data = cm(normalize_data(data_r, climate_type))
-        
-        folium.raster_layers.ImageOverlay(
-            name = strmonth + "_" + climate_type,
-            image=colored_data,
-            bounds=[[lats.min(), lons.min()-REPEAT*360], [lats.max(), lons.max()+REPEAT*360]],
-            mercator_project=True,
-            opacity=OPACITY,
-        ).add_to(m)
+        add_raster(m, strmonth, climate_type)
            
     folium.LayerControl().add_to(m)
-    m.save("static/weather_data/climate.html")
+    atomic_write("static/weather_data/climate.html", m.save)
     
 
 def draw_multi_maps(start_date, end_date, climate_type):
     # Draw multi maps, each map has one layer
-    if climate_type == "precip":
-        colormap = "Blues"
-    elif climate_type in ["temp_mean", "temp_max", "temp_min"]:
-        colormap = "coolwarm"
-    else: 
+    if climate_type not in MAP_TYPES:
         print("Invalid climate_type")
         return False
     dates = generate_dates(start_date=start_date, end_date=end_date)
 
     for date in dates:
-        m = folium.Map(
-            location=(0, 0), 
-            zoom_start=2,
-            min_zoom=2,
-            tiles="cartodb positron",
-        )
-        add_bounds(m)
-        add_legend(m, climate_type)
-        strdate = date.strftime('%Y-%m-%d')
         strmonth = date.strftime('%Y-%m')
-        lats, lons, data = fetch_data(SHAPE, strdate, climate_type)
-        political_countries_url = (
-            "http://geojson.xyz/naturalearth-3.3.0/ne_50m_admin_0_countries.geojson"
-        )
+        render_map(strmonth, climate_type)
 
-        # Repeat the map
-        data_r = np.tile(data, (1, (2*REPEAT+1)))
-        cm = colormaps[colormap]
-        colored_data = cm(normalize_data(data_r, climate_type))
-        
-        folium.raster_layers.ImageOverlay(
-            name = strmonth + "_" + climate_type,
-            image=colored_data,
-            bounds=[[lats.min(), lons.min()-REPEAT*360], [lats.max(), lons.max()+REPEAT*360]],
-            mercator_project=True,
+
+def map_path(month, climate_type):
+    """Path of the map of a month ("YYYY-MM") and a climate type"""
+    return "static/weather_data/" + month + "_" + climate_type + ".html"
+
+
+def raster_path(month, climate_type):
+    """Path of the raster image of a month ("YYYY-MM") and a climate type"""
+    return "static/weather_raster/" + month + "_" + climate_type + ".png"
+
+
+def raster_url(month, climate_type):
+    """URL of the raster image of a month, served by the "/raster" route of app.py"""
+    return "/raster/" + month + "/" + climate_type + ".png"
+
+
+def add_raster(map, month, climate_type):
+    """
+    Add the raster image of a month to a map as one layer. The image is referenced by URL
+    instead of being embedded, and repeated REPEAT times on both sides so the map wraps around.
+    """
+    layer = folium.FeatureGroup(name=month + "_" + climate_type)
+    for k in range(-REPEAT, REPEAT + 1):
+        # Placeholder image: folium would try to open a relative URL as a file, so the URL is set afterwards
+        overlay = folium.raster_layers.ImageOverlay(
+            image=np.zeros((1, 1, 4)),
+            bounds=[[-90, -180 + k*360], [90, 180 + k*360]],
             opacity=OPACITY,
-        ).add_to(m)
-        
-        folium.LayerControl().add_to(m)
-        m.save("static/weather_data/" + strmonth + "_" + climate_type + ".html")
+        )
+        overlay.url = raster_url(month, climate_type)
+        overlay.add_to(layer)
+    layer.add_to(map)
+
+
+def render_map(month, climate_type, path=None):
+    """
+    Draw the map of one month and one climate type, and save it.
+    The map only references the raster image of the month, see render_raster().
+
+    Args:
+        month (string): "YYYY-MM", or a period (eg: "1991-2020_JJA", see helpers_periods.py)
+        climate_type (string): "temp_mean", "temp_max", "temp_min" or "precip"
+        path (string): where to save the map (default: map_path(month, climate_type))
+
+    Returns:
+        string: path of the map
+    """
+    m = folium.Map(
+        location=(0, 0), 
+        zoom_start=2,
+        min_zoom=2,
+        tiles="cartodb positron",
+    )
+    use_local_assets(m)
+    add_bounds(m)
+    add_legend(m, climate_type)
+    add_raster(m, month, climate_type)
+    folium.LayerControl().add_to(m)
+    path = path or map_path(month, climate_type)
+    atomic_write(path, m.save)
+    return path
+
+
+def render_raster(month, climate_type, lats, lons, data, path=None):
+    """
+    Draw the raster image of one month and one climate type from its grid, and save it
+    as an 8-bit palette PNG (north up, Web Mercator, missing values transparent).
+
+    Args:
+        month (string): "YYYY-MM", or a period (eg: "1991-2020_JJA", see helpers_periods.py)
+        climate_type (string): "temp_mean", "temp_max", "temp_min" or "precip"
+        lats (NDarray): latitudes of the grid
+        lons (NDarray): longitudes of the grid
+        data (NDarray): grid of shape (nlats, nlons), row 0 at lats.min()
+        path (string): where to save the image (default: raster_path(month, climate_type))
+
+    Returns:
+        string: path of the image
+    """
+    colormap, vmin, vmax = scale_for(climate_type)
+    indices = raster_indices(climate_type, lats, lons, data)
+    path = path or raster_path(month, climate_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    png = encode_png(indices, lut(colormap))
+
+    def save(tmppath):
+        with open(tmppath, "wb") as file:
+            file.write(png)
+    atomic_write(path, save)
+    return path
+
+
+def raster_indices(climate_type, lats, lons, data):
+    """
+    Project a grid to Web Mercator and quantize it to the palette indices of its colour scale.
+
+    Returns:
+        NDarray: uint8 array of shape (nlats, nlons), north at the top, TRANSPARENT where data is NaN
+    """
+    colormap, vmin, vmax = scale_for(climate_type)
+    # Project the values (rather than the colours) to Web Mercator, then put the north at the top
+    projected = mercator_transform(data, (lats.min(), lats.max()), origin="lower")[:, :, 0]
+    return quantize(projected[::-1], vmin, vmax)
+
+
+def frame_path(month, climate_type):
+    """Path of the animation frame of a month ("YYYY-MM") and a climate type"""
+    return "static/weather_frames/" + month + "_" + climate_type + ".bin"
+
+
+def render_frame(month, climate_type, lats, lons, data, path=None):
+    """
+    Save one frame of the animated maps: the raw palette indices of raster_indices(), one byte per pixel,
+    row by row from the north. The colours are in frame_palette(), shared by all the frames.
+
+    Returns:
+        string: path of the frame
+    """
+    indices = raster_indices(climate_type, lats, lons, data)
+    path = path or frame_path(month, climate_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def save(tmppath):
+        with open(tmppath, "wb") as file:
+            file.write(indices.tobytes())
+    atomic_write(path, save)
+    return path
+
+
+def draw_frame(month, climate_type):
+    """Fetch the grid of a month ("YYYY-MM") and save its animation frame, see render_frame()"""
+    if climate_type not in MAP_TYPES:
+        print("Invalid climate_type")
+        return False
+    lats, lons, data = fetch_data(SHAPE, month + "-01", climate_type)
+    return render_frame(month, climate_type, lats, lons, data)
+
+
+def frame_palette(climate_type):
+    """
+    Input: climate_type
+    Output: what the player of the animated maps needs to draw the frames of a climate type:
+            {"colors": [[r, g, b], ...], "transparent": ..., "width": ..., "height": ...,
+             "bounds": ..., "repeat": ..., "opacity": ..., "vmin": ..., "vmax": ...}
+    """
+    colormap, vmin, vmax = scale_for(climate_type)
+    return {
+        "colors": lut(colormap).tolist(),
+        "transparent": TRANSPARENT,
+        "width": SHAPE[1],
+        "height": SHAPE[0],
+        "bounds": [[-90, -180], [90, 180]],
+        "repeat": REPEAT,
+        "opacity": OPACITY,
+        "vmin": vmin,
+        "vmax": vmax,
+    }
+
+
+def draw_raster(month, climate_type):
+    """Fetch the grid of a month ("YYYY-MM") and draw its raster image, see render_raster()"""
+    if climate_type not in MAP_TYPES:
+        print("Invalid climate_type")
+        return False
+    lats, lons, data = fetch_data(SHAPE, month + "-01", climate_type)
+    return render_raster(month, climate_type, lats, lons, data)
+
+
+def scale_for(climate_type):
+    """
+    Input: climate_type
+    Output: (colormap, vmin, vmax), the colour scale of a climate type, or None if the type is unknown
+    """
+    if climate_type == "precip":
+        return "Blues", MIN_PRECIP, MAX_PRECIP
+    elif climate_type in ["temp_mean", "temp_max", "temp_min"]:
+        return "coolwarm", MIN_TEMP, MAX_TEMP
+    elif climate_type == "precip_anomaly":
+        # Diverging: drier than the baseline in brown, wetter in green
+        return "BrBG", -MAX_PRECIP_ANOMALY, MAX_PRECIP_ANOMALY
+    elif climate_type in ANOMALY_TYPES:
+        return "coolwarm", -MAX_TEMP_ANOMALY, MAX_TEMP_ANOMALY
+    elif climate_type == "precip_trend":
+        return "BrBG", -MAX_PRECIP_TREND, MAX_PRECIP_TREND
+    elif climate_type in TREND_TYPES:
+        return "coolwarm", -MAX_TEMP_TREND, MAX_TEMP_TREND
+    return None
 
 
-def fetch_data(shape=(91, 91), date="1950-01-01", climate_type="temp_mean"):
+def fetch_data(shape=(91, 91), date="1950-01-01", climate_type="temp_mean", dbpath="static/weather.db"):
     """
     Input: shape, date, climate_type
     Output: lats, lons, data
@@ -172,51 +340,158 @@ def fetch_data(shape=(91, 91), date="1950-01-01", climate_type="temp_mean"):
         date (string): 
         climate_type (string): "temp_mean" (mean temperature), "temp_max" (max temperature), 
                        "temp_min" (min temperature), or "precip" (precipitation)
+        dbpath (string): path of the weather database
 
     Returns:
         (NDarray) lats
         (NDarray) lons
         (NDarray) data
     """
-    date = date
+    lats, lons, grids = fetch_month(shape, date, [climate_type], dbpath=dbpath)
+    return lats, lons, grids[climate_type]
+
+
+def fetch_month(shape=(91, 91), date="1950-01-01", climate_types=DATA_TYPES, dbpath="static/weather.db"):
+    """
+    Read one month of the grid for several climate types at once, with the missing cells filled in.
+    Anomalies ("temp_mean_anomaly", ...) are the grid of their type minus its baseline for the calendar month:
+    one subtraction on top of reading the grid, the baselines are loaded once per process.
+
+    Args:
+        shape (turple): how many lats and lons to sample
+        date (string): "YYYY-MM-DD", the first day of the month
+        climate_types (list of strings): any of MAP_TYPES
+        dbpath (string): path of the weather database
+
+    Returns:
+        (NDarray) lats
+        (NDarray) lons
+        (dict) grids: {climate_type: NDarray}
+    """
+    anomalies = [climate_type for climate_type in climate_types if climate_type in ANOMALY_TYPES]
+    if anomalies:
+        bases = list(dict.fromkeys(climate_type[:-8] if climate_type in anomalies else climate_type
+                                   for climate_type in climate_types))
+        lats, lons, grids = fetch_month(shape, date, bases, dbpath=dbpath)
+        if tuple(shape) != SHAPE:
+            print("Anomalies are only available on the grid of the baselines")
+            return lats, lons, {climate_type: np.full(shape, np.nan) for climate_type in climate_types}
+        for climate_type in anomalies:
+            grids[climate_type] = grids[climate_type[:-8]] - baseline_grid(date[:7], climate_type[:-8], dbpath=dbpath)
+        return lats, lons, {climate_type: grids[climate_type] for climate_type in climate_types}
+    # Read the month from the memory-mapped cube if it has been built from this database, otherwise from the database
+    months = [cube_month(date[:7], climate_type, dbpath=dbpath) for climate_type in climate_types]
+    if all(month is not None and month.shape == tuple(shape) for month in months):
+        lats = np.linspace(-90, 90, shape[0])
+        lons = np.linspace(-180, 180, shape[1])
+        grids = {climate_type: np.array(month, dtype=float) for climate_type, month in zip(climate_types, months)}
+    else:
+        lats, lons, grids, found = fetch_grid(shape, date, climate_types, dbpath=dbpath)
+    for climate_type in climate_types:
+        # Both sources fill the same cells: absent rows and NULL values are NaN in either
+        found = ~np.isnan(grids[climate_type])
+        grids[climate_type] = fill_missing(grids[climate_type], found)
+        if not found.all():
+            print(f"Data doesn't exist in the database for {(~found).sum()} location(s)")
+            print(f"\tDate: {date}\n\tClimate type: {climate_type}")
+    return lats, lons, grids
+
+
+def fetch_grid(shape=(91, 91), date="1950-01-01", climate_types=DATA_TYPES, dbpath="static/weather.db"):
+    """
+    Fetch one month of the whole grid with a single query over a single connection,
+    then scatter the rows into (nlats, nlons) arrays by index.
+    
+    Args:
+        shape (turple): how many lats and lons to sample
+        date (string): "YYYY-MM-DD", the first day of the month
+        climate_types (list of strings): any of "temp_mean", "temp_max", "temp_min" and "precip"
+        dbpath (string): path of the weather database
+
+    Returns:
+        (NDarray) lats
+        (NDarray) lons
+        (dict) grids: {climate_type: NDarray}, NaN where the database holds no data
+        (NDarray) found: boolean mask of the cells found in the database
+    """
     nlats, nlons = shape
     lats = np.linspace(-90, 90, nlats)
     lons = np.linspace(-180, 180, nlons)
-    data = np.zeros((nlats, nlons))
-    for i in range(nlats):
-        for j in range(nlons):
-            lat = lats[i]
-            lon = lons[j]
-            con = sqlite3.connect("static/weather.db")
-            cur = con.cursor()
-            try:
-                query = f"""SELECT {climate_type} FROM data WHERE loc_id =
-                            (SELECT loc_id FROM locations WHERE lat=? AND lon=?)
-                            AND DATE(dates)=?"""
-                # https://sqlzap.com/blog/select-date-from-datetime-in-sql
-                cur.execute(query, (lat, lon, date))
-                temp = cur.fetchone()
-                con.close()
-            except:
-                print("Error while fetching weather data")
-                con.close()
-                temp = np.nan
-            try:
-                data[i][j] = temp[0]
-            except:
-                print(f"Data doesn't exist in the database: \n\tLatitude: {lat}\n\tLongitude: {lon}")
-                print(f"\tDate: {date}\n\tClimate type: {climate_type}")
-                try:
-                    if j == 0:
-                        data[i][j] = data[(i-1)%nlats][j]
-                    else:
-                        data[i][j] = data[i][(j-1)%nlons]
-                except:
-                    data[i][j] = np.nan
-    #temps = db.execute("SELECT temp FROM temp WHERE latitude = ? AND longitude = ?", lats, lons)
-    #data = temps[0]
-
-    return lats, lons, data
+    grids = {climate_type: np.full((nlats, nlons), np.nan) for climate_type in climate_types}
+    found = np.zeros((nlats, nlons), dtype=bool)
+    for climate_type in climate_types:
+        if climate_type not in DATA_TYPES:
+            print("Invalid climate_type")
+            return lats, lons, grids, found
+
+    try:
+        con = connect(dbpath, readonly=True)
+    except sqlite3.Error:
+        print(f"Cannot open the database {dbpath}")
+        return lats, lons, grids, found
+    columns = ", ".join("d." + climate_type for climate_type in climate_types)
+    try:
+        if tuple(shape) == GRID_SHAPE and has_grid_keys(con):
+            # Integer keys: one index lookup per cell instead of scanning the whole table
+            query = f"""SELECT l.row, l.col, {columns} FROM locations AS l
+                        JOIN data AS d ON d.loc_id = l.loc_id AND d.month = ?
+                        WHERE l.row IS NOT NULL"""
+            rows = con.execute(query, (int(date[:4] + date[5:7]),)).fetchall()
+            keys = True
+        else:
+            query = f"""SELECT l.lat, l.lon, {columns} FROM data AS d
+                        JOIN locations AS l ON l.loc_id = d.loc_id
+                        WHERE DATE(d.dates) = ?"""
+            rows = con.execute(query, (date,)).fetchall()
+            keys = False
+    except sqlite3.Error:
+        print("Error while fetching weather data")
+        rows = []
+    finally:
+        con.close()
+    if not rows:
+        return lats, lons, grids, found
+
+    # None (NULL) becomes NaN in a float array
+    values = np.array(rows, dtype=float)
+    if keys:
+        i = values[:, 0].astype(int)
+        j = values[:, 1].astype(int)
+    else:
+        # Work out each row's position in the grid and drop locations which are not on the grid
+        i = np.rint((values[:, 0] + 90) / 180 * (nlats - 1)).astype(int)
+        j = np.rint((values[:, 1] + 180) / 360 * (nlons - 1)).astype(int)
+        on_grid = (i >= 0) & (i < nlats) & (j >= 0) & (j < nlons)
+        i, j, values = i[on_grid], j[on_grid], values[on_grid]
+        on_grid = np.isclose(lats[i], values[:, 0]) & np.isclose(lons[j], values[:, 1])
+        i, j, values = i[on_grid], j[on_grid], values[on_grid]
+
+    found[i, j] = True
+    for k, climate_type in enumerate(climate_types):
+        grids[climate_type][i, j] = values[:, k + 2]
+    return lats, lons, grids, found
+
+
+def fill_missing(data, found):
+    """
+    Fill the cells which don't exist in the database with their neighbours' values:
+    the western neighbour, or the southern one for the first column.
+    
+    Args:
+        data (NDarray): grid of shape (nlats, nlons)
+        found (NDarray): boolean mask of the cells found in the database
+
+    Returns:
+        (NDarray) data
+    """
+    nlats, nlons = data.shape
+    # Cells are filled in the same order as they are read, so a gap copies the value just filled
+    for i, j in np.argwhere(~found):
+        if j == 0:
+            data[i][j] = data[(i-1)%nlats][j]
+        else:
+            data[i][j] = data[i][(j-1)%nlons]
+    return data
 
 
 def generate_dates(start_date, end_date):
@@ -226,16 +501,11 @@ def generate_dates(start_date, end_date):
 
 def normalize_data(data, climate_type):
     # Normalize data to the static scale
-    if climate_type == "precip":
-        max_data = MAX_PRECIP
-        min_data = MIN_PRECIP
-    elif climate_type in ["temp_mean", "temp_max", "temp_min"]:
-        max_data = MAX_TEMP
-        min_data = MIN_TEMP
-    else: 
+    scale = scale_for(climate_type)
+    if scale is None:
         return False
-    norm = Normalize(vmin=min_data, vmax=max_data)
-    return norm(data)
+    colormap, min_data, max_data = scale
+    return (np.asarray(data, dtype=float) - min_data) / (max_data - min_data)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+import sqlite3
+import sys
+
+
+# The regular grid of the maps: lats = np.linspace(-90, 90, 91), lons = np.linspace(-180, 180, 91)
+GRID_SHAPE = (91, 91)
+LAT_STEP = 180 / (GRID_SHAPE[0] - 1)
+LON_STEP = 360 / (GRID_SHAPE[1] - 1)
+
+# SQL expressions giving the integer grid keys of a location and the integer month key of a row of data
+ROW_SQL = f"CAST(ROUND((lat + 90) / {LAT_STEP}) AS INTEGER)"
+COL_SQL = f"CAST(ROUND((lon + 180) / {LON_STEP}) AS INTEGER)"
+ON_GRID_SQL = (f"ABS((lat + 90) / {LAT_STEP} - ROUND((lat + 90) / {LAT_STEP})) < 1e-6 "
+               f"AND ABS((lon + 180) / {LON_STEP} - ROUND((lon + 180) / {LON_STEP})) < 1e-6")
+MONTH_SQL = "CAST(substr(dates, 1, 4) || substr(dates, 6, 2) AS INTEGER)"
+
+# Each migration upgrades the schema by one version (stored in PRAGMA user_version)
+MIGRATIONS = [
+    # Version 1: integer (row, col) grid keys, integer yyyymm month keys and covering indexes
+    [
+        "ALTER TABLE locations ADD COLUMN row INTEGER",
+        "ALTER TABLE locations ADD COLUMN col INTEGER",
+        "ALTER TABLE data ADD COLUMN month INTEGER",
+        f"UPDATE locations SET row = {ROW_SQL}, col = {COL_SQL} WHERE {ON_GRID_SQL}",
+        f"UPDATE data SET month = {MONTH_SQL}",
+        """CREATE INDEX IF NOT EXISTS data_loc_month
+           ON data (loc_id, month, temp_mean, temp_max, temp_min, precip)""",
+        "CREATE INDEX IF NOT EXISTS locations_row_col ON locations (row, col, loc_id)",
+        # Keep the keys filled in for rows inserted by code which doesn't know about them
+        f"""CREATE TRIGGER IF NOT EXISTS locations_grid_keys AFTER INSERT ON locations
+            WHEN NEW.row IS NULL BEGIN
+                UPDATE locations SET row = {ROW_SQL}, col = {COL_SQL}
+                WHERE loc_id = NEW.loc_id AND {ON_GRID_SQL};
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS data_month_key AFTER INSERT ON data
+            WHEN NEW.month IS NULL BEGIN
+                UPDATE data SET month = {MONTH_SQL} WHERE rowid = NEW.rowid;
+            END""",
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(con):
+    """Return the schema version of a weather database (0 before any migration)"""
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def has_grid_keys(con):
+    """Whether the database has the integer grid and month keys"""
+    return schema_version(con) >= 1
+
+
+def grid_index(lat, lon, shape=GRID_SHAPE):
+    """
+    Input: lat, lon, shape
+    Output: (row, col) of the location in the regular grid, or None if it's not on the grid
+
+    Args:
+        lat (float): latitude
+        lon (float): longitude
+        shape (turple): how many lats and lons in the grid
+
+    Returns:
+        turple: (row, col), or None
+    """
+    row = (lat + 90) / 180 * (shape[0] - 1)
+    col = (lon + 180) / 360 * (shape[1] - 1)
+    if abs(row - round(row)) > 1e-6 or abs(col - round(col)) > 1e-6:
+        return None
+    row, col = round(row), round(col)
+    if not (0 <= row < shape[0] and 0 <= col < shape[1]):
+        return None
+    return row, col
+
+
+def migrate(dbpath="static/weather.db"):
+    """
+    Upgrade the weather database to the latest schema version.
+    Each migration runs in its own transaction.
+
+    Args:
+        dbpath (string): path of the weather database
+
+    Returns:
+        int: the schema version after migrating
+    """
+    con = sqlite3.connect(dbpath, isolation_level=None)
+    try:
+        version = schema_version(con)
+        for i in range(version, SCHEMA_VERSION):
+            print(f"Migrating {dbpath} from version {i} to {i + 1}")
+            con.execute("BEGIN")
+            try:
+                for statement in MIGRATIONS[i]:
+                    con.execute(statement)
+                con.execute(f"PRAGMA user_version = {i + 1}")
+                con.execute("COMMIT")
+            except sqlite3.Error as e:
+                con.execute("ROLLBACK")
+                print(f"Migration to version {i + 1} failed: {e}")
+                return i
+        con.execute("ANALYZE")
+        return schema_version(con)
+    finally:
+        con.close()
+
+
+def query_plans(dbpath="static/weather.db"):
+    """
+    Print the query plans of the lookups used by helpers_data and helpers_maps,
+    so we can check that they use indexes instead of full scans.
+
+    Args:
+        dbpath (string): path of the weather database
+
+    Returns:
+        dict: {query name: list of the steps of its plan}
+    """
+    con = sqlite3.connect(dbpath)
+    if has_grid_keys(con):
+        queries = {
+            "fetch_loc_id": ("SELECT loc_id FROM locations WHERE row = ? AND col = ?", (45, 45)),
+            "get_data_in_database": ("""SELECT * FROM data WHERE loc_id =
+                                        (SELECT loc_id FROM locations WHERE row = ? AND col = ?) LIMIT 1""", (45, 45)),
+            "fetch_grid": ("""SELECT l.row, l.col, d.temp_mean FROM locations AS l
+                              JOIN data AS d ON d.loc_id = l.loc_id AND d.month = ?
+                              WHERE l.row IS NOT NULL""", (195001,)),
+        }
+    else:
+        queries = {
+            "fetch_loc_id": ("SELECT loc_id FROM locations WHERE lat = ? AND lon = ?", (0, 0)),
+            "get_data_in_database": ("""SELECT * FROM data WHERE loc_id =
+                                        (SELECT loc_id FROM locations WHERE lat = ? AND lon = ?) LIMIT 1""", (0, 0)),
+            "fetch_grid": ("""SELECT l.lat, l.lon, d.temp_mean FROM data AS d
+                              JOIN locations AS l ON l.loc_id = d.loc_id
+                              WHERE DATE(d.dates) = ?""", ("1950-01-01",)),
+        }
+    plans = {}
+    print(f"Query plans for {dbpath} (schema version {schema_version(con)}):")
+    for name, (query, params) in queries.items():
+        plans[name] = [row[3] for row in con.execute("EXPLAIN QUERY PLAN " + query, params)]
+        print(f"\t{name}:")
+        for step in plans[name]:
+            # A SCAN over the data table is a full scan; over locations it's bounded by the grid
+            warning = "  <-- full scan" if step.startswith("SCAN") and "COVERING INDEX" not in step else ""
+            print(f"\t\t{step}{warning}")
+    con.close()
+    return plans
+
+
+if __name__ == "__main__":
+    # Usage: python helpers_migrate.py [dbpath]
+    dbpath = sys.argv[1] if len(sys.argv) > 1 else "static/weather.db"
+    query_plans(dbpath)
+    migrate(dbpath)
+    query_plans(dbpath)
@@ -0,0 +1,222 @@
+import json
+import numpy as np
+import os
+import re
+import sys
+
+from datetime import datetime
+from helpers_cache import atomic_write, build_lock
+from helpers_cube import load_cube
+from helpers_maps import SHAPE, render_map, render_raster
+
+
+PREFIX_PATH = "static/weather_prefix.npy"
+COUNTS_PATH = "static/weather_prefix_counts.npy"
+PREFIX_META_PATH = "static/weather_prefix.json"
+DATA_TYPES = ["temp_mean", "temp_max", "temp_min", "precip"]
+# Calendar months of the seasons. A month listed before a smaller one belongs to the previous year:
+# the winter of 2021 ("DJF") is December 2020, January and February 2021
+SEASONS = {
+    "annual": [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
+    "DJF": [12, 1, 2],
+    "MAM": [3, 4, 5],
+    "JJA": [6, 7, 8],
+    "SON": [9, 10, 11],
+}
+
+# Cache of the opened index, so each process maps the files only once
+_prefix = {"built": None, "sums": None, "counts": None, "meta": None}
+
+
+def period_key(start_year, end_year, season="annual"):
+    """Name of a period in the paths and URLs of its map, eg: "1991-2020_JJA" """
+    return f"{start_year}-{end_year}_{season}"
+
+
+def parse_period(key):
+    """
+    Read a period key, see period_key().
+
+    Returns:
+        turple: (start_year, end_year, season), or None if the key is not a period
+    """
+    match = re.fullmatch(r"(\d{4})-(\d{4})_(\w+)", key)
+    if not match or match.group(3) not in SEASONS or match.group(1) > match.group(2):
+        return None
+    return int(match.group(1)), int(match.group(2)), match.group(3)
+
+
+def build_prefix(sumspath=PREFIX_PATH, countspath=COUNTS_PATH, metapath=PREFIX_META_PATH):
+    """
+    Build the prefix-sum index of the cube: for each climate type, calendar month and cell, the running sums
+    of the values and of the number of months with data, year after year (NaN count as 0).
+    The sum over the years y0 to y1 is then sums[y1 + 1] - sums[y0], whatever the length of the range.
+
+    The arrays have the shape (climate types, 12, years + 1, nlats, nlons), so a lookup reads two whole grids
+    which are contiguous in the memory-mapped file. Sums are float64 so that subtracting
+    two large sums doesn't lose the decimals of the values.
+
+    Returns:
+        dict: metadata of the index, None if the cube doesn't exist
+    """
+    cube, cube_meta = load_cube()
+    if cube is None:
+        print("Cannot build the index of the periods without the cube, run python helpers_cube.py first")
+        return None
+    first_year = int(cube_meta["start"][:4])
+    offset = int(cube_meta["start"][5:7]) - 1
+    nmonths, nlats, nlons = cube.shape[:3]
+    nyears = (offset + nmonths + 11) // 12
+    types = [cube_meta["data_types"].index(climate_type) for climate_type in DATA_TYPES]
+
+    # Write into temporary files, so readers never see a half-built index
+    shape = (len(types), 12, nyears + 1, nlats, nlons)
+    sums = np.lib.format.open_memmap(sumspath + ".tmp", mode="w+", dtype=np.float64, shape=shape)
+    counts = np.lib.format.open_memmap(countspath + ".tmp", mode="w+", dtype=np.uint16, shape=shape)
+    sums[:, :, 0] = 0
+    counts[:, :, 0] = 0
+    years = np.arange(nyears)
+    for month in range(12):
+        # The months of the cube falling in this calendar month, one per year (NaN before start and after end)
+        indices = years * 12 + month - offset
+        valid = (indices >= 0) & (indices < nmonths)
+        values = np.full((nyears, nlats, nlons, len(types)), np.nan, dtype=np.float64)
+        values[valid] = cube[indices[valid]][..., types]
+        values = np.moveaxis(values, -1, 0)
+        sums[:, month, 1:] = np.nancumsum(values, axis=1)
+        counts[:, month, 1:] = np.cumsum(~np.isnan(values), axis=1)
+    sums.flush()
+    counts.flush()
+    del sums, counts
+    os.replace(sumspath + ".tmp", sumspath)
+    os.replace(countspath + ".tmp", countspath)
+
+    meta = {
+        "shape": list(shape),
+        "start_year": first_year,
+        "end_year": first_year + nyears - 1,
+        "data_types": DATA_TYPES,
+        "cube_built": cube_meta["built"],
+        "built": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    # Like the cube's, the metadata is published atomically once the arrays are in place
+    def save(tmppath):
+        with open(tmppath, "w") as file:
+            json.dump(meta, file, indent=4)
+    atomic_write(metapath, save)
+    print(f"Built the index of the periods {tuple(shape)}, {meta['start_year']}-{meta['end_year']}")
+    return meta
+
+
+def read_prefix_meta(metapath=PREFIX_META_PATH):
+    """The metadata of the index, None if it has not been built"""
+    try:
+        with open(metapath) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def prefix_mtime(metapath=PREFIX_META_PATH):
+    """When the index was last built (the maps of the periods drawn before are stale), None if it has not been"""
+    try:
+        return os.path.getmtime(metapath)
+    except OSError:
+        return None
+
+
+def load_prefix(sumspath=PREFIX_PATH, countspath=COUNTS_PATH, metapath=PREFIX_META_PATH):
+    """
+    Open the prefix-sum index as read-only memory maps. It is built first if it doesn't exist
+    or if the cube has been rebuilt since (when the cube is available), and opened again only after that.
+
+    Returns:
+        (numpy.memmap) sums, or None if there is no index
+        (numpy.memmap) counts, or None
+        (dict) meta, or None
+    """
+    meta = read_prefix_meta(metapath)
+    cube, cube_meta = load_cube()
+    if cube is not None and (meta is None or meta["cube_built"] != cube_meta["built"]):
+        # Built once, even if several workers need it at the same time
+        with build_lock("periods/prefix"):
+            meta = read_prefix_meta(metapath)
+            if meta is None or meta["cube_built"] != cube_meta["built"]:
+                meta = build_prefix(sumspath, countspath, metapath)
+    if meta is None:
+        return None, None, None
+    if _prefix["built"] != meta["built"]:
+        try:
+            sums = np.load(sumspath, mmap_mode="r")
+            counts = np.load(countspath, mmap_mode="r")
+        except (OSError, ValueError):
+            print("Warning: cannot open the index of the periods")
+            return None, None, None
+        _prefix.update(built=meta["built"], sums=sums, counts=counts, meta=meta)
+    return _prefix["sums"], _prefix["counts"], _prefix["meta"]
+
+
+def period_mean(climate_type, start_year, end_year, season="annual"):
+    """
+    Mean of a climate type over the months of a season from start_year to end_year, for each cell.
+    It costs two grid lookups per calendar month of the season (at most 24 for "annual"),
+    however many years the range has.
+
+    Args:
+        climate_type (string): "temp_mean", "temp_max", "temp_min" or "precip"
+        start_year (int): first year
+        end_year (int): last year
+        season (string): "annual", "DJF", "MAM", "JJA" or "SON"
+
+    Returns:
+        NDarray: grid of shape (nlats, nlons), row 0 at latitude -90, NaN where a cell has no data.
+                 None if there is no index
+    """
+    sums, counts, meta = load_prefix()
+    if sums is None:
+        return None
+    t = meta["data_types"].index(climate_type)
+    nyears = meta["shape"][2] - 1
+    months = SEASONS[season]
+    total = np.zeros(meta["shape"][3:])
+    n = np.zeros(meta["shape"][3:])
+    for month in months:
+        shift = 1 if month > months[-1] else 0
+        y0 = min(max(start_year - shift - meta["start_year"], 0), nyears)
+        y1 = min(max(end_year - shift - meta["start_year"] + 1, 0), nyears)
+        if y1 > y0:
+            total += sums[t, month - 1, y1] - sums[t, month - 1, y0]
+            n += counts[t, month - 1, y1].astype(float) - counts[t, month - 1, y0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n > 0, total / n, np.nan)
+
+
+def draw_period_raster(key, climate_type):
+    """Compute the mean of a period (see period_key()) and draw its raster image, see render_raster()"""
+    period = parse_period(key)
+    if period is None or climate_type not in DATA_TYPES:
+        print("Invalid period or climate_type")
+        return False
+    data = period_mean(climate_type, *period)
+    if data is None:
+        return False
+    lats = np.linspace(-90, 90, SHAPE[0])
+    lons = np.linspace(-180, 180, SHAPE[1])
+    return render_raster(key, climate_type, lats, lons, data)
+
+
+def draw_period_map(key, climate_type):
+    """Draw the map of a period, eg: "1991-2020_JJA", whose raster image is served by the "/raster" route"""
+    if parse_period(key) is None or climate_type not in DATA_TYPES:
+        print("Invalid period or climate_type")
+        return False
+    return render_map(key, climate_type)
+
+
+if __name__ == "__main__":
+    # Usage: python helpers_periods.py
+    # (after python helpers_cube.py, or let the first map of a period build the index)
+    meta = build_prefix()
+    if meta is None:
+        sys.exit(1)
@@ -0,0 +1,152 @@
+import argparse
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from helpers_cache import RenderCache, render_lock, write_sidecars
+from helpers_climatology import baselines_mtime, load_baselines
+from helpers_cube import CUBE_PATH, META_PATH, load_cube, validate_cube
+from helpers_maps import ANOMALY_TYPES, DATA_TYPES, MAP_TYPES, SHAPE, fetch_month, generate_dates, map_path, raster_path, render_map, render_raster
+
+
+def source_mtime(dbpath="static/weather.db"):
+    """
+    When the data behind the maps last changed: the build of the cube if it is used,
+    otherwise the last write to the weather database (including its write-ahead log).
+    """
+    cube, meta = load_cube()
+    if cube is not None:
+        return max(os.path.getmtime(CUBE_PATH), os.path.getmtime(META_PATH))
+    mtimes = [os.path.getmtime(path) for path in (dbpath, dbpath + "-wal") if os.path.exists(path)]
+    return max(mtimes) if mtimes else 0
+
+
+def is_current(path, mtime):
+    """Whether a rendered file exists and is newer than the data it was rendered from"""
+    try:
+        return os.path.getmtime(path) >= mtime
+    except OSError:
+        return False
+
+
+def prerender_month(month, climate_types, mtime, force=False, dbpath="static/weather.db"):
+    """
+    Render the maps and the raster images of one month. The grid is read once for all the climate types.
+    Runs in a worker process.
+
+    Args:
+        month (string): "YYYY-MM"
+        climate_types (list of strings): types of climate data to render
+        mtime (float): maps older than this are rendered again (anomalies: also those older than their baselines)
+        force (bool): render the maps even if they are current
+        dbpath (string): path of the weather database
+
+    Returns:
+        list: (month, climate_type, status, seconds), status is "rendered", "skipped" or "failed: ..."
+    """
+    mtimes = {climate_type: mtime for climate_type in climate_types}
+    if set(climate_types) & set(ANOMALY_TYPES):
+        anomaly_mtime = max(mtime, baselines_mtime(dbpath=dbpath) or 0)
+        mtimes.update((climate_type, anomaly_mtime) for climate_type in climate_types if climate_type in ANOMALY_TYPES)
+    todo = [climate_type for climate_type in climate_types
+            if force or not (is_current(map_path(month, climate_type), mtimes[climate_type])
+                             and is_current(raster_path(month, climate_type), mtimes[climate_type]))]
+    results = [(month, climate_type, "skipped", 0) for climate_type in climate_types if climate_type not in todo]
+    if not todo:
+        return results
+    start = time.time()
+    try:
+        lats, lons, grids = fetch_month(SHAPE, month + "-01", todo, dbpath=dbpath)
+    except Exception as e:
+        return results + [(month, climate_type, f"failed: {e}", 0) for climate_type in todo]
+    load = (time.time() - start) / len(todo)
+    for climate_type in todo:
+        start = time.time()
+        try:
+            # Coalesce with the requests of the app rendering the same files
+            for path in (raster_path(month, climate_type), map_path(month, climate_type)):
+                with render_lock(os.path.relpath(path, "static")):
+                    if path.endswith(".png"):
+                        render_raster(month, climate_type, lats, lons, grids[climate_type], path=path)
+                    else:
+                        render_map(month, climate_type, path=path)
+                        # Compressed here, in parallel, rather than when the parent indexes the map
+                        write_sidecars(path)
+            results.append((month, climate_type, "rendered", load + time.time() - start))
+        except Exception as e:
+            results.append((month, climate_type, f"failed: {e}", 0))
+    return results
+
+
+def prerender(start="1950-01", end="2023-12", climate_types=DATA_TYPES, workers=None, force=False,
+              dbpath="static/weather.db", cache=None):
+    """
+    Render the maps (and their raster images) of every month from start to end in a process pool,
+    skipping the ones which are newer than the data.
+
+    Args:
+        start (string): first month, "YYYY-MM"
+        end (string): last month, "YYYY-MM"
+        climate_types (list of strings): types of climate data to render
+        workers (int): number of processes (None: one per CPU)
+        force (bool): render the maps even if they are current
+        dbpath (string): path of the weather database
+        cache (RenderCache): index the rendered maps are added to (None: no index)
+
+    Returns:
+        dict: {"rendered": ..., "skipped": ..., "failed": ..., "seconds": ..., "maps_per_second": ...}
+    """
+    for climate_type in climate_types:
+        if climate_type not in MAP_TYPES:
+            raise ValueError(f"Invalid climate_type: {climate_type}")
+    if set(climate_types) & set(ANOMALY_TYPES):
+        # Built here once, instead of by the first worker while the others wait for it
+        load_baselines(dbpath=dbpath)
+    months = [date.strftime("%Y-%m") for date in generate_dates(start + "-01", end + "-01")]
+    mtime = source_mtime(dbpath)
+    report = {"rendered": 0, "skipped": 0, "failed": 0}
+    begin = time.time()
+    busy = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=validate_cube,
+                             initargs=(SHAPE, DATA_TYPES, start, end)) as executor:
+        futures = [executor.submit(prerender_month, month, climate_types, mtime, force, dbpath) for month in months]
+        for i, future in enumerate(as_completed(futures)):
+            for month, climate_type, status, seconds in future.result():
+                if status == "rendered":
+                    report["rendered"] += 1
+                    busy += seconds
+                    if cache:
+                        for path in (raster_path(month, climate_type), map_path(month, climate_type)):
+                            cache.store(os.path.relpath(path, cache.root))
+                elif status == "skipped":
+                    report["skipped"] += 1
+                else:
+                    report["failed"] += 1
+                    print(f"{month} {climate_type}: {status}")
+            if (i + 1) % 50 == 0 or i + 1 == len(months):
+                elapsed = time.time() - begin
+                print(f"{i + 1}/{len(months)} months, {report['rendered']} map(s) rendered "
+                      f"({report['rendered'] / elapsed:.1f}/s), {report['skipped']} skipped, {report['failed']} failed")
+    report["seconds"] = round(time.time() - begin, 1)
+    report["maps_per_second"] = round(report["rendered"] / report["seconds"], 2) if report["seconds"] else None
+    report["seconds_per_map"] = round(busy / report["rendered"], 3) if report["rendered"] else None
+    print(f"Pre-rendered {report['rendered']} map(s) in {report['seconds']} s "
+          f"({report['maps_per_second']} maps/s, {report['seconds_per_map']} s of work per map), "
+          f"{report['skipped']} skipped, {report['failed']} failed")
+    return report
+
+
+if __name__ == "__main__":
+    # Usage: python helpers_prerender.py [--start YYYY-MM] [--end YYYY-MM] [--types temp_mean precip] [--workers N] [--force]
+    parser = argparse.ArgumentParser(description="Render the maps catalogue ahead of the requests")
+    parser.add_argument("--start", default="1950-01", help="first month, YYYY-MM")
+    parser.add_argument("--end", default="2023-12", help="last month, YYYY-MM")
+    parser.add_argument("--types", nargs="+", default=DATA_TYPES, choices=MAP_TYPES, help="types of climate data")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="render the maps even if they are current")
+    parser.add_argument("--db", default="static/weather.db", help="path of the weather database")
+    args = parser.parse_args()
+    validate_cube(SHAPE, DATA_TYPES, args.start, args.end)
+    cache = RenderCache(budget=int(os.environ.get("RENDER_CACHE_BYTES", 1024**3)),
+                        policy=os.environ.get("RENDER_CACHE_POLICY", "lru"))
+    prerender(args.start, args.end, args.types, workers=args.workers, force=args.force, dbpath=args.db, cache=cache)
@@ -0,0 +1,73 @@
+import numpy as np
+import struct
+import zlib
+
+
+# Indices 0 to 254 are the colour scale, index 255 is transparent (no data)
+NCOLORS = 255
+TRANSPARENT = 255
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def png_chunk(kind, data):
+    """One PNG chunk: length, type, data and CRC"""
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+def encode_png(indices, palette, transparent=TRANSPARENT):
+    """
+    Encode an image of palette indices as an 8-bit palette PNG.
+    The same input always gives the same bytes, so the PNG can be identified by its hash.
+
+    Args:
+        indices (NDarray): uint8 array of shape (height, width), row 0 at the top
+        palette (NDarray): uint8 array of shape (ncolors, 3), RGB of each index
+        transparent (int): index which is fully transparent (None: no transparency)
+
+    Returns:
+        bytes: the PNG file
+    """
+    indices = np.ascontiguousarray(indices, dtype=np.uint8)
+    palette = np.asarray(palette, dtype=np.uint8)
+    height, width = indices.shape
+    # Filter type 0 (none) at the start of each row
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    raw[:, 1:] = indices
+    # Width, height, bit depth 8, colour type 3 (palette), default compression, filter and no interlace
+    header = struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)
+    chunks = [png_chunk(b"IHDR", header), png_chunk(b"PLTE", palette.tobytes())]
+    if transparent is not None:
+        # Alpha of the indices up to the transparent one, the following ones are opaque
+        alpha = np.full(transparent + 1, 255, dtype=np.uint8)
+        alpha[transparent] = 0
+        chunks.append(png_chunk(b"tRNS", alpha.tobytes()))
+    chunks.append(png_chunk(b"IDAT", zlib.compress(raw.tobytes(), 9)))
+    chunks.append(png_chunk(b"IEND", b""))
+    return PNG_SIGNATURE + b"".join(chunks)
+
+
+def quantize(data, vmin, vmax, ncolors=NCOLORS, transparent=TRANSPARENT, out=None):
+    """
+    Map values to palette indices: vmin to 0 and vmax to ncolors - 1, values out of the scale
+    are clipped to its ends, and NaN goes to the transparent index.
+
+    Args:
+        data (NDarray): values
+        vmin (float): bottom of the scale
+        vmax (float): top of the scale
+        out (NDarray): uint8 array with the shape of data to write into (None: a new one)
+
+    Returns:
+        NDarray: uint8 indices with the shape of data
+    """
+    # One float32 scratch array, transformed in place
+    scaled = np.subtract(data, vmin, dtype=np.float32)
+    scaled *= (ncolors - 1) / (vmax - vmin)
+    missing = np.isnan(scaled)
+    np.clip(scaled, 0, ncolors - 1, out=scaled)
+    np.rint(scaled, out=scaled)
+    scaled[missing] = transparent
+    if out is None:
+        out = np.empty(scaled.shape, dtype=np.uint8)
+    np.copyto(out, scaled, casting="unsafe")
+    return out
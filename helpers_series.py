@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+
+# Aggregation levels of the time series of a location
+LEVELS = ["monthly", "annual", "decadal"]
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling: keep `threshold` points of a series which preserve its shape.
+    The first and last points are always kept; from each bucket in between, the point which forms
+    the largest triangle with the previously kept point and the average of the next bucket.
+    https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+
+    Args:
+        x (NDarray): increasing x values (for dates, use their timestamps)
+        y (NDarray): y values, without NaN
+        threshold (int): number of points to keep
+
+    Returns:
+        NDarray: indices of the points kept, increasing
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    # threshold - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype=int)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = x[end:edges[i + 2]].mean(), y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(areas))
+        keep[i + 1] = a
+    return keep
+
+
+def downsample(series, threshold):
+    """
+    Downsample a series indexed by dates with lttb(), dropping its missing values first.
+
+    Returns:
+        Series: the points kept
+    """
+    series = series.dropna()
+    if len(series) <= threshold:
+        return series
+    timestamps = series.index.asi8 if isinstance(series.index, pd.DatetimeIndex) else series.index
+    return series.iloc[lttb(timestamps, series.to_numpy(), threshold)]
+
+
+def aggregate(df, level):
+    """
+    Aggregate monthly data to a coarser level: the mean of each year ("annual") or decade ("decadal").
+    Each period is dated by its first day.
+
+    Args:
+        df (DataFrame): monthly data indexed by dates
+        level (string): "monthly", "annual" or "decadal"
+
+    Returns:
+        DataFrame: aggregated data indexed by dates
+    """
+    if level == "monthly":
+        return df
+    years = df.index.year
+    if level == "annual":
+        starts = years
+    elif level == "decadal":
+        starts = years // 10 * 10
+    else:
+        raise ValueError(f"Invalid level: {level}")
+    aggregated = df.groupby(starts).mean(numeric_only=True)
+    aggregated.index = pd.to_datetime([f"{year}-01-01" for year in aggregated.index])
+    return aggregated
+
+
+def to_columns(df, columns):
+    """
+    Columnar JSON of a DataFrame indexed by dates: {"dates": ["YYYY-MM-DD", ...], column: [values, NaN as None]}
+    """
+    data = {"dates": [date.strftime("%Y-%m-%d") for date in df.index]}
+    for column in columns:
+        if column in df:
+            data[column] = [None if value != value else round(float(value), 3) for value in df[column].tolist()]
+    return data
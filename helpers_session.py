@@ -0,0 +1,145 @@
+import os
+import secrets
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from helpers_db import connect, get_db
+
+
+# Out of static/, which is served to anyone: a session id is as good as a password
+SESSION_DB = "instance/sessions.db"
+# Expired sessions are deleted by a background thread this often, in seconds
+SWEEP_INTERVAL = 600
+
+
+class SqliteSession(SecureCookieSession):
+    """The data of a session, and the id of its record (None until it is first saved)"""
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires = expires
+        # Id of the record to delete when the session is saved (see clear())
+        self.old_sid = None
+
+    def clear(self):
+        # Login and logout clear the session: its next data gets a new id, so an id seen before never leads to it
+        super().clear()
+        self.old_sid = self.old_sid or self.sid
+        self.sid = None
+
+
+class SqliteSessionInterface(SessionInterface):
+    """
+    Server-side sessions stored in SQLite: the cookie only holds a random id.
+    A record is only written when a session has data and has been modified, so visitors who are not
+    logged in (pages which only read session["imgname"]) never create one. Records expire after
+    app.permanent_session_lifetime without use; they are found by an index on their expiry
+    and deleted by a background sweeper.
+    """
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, dbpath=SESSION_DB, sweep_interval=SWEEP_INTERVAL):
+        self.dbpath = dbpath
+        self.sweep_interval = sweep_interval
+        os.makedirs(os.path.dirname(dbpath) or ".", exist_ok=True)
+        con = connect(dbpath)
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY NOT NULL,
+                data TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+        """)
+        con.commit()
+        con.close()
+        self.sweeper = None
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return SqliteSession()
+        row = get_db("sessions").execute("SELECT data, expires FROM sessions WHERE sid = ? AND expires > ?",
+                                         (sid, time.time())).fetchone()
+        if not row:
+            return SqliteSession()
+        return SqliteSession(self.serializer.loads(row[0]), sid=sid, expires=row[1])
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.old_sid:
+            con = get_db("sessions")
+            con.execute("DELETE FROM sessions WHERE sid = ?", (session.old_sid,))
+            con.commit()
+        if not session:
+            # Logged out (or never logged in): no record, and no cookie
+            if session.sid:
+                con = get_db("sessions")
+                con.execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+                con.commit()
+            if session.sid or session.old_sid:
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+            return
+        con = get_db("sessions")
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        if session.modified or not session.sid:
+            session.sid = session.sid or secrets.token_urlsafe(32)
+            con.execute("INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)",
+                        (session.sid, self.serializer.dumps(dict(session)), now + lifetime))
+            con.commit()
+        elif session.expires - now < lifetime / 2:
+            # Sliding expiry, written at most twice per lifetime instead of on every request
+            con.execute("UPDATE sessions SET expires = ? WHERE sid = ?", (now + lifetime, session.sid))
+            con.commit()
+        else:
+            return
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def sweep(self):
+        """
+        Delete the expired sessions.
+
+        Returns:
+            int: number of sessions deleted
+        """
+        con = connect(self.dbpath)
+        try:
+            deleted = con.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+            con.commit()
+        finally:
+            con.close()
+        return deleted
+
+    def start_sweeper(self):
+        """Sweep the expired sessions every sweep_interval seconds in a daemon thread"""
+        def run():
+            while True:
+                try:
+                    deleted = self.sweep()
+                    if deleted:
+                        print(f"Sessions: deleted {deleted} expired session(s)")
+                except Exception as e:
+                    print(f"Cannot sweep the sessions: {e}")
+                time.sleep(self.sweep_interval)
+
+        if self.sweeper is None:
+            self.sweeper = threading.Thread(target=run, name="session-sweeper", daemon=True)
+            self.sweeper.start()
+
+
+def init_app(app, dbpath=SESSION_DB, sweep_interval=SWEEP_INTERVAL):
+    """Store the sessions of an app in SQLite and start the sweeper (requires helpers_db.init_app())"""
+    app.config["DATABASES"]["sessions"] = dbpath
+    app.config["WAL_DATABASES"].append("sessions")
+    app.session_interface = SqliteSessionInterface(dbpath, sweep_interval)
+    app.session_interface.start_sweeper()
+    return app.session_interface
@@ -0,0 +1,212 @@
+import math
+import numpy as np
+import os
+import re
+import sys
+
+from helpers_cache import atomic_write
+from helpers_maps import SHAPE, TREND_TYPES, render_map, render_raster
+from helpers_periods import load_prefix, prefix_mtime
+from helpers_prerender import is_current, source_mtime
+
+try:
+    from scipy import stats
+except ImportError:
+    stats = None
+
+
+TREND_DIR = "static/weather_trends"
+DATA_TYPES = ["temp_mean", "temp_max", "temp_min", "precip"]
+# Layers of a trend array, see linear_trend()
+FIELDS = ["slope", "t", "p", "years"]
+# Cells with fewer complete years have no trend
+MIN_YEARS = 10
+# Maps of the significant trends only show the cells with a lower p-value
+SIGNIFICANCE = 0.05
+
+
+def trend_key(start_year, end_year, significant=False):
+    """Name of a trend map in its paths and URLs, eg: "1951-2020" or "1951-2020_significant" """
+    return f"{start_year}-{end_year}" + ("_significant" if significant else "")
+
+
+def parse_trend(key):
+    """
+    Read a trend key, see trend_key().
+
+    Returns:
+        turple: (start_year, end_year, significant), or None if the key is not a trend
+    """
+    match = re.fullmatch(r"(\d{4})-(\d{4})(_significant)?", key)
+    if not match or int(match.group(2)) - int(match.group(1)) + 1 < MIN_YEARS:
+        return None
+    return int(match.group(1)), int(match.group(2)), bool(match.group(3))
+
+
+def trend_path(start_year, end_year, climate_type):
+    """Path of the trend array of a period and a climate type"""
+    return f"{TREND_DIR}/{start_year}-{end_year}_{climate_type}.npy"
+
+
+def trend_mtime():
+    """When the data behind the trends last changed: the build of the cube or of the index of the periods"""
+    return max(source_mtime(), prefix_mtime() or 0)
+
+
+def annual_means(climate_type, start_year, end_year):
+    """
+    Annual means of each cell from the prefix sums of helpers_periods.py: the sums of the 12 calendar months
+    from one year to the next, all the years at once. Years with a missing month are NaN.
+
+    Returns:
+        (NDarray) years
+        (NDarray) means, of shape (years, nlats, nlons), or None if there is no index
+    """
+    sums, counts, meta = load_prefix()
+    if sums is None:
+        return None, None
+    t = meta["data_types"].index(climate_type)
+    nyears = meta["shape"][2] - 1
+    y0 = min(max(start_year - meta["start_year"], 0), nyears)
+    y1 = min(max(end_year - meta["start_year"] + 1, 0), nyears)
+    years = np.arange(y0, y1) + meta["start_year"]
+    total = np.diff(sums[t, :, y0:y1 + 1], axis=1).sum(axis=0)
+    n = np.diff(counts[t, :, y0:y1 + 1].astype(np.int32), axis=1).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return years, np.where(n == 12, total / 12, np.nan)
+
+
+def p_value(t, dof):
+    """
+    Two-sided p-value of Student's t statistics. Without scipy, t is first converted to a normal deviate
+    with an approximation which is close for more than 10 degrees of freedom.
+    """
+    t = np.abs(np.asarray(t, dtype=float))
+    dof = np.asarray(dof, dtype=float)
+    if stats is not None:
+        return 2 * stats.t.sf(t, dof)
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        z = t * (1 - 1 / (4 * dof)) / np.sqrt(1 + t**2 / (2 * dof))
+    return np.vectorize(math.erfc, otypes=[float])(z / math.sqrt(2))
+
+
+def linear_trend(years, values):
+    """
+    Least-squares line of every cell at once, ignoring the missing years of each cell: the sums of the normal
+    equations are reduced over the years axis, so there is no loop over the cells.
+
+    Args:
+        years (NDarray): the x values, one per year
+        values (NDarray): array of shape (years, ...), NaN where a year is missing
+
+    Returns:
+        NDarray: float32 array of shape (4, ...): the slope per decade, its t statistic, its two-sided p-value,
+                 and the number of years (see FIELDS). NaN where a cell has fewer than MIN_YEARS years
+    """
+    shape = values.shape[1:]
+    y = values.reshape(len(years), -1)
+    valid = ~np.isnan(y)
+    n = valid.sum(axis=0)
+    x = np.where(valid, np.asarray(years, dtype=float)[:, None], 0)
+    y = np.where(valid, y, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dx = np.where(valid, x - x.sum(axis=0) / n, 0)
+        dy = np.where(valid, y - y.sum(axis=0) / n, 0)
+        sxx = (dx * dx).sum(axis=0)
+        sxy = (dx * dy).sum(axis=0)
+        syy = (dy * dy).sum(axis=0)
+        slope = sxy / sxx
+        # Residual variance with n - 2 degrees of freedom, then the standard error of the slope
+        residuals = np.maximum(syy - slope * sxy, 0)
+        se = np.sqrt(residuals / (n - 2) / sxx)
+        t = slope / se
+    p = p_value(t, n - 2)
+    trend = np.stack([slope * 10, t, p, n.astype(float)])
+    trend[:3, n < max(MIN_YEARS, 3)] = np.nan
+    return trend.reshape((len(FIELDS),) + shape).astype(np.float32)
+
+
+def compute_trend(climate_type, start_year, end_year):
+    """
+    The linear trend of the annual means of a climate type over a period, for the whole grid.
+
+    Returns:
+        NDarray: float32 array of shape (4, nlats, nlons), see linear_trend(). None if there is no index
+    """
+    years, means = annual_means(climate_type, start_year, end_year)
+    if means is None:
+        return None
+    return linear_trend(years, means)
+
+
+def write_trend(start_year, end_year, climate_type, path=None):
+    """
+    Compute the trend of a period and save it as a NumPy .npy file.
+
+    Returns:
+        string: path of the file, False if it cannot be computed
+    """
+    if climate_type not in DATA_TYPES:
+        print("Invalid climate_type")
+        return False
+    trend = compute_trend(climate_type, start_year, end_year)
+    if trend is None:
+        print("Cannot compute the trend without the index of the periods")
+        return False
+    path = path or trend_path(start_year, end_year, climate_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def save(tmppath):
+        with open(tmppath, "wb") as file:
+            np.save(file, trend)
+    atomic_write(path, save)
+    return path
+
+
+def load_trend(start_year, end_year, climate_type):
+    """
+    The trend of a period: the saved array if it is newer than the data (see trend_mtime()),
+    otherwise it is computed and saved again, so merging new months invalidates it.
+
+    Returns:
+        NDarray: float32 array of shape (4, nlats, nlons), None if it cannot be computed
+    """
+    path = trend_path(start_year, end_year, climate_type)
+    if not is_current(path, trend_mtime()) and not write_trend(start_year, end_year, climate_type, path):
+        return None
+    return np.load(path)
+
+
+def draw_trend_raster(key, climate_type):
+    """
+    Draw the raster image of the trend of a period, eg: key "1951-2020", climate_type "temp_mean_trend".
+    With a "_significant" key, the cells whose p-value is not below SIGNIFICANCE are left transparent.
+    """
+    trend = parse_trend(key)
+    if trend is None or climate_type not in TREND_TYPES:
+        print("Invalid period or climate_type")
+        return False
+    start_year, end_year, significant = trend
+    data = load_trend(start_year, end_year, climate_type[:-6])
+    if data is None:
+        return False
+    slope = np.where(data[2] < SIGNIFICANCE, data[0], np.nan) if significant else data[0]
+    lats = np.linspace(-90, 90, SHAPE[0])
+    lons = np.linspace(-180, 180, SHAPE[1])
+    return render_raster(key, climate_type, lats, lons, slope)
+
+
+def draw_trend_map(key, climate_type):
+    """Draw the map of the trend of a period, whose raster image is served by the "/raster" route"""
+    if parse_trend(key) is None or climate_type not in TREND_TYPES:
+        print("Invalid period or climate_type")
+        return False
+    return render_map(key, climate_type)
+
+
+if __name__ == "__main__":
+    # Usage: python helpers_trends.py start_year end_year
+    if len(sys.argv) != 3:
+        sys.exit("Usage: python helpers_trends.py start_year end_year")
+    for climate_type in DATA_TYPES:
+        print(write_trend(int(sys.argv[1]), int(sys.argv[2]), climate_type))
@@ -0,0 +1,75 @@
+import os
+import time
+
+from helpers_cache import RenderCache, build_lock, render_lock
+
+
+def make_cache(tmp_path, budget=1024**3):
+    root = tmp_path / "static"
+    (root / "weather_data").mkdir(parents=True)
+    return RenderCache(root=str(root), dbpath=str(tmp_path / "render_cache.db"), budget=budget)
+
+
+def render_file(cache, key, size=100):
+    def render():
+        with open(cache.path(key), "w") as file:
+            file.write("x" * size)
+    return render
+
+
+def test_stale_file_is_a_miss(tmp_path):
+    cache = make_cache(tmp_path)
+    key = "weather_data/1950-01_temp_mean.html"
+    assert cache.get_or_render(key, render_file(cache, key)) is True
+    assert cache.get_or_render(key, render_file(cache, key)) is False
+    os.utime(cache.path(key), (0, 0))
+    assert cache.get_or_render(key, render_file(cache, key), stale_before=time.time()) is True
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_eviction_skips_locked_entries(tmp_path):
+    cache = make_cache(tmp_path, budget=250)
+    keys = [f"weather_data/1950-0{month}_temp_mean.html" for month in (1, 2, 3)]
+    cache.get_or_render(keys[0], render_file(cache, keys[0]))
+    cache.get_or_render(keys[1], render_file(cache, keys[1]))
+    # The oldest entry is being sent: the next one is evicted instead
+    with render_lock(keys[0], lock_dir=str(tmp_path / "locks")) as locked:
+        assert locked
+        with render_lock(keys[0], lock_dir=str(tmp_path / "locks"), blocking=False) as again:
+            assert not again
+    with render_lock(keys[0]):
+        cache.get_or_render(keys[2], render_file(cache, keys[2]))
+    assert os.path.isfile(cache.path(keys[0]))
+    assert not os.path.isfile(cache.path(keys[1]))
+    assert os.path.isfile(cache.path(keys[2]))
+    assert cache.stats()["evictions"] == 1
+
+
+def test_failed_render_is_not_stored(tmp_path):
+    cache = make_cache(tmp_path)
+    key = "weather_data/1950-01_temp_mean.html"
+    assert cache.get_or_render(key, lambda: False) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_chart_data_belongs_to_its_chart(tmp_path):
+    cache = make_cache(tmp_path)
+    (tmp_path / "static" / "location_data").mkdir()
+    key = "location_data/cell_45_45.html"
+
+    def render():
+        render_file(cache, key)()
+        with open(cache.path("location_data/cell_45_45.json"), "w") as file:
+            file.write("y" * 50)
+    cache.get_or_render(key, render)
+    assert cache.stats()["bytes"] == 150
+    cache.remove(key)
+    assert not os.listdir(tmp_path / "static" / "location_data")
+
+
+def test_build_lock_can_be_taken_under_any_render_lock():
+    # Even under the render stripe of its own name, the build doesn't wait for the lock held by its process
+    with render_lock("climatology/1951-1980"):
+        with build_lock("climatology/1951-1980") as locked:
+            assert locked
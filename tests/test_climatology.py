@@ -0,0 +1,51 @@
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+import helpers_climatology
+from helpers_climatology import baselines_mtime, build_baselines, climatology_path, compute_baselines, load_baselines
+from test_migrate import BASELINE_SCHEMA
+
+
+@pytest.fixture(autouse=True)
+def climatology_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers_climatology, "CLIMATOLOGY_DIR", str(tmp_path / "instance"))
+
+
+def weather_db(tmp_path):
+    dbpath = str(tmp_path / "weather.db")
+    con = sqlite3.connect(dbpath)
+    con.executescript(BASELINE_SCHEMA)
+    # A cell of the grid, and a location between the cells rounding to the cell (46, 46)
+    con.executemany("INSERT INTO locations (lat, lon) VALUES (?, ?)", [(0, 0), (1.5, 2.25)])
+    con.executemany("INSERT INTO data (loc_id, dates, temp_mean, temp_max, temp_min, precip) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(loc_id, f"{year}-01-01 00:00:00+00:00", 10.0 + year % 2, 15.0, 5.0, 1.0)
+                     for loc_id in (1, 2) for year in (1951, 1952)])
+    con.commit()
+    con.close()
+    return dbpath
+
+
+def test_baselines_leave_out_locations_off_the_grid(tmp_path):
+    baselines = compute_baselines(1951, 1980, dbpath=weather_db(tmp_path))
+    assert baselines[0, 45, 45, 0] == 10.5
+    assert np.isnan(baselines[0, 46, 46]).all()
+    assert np.isnan(baselines[1]).all()
+
+
+def test_baselines_are_stored_out_of_the_weather_database(tmp_path):
+    dbpath = weather_db(tmp_path)
+    os.utime(dbpath, (0, 0))
+    assert baselines_mtime(dbpath=dbpath) is None
+    build_baselines(1951, 1980, dbpath=dbpath)
+    assert os.path.getmtime(dbpath) == 0
+    assert climatology_path(dbpath) == str(tmp_path / "instance" / "weather_climatology.db")
+    assert os.path.isfile(climatology_path(dbpath))
+    built = baselines_mtime(dbpath=dbpath)
+    assert built is not None
+    assert load_baselines(dbpath=dbpath)[0, 45, 45, 0] == 10.5
+
+    build_baselines(1951, 1980, dbpath=dbpath)
+    assert baselines_mtime(dbpath=dbpath) > built
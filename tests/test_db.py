@@ -0,0 +1,33 @@
+import sqlite3
+
+from flask import Flask
+
+from helpers_db import get_db, init_app
+
+
+def journal_mode(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute("PRAGMA journal_mode").fetchone()[0]
+    finally:
+        con.close()
+
+
+def test_only_the_wal_databases_are_switched(tmp_path):
+    paths = {"users": str(tmp_path / "users.db"), "weather": str(tmp_path / "weather.db")}
+    for path in paths.values():
+        con = sqlite3.connect(path)
+        con.execute("CREATE TABLE t (x INTEGER)")
+        con.close()
+    app = Flask(__name__)
+    app.config["DATABASES"] = paths
+    init_app(app)
+    assert journal_mode(paths["users"]) == "delete"
+    assert journal_mode(paths["weather"]) == "wal"
+
+    # Writing through the app keeps the journal mode of the users database
+    with app.app_context():
+        get_db("users").execute("INSERT INTO t VALUES (1)")
+        get_db("users").commit()
+    assert journal_mode(paths["users"]) == "delete"
+    assert not (tmp_path / "users.db-wal").exists()
@@ -0,0 +1,21 @@
+from helpers_http import is_immutable, is_private
+
+
+def test_only_renders_which_are_never_drawn_again_are_immutable():
+    assert is_immutable("weather_data/1950-01_temp_mean.html")
+    assert is_immutable("weather_raster/1950-01_precip.png")
+    assert is_immutable("weather_frames/1950-01_temp_min.bin")
+    assert is_immutable("vendor/plotly-2.35.2.min.js")
+    # Drawn again after their baselines, their index or the data
+    assert not is_immutable("weather_data/1950-01_temp_mean_anomaly.html")
+    assert not is_immutable("weather_raster/1950-01_precip_anomaly.png")
+    assert not is_immutable("weather_frames/1950-01_temp_min_anomaly.bin")
+    assert not is_immutable("weather_data/1991-2020_JJA_temp_mean.html")
+    assert not is_immutable("weather_raster/1951-2020_temp_mean_trend.png")
+    assert not is_immutable("api/grid/1950-01_temp_mean.npy")
+
+
+def test_databases_are_never_served():
+    for filename in ["users.db", "weather.db-wal", "weather.db-shm", "weather_update.db-journal", "Users.DB"]:
+        assert is_private(filename)
+    assert not is_private("weather_data/1950-01_temp_mean.html")
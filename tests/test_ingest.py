@@ -0,0 +1,236 @@
+import numpy as np
+import pandas as pd
+import pytest
+import sqlite3
+
+import helpers_data
+import helpers_ingest
+from helpers_ingest import ApiBudget, ingest
+from helpers_jobs import plan_job
+from test_migrate import BASELINE_SCHEMA
+
+
+class Clock:
+    """Fake time.time() and time.sleep(): sleeping moves the clock forward"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(helpers_ingest.time, "time", clock.time)
+    monkeypatch.setattr(helpers_ingest.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_budget_refills_continuously(tmp_path, clock):
+    # 10 calls per 10 seconds: one call per second
+    budget = ApiBudget(str(tmp_path / "budget.db"), limits={"minute": (10, 10)})
+    assert budget.try_acquire(10) == 0
+    assert budget.try_acquire(1) == pytest.approx(1)
+    clock.now += 2.5
+    assert budget.remaining()["minute"] == pytest.approx(2.5)
+    assert budget.try_acquire(2) == 0
+    assert budget.remaining()["minute"] == pytest.approx(0.5)
+    # Never above the capacity
+    clock.now += 3600
+    assert budget.remaining()["minute"] == pytest.approx(10)
+
+
+def test_budget_waits_for_the_slowest_bucket(tmp_path, clock):
+    budget = ApiBudget(str(tmp_path / "budget.db"), limits={"fast": (10, 10), "slow": (10, 100)})
+    assert budget.acquire(10)
+    # 3 calls: 3 s for "fast", 30 s for "slow"
+    assert budget.try_acquire(3) == pytest.approx(30)
+    assert budget.acquire(3)
+    assert sum(clock.sleeps) == pytest.approx(30)
+    assert budget.remaining()["slow"] == pytest.approx(0)
+
+
+def test_budget_timeout(tmp_path, clock):
+    budget = ApiBudget(str(tmp_path / "budget.db"), limits={"minute": (10, 10)})
+    assert budget.acquire(10)
+    assert budget.acquire(5, timeout=1) is False
+    assert clock.sleeps == []
+    with pytest.raises(ValueError):
+        budget.try_acquire(11)
+
+
+def test_budget_is_shared_through_the_database(tmp_path, clock):
+    path = str(tmp_path / "budget.db")
+    first = ApiBudget(path, limits={"minute": (10, 10)})
+    second = ApiBudget(path, limits={"minute": (10, 10)})
+    assert first.try_acquire(6) == 0
+    assert second.try_acquire(6) == pytest.approx(2)
+    assert second.try_acquire(4) == 0
+
+
+class Variable:
+    def __init__(self, values):
+        self.values = values
+
+    def ValuesAsNumpy(self):
+        return self.values
+
+
+class Daily:
+    """Daily data of January 1950, one constant value per variable"""
+
+    def __init__(self, values):
+        self.values = values
+
+    def Time(self):
+        return int(pd.Timestamp("1950-01-01", tz="UTC").timestamp())
+
+    def TimeEnd(self):
+        return int(pd.Timestamp("1950-02-01", tz="UTC").timestamp())
+
+    def Interval(self):
+        return 86400
+
+    def Variables(self, j):
+        return Variable(np.full(31, self.values[j], dtype=np.float32))
+
+
+class Response:
+    def __init__(self, lat, lon, values):
+        self.lat = lat
+        self.lon = lon
+        self.values = values
+
+    def Latitude(self):
+        return self.lat
+
+    def Longitude(self):
+        return self.lon
+
+    def Daily(self):
+        return Daily(self.values)
+
+
+class Client:
+    """Stub of the Open-Meteo client, answering with prepared responses"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.params = None
+
+    def weather_api(self, url, params):
+        self.params = params
+        return self.responses
+
+
+METEO_TYPES = ["temperature_2m_mean", "precipitation_sum"]
+MODELS = ["model_a", "model_b"]
+
+
+def test_batch_is_demultiplexed_by_location(monkeypatch):
+    # One response per location and model, location by location, snapped to the models' grids
+    client = Client([
+        Response(0.05, 0.04, [10, 1]), Response(-0.03, 0.1, [12, 3]),
+        Response(10.02, 179.95, [20, 5]), Response(9.98, -179.9, [22, 7]),
+    ])
+    monkeypatch.setattr(helpers_data, "open_meteo_client", lambda: client)
+    dataframes = helpers_data.get_data_batch([(0, 0), (10, 180)], "1950-01-01", "1950-01-31",
+                                             models=MODELS, meteo_types=METEO_TYPES)
+    assert client.params["latitude"] == [0, 10]
+    assert client.params["longitude"] == [0, 180]
+    assert len(dataframes) == 2
+    # The mean of the models of each location, not of its neighbours
+    assert dataframes[0]["temp_mean"].tolist() == [11]
+    assert dataframes[0]["precip"].tolist() == [2]
+    assert dataframes[1]["temp_mean"].tolist() == [21]
+    assert dataframes[1]["precip"].tolist() == [6]
+
+
+def test_batch_fails_when_a_response_is_for_another_location(monkeypatch):
+    # The responses of the second location are more than 1° away from it
+    client = Client([
+        Response(0, 0, [10, 1]), Response(0, 0, [12, 3]),
+        Response(12, 20, [20, 5]), Response(12, 20, [22, 7]),
+    ])
+    monkeypatch.setattr(helpers_data, "open_meteo_client", lambda: client)
+    assert helpers_data.get_data_batch([(0, 0), (10, 20)], "1950-01-01", "1950-01-31",
+                                       models=MODELS, meteo_types=METEO_TYPES) is False
+
+
+def test_batch_fails_when_responses_are_missing(monkeypatch):
+    client = Client([Response(0, 0, [10, 1]), Response(0, 0, [12, 3]), Response(10, 20, [20, 5])])
+    monkeypatch.setattr(helpers_data, "open_meteo_client", lambda: client)
+    assert helpers_data.get_data_batch([(0, 0), (10, 20)], "1950-01-01", "1950-01-31",
+                                       models=MODELS, meteo_types=METEO_TYPES) is False
+
+
+def test_ingest_reports_each_failure(tmp_path):
+    def fetch(task):
+        if task == 2:
+            raise RuntimeError("timed out")
+        if task == 3:
+            return False
+        return task * 10
+
+    def write(con, task, result):
+        if task == 4:
+            return False
+        if task == 5:
+            raise ValueError("bad row")
+        written.append((task, result))
+
+    written = []
+    succeeded, failed = ingest([1, 2, 3, 4, 5], fetch, write, dbpath=str(tmp_path / "weather.db"), workers=2)
+    assert succeeded == [1]
+    assert written == [(1, 10)]
+    errors = dict(failed)
+    assert set(errors) == {2, 3, 4, 5}
+    assert errors[2] == "cannot get data: timed out"
+    assert errors[3] == "cannot get data"
+    assert errors[4] == "cannot write data into the database"
+    assert errors[5] == "cannot write data into the database: bad row"
+
+
+def test_ingest_fails_every_task_when_finish_fails(tmp_path):
+    def finish(con):
+        raise OSError("disk full")
+
+    succeeded, failed = ingest([1, 2], lambda task: task, lambda con, task, result: True,
+                               dbpath=str(tmp_path / "weather.db"), finish=finish)
+    assert succeeded == []
+    assert sorted(task for task, error in failed) == [1, 2]
+    assert all(error == "cannot write data into the database: disk full" for task, error in failed)
+
+
+def test_ingest_takes_the_cost_of_each_task_from_the_budget(tmp_path, clock):
+    budget = ApiBudget(str(tmp_path / "budget.db"), limits={"minute": (10, 10)})
+    succeeded, failed = ingest([1, 2, 3], lambda task: task, lambda con, task, result: True,
+                               dbpath=str(tmp_path / "weather.db"), workers=1, budget=budget, cost=lambda task: task)
+    assert sorted(succeeded) == [1, 2, 3] and failed == []
+    assert budget.remaining()["minute"] == pytest.approx(4)
+
+
+def test_job_does_not_write_a_batch_without_location(tmp_path, monkeypatch):
+    dbpath = str(tmp_path / "weather.db")
+    con = sqlite3.connect(dbpath)
+    con.executescript(BASELINE_SCHEMA)
+    job_id = plan_job(con, [0], [0, 4], "1950-01-01", "1950-01-31")
+    con.close()
+
+    data = pd.DataFrame({"dates": ["1950-01-01 00:00:00+00:00"], "temp_mean": [10.0], "temp_max": [15.0],
+                         "temp_min": [5.0], "precip": [1.0]})
+    monkeypatch.setattr(helpers_data, "get_data_batch", lambda batch, **kwargs: [data.copy() for _ in batch])
+    monkeypatch.setattr(helpers_data, "fetch_loc_id", lambda lat, lon, con=None: False if lon else 1)
+    assert helpers_data.run_job(job_id, dbpath=dbpath, budget_path=None, max_attempts=1) is False
+
+    con = sqlite3.connect(dbpath)
+    assert con.execute("SELECT COUNT(*) FROM data").fetchone()[0] == 0
+    assert con.execute("SELECT COUNT(*) FROM job_items WHERE state = 'failed'").fetchone()[0] == 2
+    con.close()
@@ -0,0 +1,22 @@
+import sqlite3
+
+from helpers_jobs import DONE, FAILED, PENDING, job_status, mark_done, mark_failed, next_items, plan_job, set_status
+
+
+def test_resuming_a_failed_job_retries_its_failed_items():
+    con = sqlite3.connect(":memory:")
+    con.executescript("""
+        CREATE TABLE locations (loc_id INTEGER PRIMARY KEY, lat REAL, lon REAL);
+        CREATE TABLE data (loc_id INTEGER, dates TIMESTAMP);
+    """)
+    job_id = plan_job(con, [0, 2], [0], "1950-01-01", "1950-12-31")
+    mark_done(con, job_id, [(0, 0)])
+    for _ in range(5):
+        mark_failed(con, job_id, [(2, 0)], "timeout", backoff=0)
+    set_status(con, job_id, FAILED)
+    assert next_items(con, job_id, max_attempts=5) == []
+
+    assert plan_job(con, [0, 2], [0], "1950-01-01", "1950-12-31") == job_id
+    assert job_status(con, job_id) == PENDING
+    assert next_items(con, job_id, max_attempts=5) == [(2.0, 0.0)]
+    assert con.execute("SELECT state, attempts FROM job_items WHERE lat = 0").fetchone() == (DONE, 0)
@@ -0,0 +1,29 @@
+import pandas as pd
+
+import helpers_locations
+from helpers_locations import location_data
+
+
+class SpentBudget:
+    def try_acquire(self, cost=1):
+        return 60
+
+
+def local(lat, lon, method, start, end, dbpath):
+    dates = pd.date_range(start + "-01", end + "-01", freq="MS", tz="UTC", name="dates")
+    return pd.DataFrame({"temp_mean": 10.0}, index=dates)
+
+
+def test_location_data_is_local_unless_topped_up(monkeypatch):
+    calls = []
+    monkeypatch.setattr(helpers_locations, "local_series", local)
+    monkeypatch.setattr(helpers_locations, "get_data", lambda **kwargs: calls.append(kwargs) or False)
+    assert len(location_data(1.2, 3.4, method="bilinear", start="1950-01", end="1950-12")) == 12
+    assert calls == []
+    # Spent budget: no call either
+    location_data(1.2, 3.4, method="bilinear", start="1950-01", end="1950-12", top_up=True, budget=SpentBudget())
+    assert calls == []
+    # The API is asked for the nearest cell, so the locations of a cell share the request
+    location_data(1.2, 3.4, method="bilinear", start="1950-01", end="1950-12", date_end="1951-03-31", top_up=True)
+    assert calls[0]["location"] == (2, 4)
+    assert calls[0]["date_start"] == "1951-01-01"
@@ -0,0 +1,89 @@
+import sqlite3
+
+from helpers_migrate import SCHEMA_VERSION, migrate, query_plans, schema_version
+
+
+# Schema of the weather database before any migration
+BASELINE_SCHEMA = """
+    CREATE TABLE locations (
+        loc_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        lat REAL NOT NULL,
+        lon REAL NOT NULL,
+        UNIQUE(lat, lon)
+    );
+    CREATE TABLE data (
+        loc_id INTEGER NOT NULL,
+        dates TIMESTAMP NOT NULL,
+        temp_mean REAL,
+        temp_max REAL,
+        temp_min REAL,
+        precip REAL,
+        FOREIGN KEY (loc_id) REFERENCES locations(loc_id),
+        UNIQUE(loc_id, dates)
+    );
+"""
+
+
+def baseline_db(tmp_path):
+    dbpath = str(tmp_path / "weather.db")
+    con = sqlite3.connect(dbpath)
+    con.executescript(BASELINE_SCHEMA)
+    # Two locations on the grid, one between its cells (from /locations)
+    con.executemany("INSERT INTO locations (lat, lon) VALUES (?, ?)", [(0, 0), (-90, -180), (1.5, 2.25)])
+    con.executemany("INSERT INTO data (loc_id, dates, temp_mean, temp_max, temp_min, precip) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(loc_id, f"1950-{month:02d}-01 00:00:00+00:00", 10.0, 15.0, 5.0, 1.0)
+                     for loc_id in (1, 2, 3) for month in range(1, 13)])
+    con.commit()
+    con.close()
+    return dbpath
+
+
+def test_migrate_adds_keys_and_indexes(tmp_path):
+    dbpath = baseline_db(tmp_path)
+    assert migrate(dbpath) == SCHEMA_VERSION
+
+    con = sqlite3.connect(dbpath)
+    assert schema_version(con) == SCHEMA_VERSION
+    assert {"row", "col"} <= {column[1] for column in con.execute("PRAGMA table_info(locations)")}
+    assert "month" in {column[1] for column in con.execute("PRAGMA table_info(data)")}
+    indexes = {index[1] for index in con.execute("PRAGMA index_list(data)")}
+    indexes |= {index[1] for index in con.execute("PRAGMA index_list(locations)")}
+    assert {"data_loc_month", "locations_row_col"} <= indexes
+
+    # Existing rows are keyed, locations off the grid are not
+    assert con.execute("SELECT row, col FROM locations ORDER BY loc_id").fetchall() == [(45, 45), (0, 0), (None, None)]
+    assert con.execute("SELECT COUNT(*) FROM data WHERE month IS NULL").fetchone()[0] == 0
+    assert con.execute("SELECT month FROM data WHERE loc_id = 1 ORDER BY month LIMIT 1").fetchone()[0] == 195001
+    con.close()
+
+
+def test_triggers_fill_keys_of_new_rows(tmp_path):
+    dbpath = baseline_db(tmp_path)
+    migrate(dbpath)
+
+    # Code which doesn't know about the keys still gets them
+    con = sqlite3.connect(dbpath)
+    con.execute("INSERT INTO locations (lat, lon) VALUES (?, ?)", (90, 180))
+    con.execute("INSERT INTO locations (lat, lon) VALUES (?, ?)", (0.5, 0.5))
+    loc_id = con.execute("SELECT loc_id FROM locations WHERE lat = 90").fetchone()[0]
+    con.execute("INSERT INTO data (loc_id, dates, temp_mean) VALUES (?, ?, ?)", (loc_id, "2023-07-01 00:00:00+00:00", 1.0))
+    con.commit()
+    assert con.execute("SELECT row, col FROM locations WHERE loc_id = ?", (loc_id,)).fetchone() == (90, 90)
+    assert con.execute("SELECT row, col FROM locations WHERE lat = 0.5").fetchone() == (None, None)
+    assert con.execute("SELECT month FROM data WHERE loc_id = ?", (loc_id,)).fetchone()[0] == 202307
+    con.close()
+
+
+def test_migrate_is_idempotent(tmp_path):
+    dbpath = baseline_db(tmp_path)
+    assert migrate(dbpath) == SCHEMA_VERSION
+    assert migrate(dbpath) == SCHEMA_VERSION
+
+
+def test_month_query_uses_covering_index(tmp_path):
+    dbpath = baseline_db(tmp_path)
+    migrate(dbpath)
+    plan = query_plans(dbpath)["fetch_grid"]
+    assert any("data_loc_month" in step and "COVERING INDEX" in step for step in plan), plan
+    # No full scan of the data table
+    assert not any(step.startswith("SCAN d") and "COVERING INDEX" not in step for step in plan), plan